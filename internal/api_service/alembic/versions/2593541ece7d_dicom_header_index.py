@@ -0,0 +1,51 @@
+"""dicom header index
+
+Revision ID: 2593541ece7d
+Revises: 3ebb172a8121
+Create Date: 2026-10-16 21:05:06.094610
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '2593541ece7d'
+down_revision: Union[str, Sequence[str], None] = '3ebb172a8121'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("""
+      CREATE TABLE DICOMHEADERS (
+        FILE_ID INT PRIMARY KEY,
+        SOP_INSTANCE_UID VARCHAR(64),
+        STUDY_INSTANCE_UID VARCHAR(64),
+        SERIES_INSTANCE_UID VARCHAR(64),
+        MODALITY VARCHAR(16),
+        STUDY_DATE DATE,
+        SERIES_DESCRIPTION VARCHAR(64),
+        SERIES_NUMBER INT,
+        INSTANCE_NUMBER INT,
+        SLICE_LOCATION DOUBLE PRECISION,
+        IMAGE_POSITION DOUBLE PRECISION[],
+        PIXEL_SPACING DOUBLE PRECISION[],
+        SLICE_THICKNESS DOUBLE PRECISION,
+        ROWS INT,
+        COLUMNS INT,
+        TRANSFER_SYNTAX_UID VARCHAR(64),
+        FOREIGN KEY (FILE_ID) REFERENCES FILERECORDS(FILE_ID)
+      )
+    """)
+    op.execute("CREATE INDEX DICOMHEADERS_STUDY_IDX ON DICOMHEADERS (STUDY_INSTANCE_UID)")
+    op.execute("CREATE INDEX DICOMHEADERS_SERIES_IDX ON DICOMHEADERS (SERIES_INSTANCE_UID, INSTANCE_NUMBER)")
+    op.execute("CREATE INDEX DICOMHEADERS_SOP_IDX ON DICOMHEADERS (SOP_INSTANCE_UID)")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TABLE DICOMHEADERS")
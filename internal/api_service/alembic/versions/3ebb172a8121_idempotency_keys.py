@@ -0,0 +1,40 @@
+"""idempotency keys
+
+Revision ID: 3ebb172a8121
+Revises: 438e3fc789e2
+Create Date: 2026-10-16 21:02:35.229136
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3ebb172a8121'
+down_revision: Union[str, Sequence[str], None] = '438e3fc789e2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("""
+      CREATE TABLE IDEMPOTENCY_KEYS (
+        AID INT NOT NULL,
+        IDEMPOTENCY_KEY VARCHAR(255) NOT NULL,
+        REQUEST_HASH CHAR(64) NOT NULL,
+        CLAIM_TOKEN UUID NOT NULL DEFAULT gen_random_uuid(),
+        STATUS VARCHAR(20) NOT NULL DEFAULT 'in_progress' CHECK (STATUS IN ('in_progress', 'complete')),
+        RESPONSE JSONB,
+        CLAIMED_AT TIMESTAMP NOT NULL DEFAULT NOW(),
+        COMPLETED_AT TIMESTAMP,
+        PRIMARY KEY (AID, IDEMPOTENCY_KEY)
+      )
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TABLE IDEMPOTENCY_KEYS")
@@ -0,0 +1,35 @@
+"""content addressed files
+
+Revision ID: 438e3fc789e2
+Revises: d9939b7c00ab
+Create Date: 2026-10-16 20:58:42.527613
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '438e3fc789e2'
+down_revision: Union[str, Sequence[str], None] = 'd9939b7c00ab'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("ALTER TABLE FILERECORDS ADD COLUMN CONTENT_HASH CHAR(64)")
+    op.execute("ALTER TABLE FILERECORDS ADD COLUMN REF_COUNT INT NOT NULL DEFAULT 1")
+    op.execute("""
+      CREATE UNIQUE INDEX FILERECORDS_CONTENT_HASH_IDX
+      ON FILERECORDS (CONTENT_HASH, FILETYPE) WHERE CONTENT_HASH IS NOT NULL
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP INDEX FILERECORDS_CONTENT_HASH_IDX")
+    op.execute("ALTER TABLE FILERECORDS DROP COLUMN REF_COUNT")
+    op.execute("ALTER TABLE FILERECORDS DROP COLUMN CONTENT_HASH")
@@ -0,0 +1,40 @@
+"""preview pyramid
+
+Revision ID: 5085faaccd79
+Revises: 2593541ece7d
+Create Date: 2026-10-16 21:11:56.212339
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5085faaccd79'
+down_revision: Union[str, Sequence[str], None] = '2593541ece7d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("""
+      CREATE TABLE FILEPREVIEWS (
+        FILE_ID INT NOT NULL,
+        LEVEL VARCHAR(16) NOT NULL,
+        OBJECT_KEY VARCHAR(255) NOT NULL,
+        CONTENT_TYPE VARCHAR(32) NOT NULL,
+        WIDTH INT NOT NULL,
+        HEIGHT INT NOT NULL,
+        SIZE_BYTES INT NOT NULL,
+        PRIMARY KEY (FILE_ID, LEVEL),
+        FOREIGN KEY (FILE_ID) REFERENCES FILERECORDS(FILE_ID)
+      )
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TABLE FILEPREVIEWS")
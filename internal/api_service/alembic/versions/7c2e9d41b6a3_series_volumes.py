@@ -0,0 +1,45 @@
+"""series volumes
+
+Revision ID: 7c2e9d41b6a3
+Revises: 5085faaccd79
+Create Date: 2026-10-16 21:24:08.530117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c2e9d41b6a3'
+down_revision: Union[str, Sequence[str], None] = '5085faaccd79'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("""
+      CREATE TABLE SERIESVOLUMES (
+        DICOM_ID INT NOT NULL,
+        SERIES_INSTANCE_UID VARCHAR(64) NOT NULL,
+        OBJECT_KEY VARCHAR(255) NOT NULL,
+        SLICE_COUNT INT NOT NULL,
+        ROWS INT NOT NULL,
+        COLUMNS INT NOT NULL,
+        DTYPE VARCHAR(8) NOT NULL,
+        DATA_OFFSET BIGINT NOT NULL,
+        SLICE_BYTES INT NOT NULL,
+        SIZE_BYTES BIGINT NOT NULL,
+        HEADER JSONB NOT NULL,
+        CREATED_AT TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (DICOM_ID, SERIES_INSTANCE_UID),
+        FOREIGN KEY (DICOM_ID) REFERENCES DICOMS(DICOM_ID)
+      )
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TABLE SERIESVOLUMES")
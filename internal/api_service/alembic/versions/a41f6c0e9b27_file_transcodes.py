@@ -0,0 +1,42 @@
+"""file transcodes
+
+Revision ID: a41f6c0e9b27
+Revises: 7c2e9d41b6a3
+Create Date: 2026-10-16 21:41:37.018245
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a41f6c0e9b27'
+down_revision: Union[str, Sequence[str], None] = '7c2e9d41b6a3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("""
+      CREATE TABLE FILETRANSCODES (
+        FILE_ID INT PRIMARY KEY,
+        ORIGINAL_KEY VARCHAR(255),
+        SOURCE_SYNTAX VARCHAR(64) NOT NULL,
+        STORED_SYNTAX VARCHAR(64) NOT NULL,
+        ORIGINAL_SIZE BIGINT NOT NULL,
+        STORED_SIZE BIGINT NOT NULL,
+        ENCODE_MS DOUBLE PRECISION,
+        ORIGINAL_DECODE_MS DOUBLE PRECISION,
+        STORED_DECODE_MS DOUBLE PRECISION,
+        CREATED_AT TIMESTAMP DEFAULT NOW(),
+        FOREIGN KEY (FILE_ID) REFERENCES FILERECORDS(FILE_ID)
+      )
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TABLE FILETRANSCODES")
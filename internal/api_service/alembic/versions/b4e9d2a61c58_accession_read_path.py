@@ -0,0 +1,210 @@
+"""accession read path
+
+Revision ID: b4e9d2a61c58
+Revises: f2a7c4d19e36
+Create Date: 2026-10-17 09:12:44.503187
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b4e9d2a61c58'
+down_revision: Union[str, Sequence[str], None] = 'f2a7c4d19e36'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # both link tables are keyed (owner, child); lookups from the child side
+    # (which accessions hold a file, who owns an accession) scanned them
+    op.execute("CREATE INDEX DICOMFILES_FILE_ID_IDX ON DICOMFILES (FILE_ID)")
+    op.execute("CREATE INDEX PATIENTDICOMS_DICOM_ID_IDX ON PATIENTDICOMS (DICOM_ID)")
+
+    # one row per accession with everything the listing shows, kept current
+    # by the triggers below, so listing never reads file rows
+    op.execute("""
+      CREATE TABLE ACCESSIONSUMMARY (
+        DICOM_ID INT PRIMARY KEY,
+        PATIENT_ID INT NOT NULL,
+        DICOM_NAME VARCHAR(100) NOT NULL,
+        CREATED_AT TIMESTAMP,
+        AGASTON_SCORE INT,
+        SLICES INT NOT NULL DEFAULT 0,
+        MASKS INT NOT NULL DEFAULT 0,
+        FOREIGN KEY (DICOM_ID) REFERENCES DICOMS(DICOM_ID)
+      )
+    """)
+    op.execute("""
+      CREATE INDEX ACCESSIONSUMMARY_PATIENT_IDX
+      ON ACCESSIONSUMMARY (PATIENT_ID, CREATED_AT DESC, DICOM_ID DESC)
+    """)
+
+    # file counts are recounted, not adjusted by deltas: the statement that
+    # creates an accession also links its files, and the two triggers may
+    # fire in either order
+    op.execute("""
+      CREATE FUNCTION refresh_accession_summary(dicom_ids INT[]) RETURNS VOID AS $$
+        INSERT INTO ACCESSIONSUMMARY (DICOM_ID, PATIENT_ID, DICOM_NAME, CREATED_AT, AGASTON_SCORE, SLICES, MASKS)
+        SELECT pd.DICOM_ID, pd.PATIENT_ID, d.DICOM_NAME, d.CREATED_AT, ps.AGASTON_SCORE,
+          COUNT(f.FILE_ID) FILTER (WHERE f.FILETYPE = 'slice'),
+          COUNT(f.FILE_ID) FILTER (WHERE f.FILETYPE = 'mask')
+        FROM PATIENTDICOMS pd
+        JOIN DICOMS d ON d.DICOM_ID = pd.DICOM_ID
+        LEFT JOIN PATIENT_STATS ps ON ps.STAT_ID = d.STAT_ID
+        LEFT JOIN DICOMFILES df ON df.DICOM_ID = pd.DICOM_ID
+        LEFT JOIN FILERECORDS f ON f.FILE_ID = df.FILE_ID
+        WHERE pd.DICOM_ID = ANY(dicom_ids)
+        GROUP BY pd.DICOM_ID, pd.PATIENT_ID, d.DICOM_NAME, d.CREATED_AT, ps.AGASTON_SCORE
+        ON CONFLICT (DICOM_ID) DO UPDATE SET
+          PATIENT_ID = EXCLUDED.PATIENT_ID,
+          DICOM_NAME = EXCLUDED.DICOM_NAME,
+          CREATED_AT = EXCLUDED.CREATED_AT,
+          AGASTON_SCORE = EXCLUDED.AGASTON_SCORE,
+          SLICES = EXCLUDED.SLICES,
+          MASKS = EXCLUDED.MASKS;
+        DELETE FROM ACCESSIONSUMMARY s
+        WHERE s.DICOM_ID = ANY(dicom_ids)
+          AND NOT EXISTS (SELECT 1 FROM PATIENTDICOMS pd WHERE pd.DICOM_ID = s.DICOM_ID);
+      $$ LANGUAGE sql
+    """)
+    # statement level, so a series of 500 slices refreshes its row once
+    op.execute("""
+      CREATE FUNCTION accession_summary_from_links() RETURNS TRIGGER AS $$
+      BEGIN
+        IF TG_OP = 'INSERT' THEN
+          PERFORM refresh_accession_summary(ARRAY(SELECT DISTINCT DICOM_ID FROM new_rows));
+        ELSE
+          PERFORM refresh_accession_summary(ARRAY(SELECT DISTINCT DICOM_ID FROM old_rows));
+        END IF;
+        RETURN NULL;
+      END;
+      $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+      CREATE FUNCTION accession_summary_from_dicoms() RETURNS TRIGGER AS $$
+      BEGIN
+        PERFORM refresh_accession_summary(ARRAY(SELECT DICOM_ID FROM new_rows));
+        RETURN NULL;
+      END;
+      $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+      CREATE FUNCTION accession_summary_from_stats() RETURNS TRIGGER AS $$
+      BEGIN
+        UPDATE ACCESSIONSUMMARY s SET AGASTON_SCORE = n.AGASTON_SCORE
+        FROM new_rows n
+        JOIN DICOMS d ON d.STAT_ID = n.STAT_ID
+        WHERE s.DICOM_ID = d.DICOM_ID;
+        RETURN NULL;
+      END;
+      $$ LANGUAGE plpgsql
+    """)
+    for table in ("PATIENTDICOMS", "DICOMFILES"):
+        op.execute(f"""
+          CREATE TRIGGER {table}_SUMMARY_INSERT AFTER INSERT ON {table}
+          REFERENCING NEW TABLE AS new_rows
+          FOR EACH STATEMENT EXECUTE FUNCTION accession_summary_from_links()
+        """)
+        op.execute(f"""
+          CREATE TRIGGER {table}_SUMMARY_DELETE AFTER DELETE ON {table}
+          REFERENCING OLD TABLE AS old_rows
+          FOR EACH STATEMENT EXECUTE FUNCTION accession_summary_from_links()
+        """)
+    op.execute("""
+      CREATE TRIGGER DICOMS_SUMMARY_UPDATE AFTER UPDATE ON DICOMS
+      REFERENCING NEW TABLE AS new_rows
+      FOR EACH STATEMENT EXECUTE FUNCTION accession_summary_from_dicoms()
+    """)
+    op.execute("""
+      CREATE TRIGGER PATIENT_STATS_SUMMARY_UPDATE AFTER UPDATE ON PATIENT_STATS
+      REFERENCING NEW TABLE AS new_rows
+      FOR EACH STATEMENT EXECUTE FUNCTION accession_summary_from_stats()
+    """)
+    op.execute("SELECT refresh_accession_summary(ARRAY(SELECT DICOM_ID FROM PATIENTDICOMS))")
+
+    # single-SELECT SQL functions the planner inlines into the calling query,
+    # so filters and LIMITs reach the indexes; the plpgsql versions ran
+    # their query blind and handed back a materialized result
+    op.execute("""
+      CREATE OR REPLACE FUNCTION get_dicoms_by_aid(aid_input INT)
+      RETURNS TABLE (
+        DICOM_ID INT,
+        DICOM_NAME VARCHAR,
+        CREATED_AT TIMESTAMP,
+        AGASTON_SCORE INT
+      ) AS $$
+        SELECT s.DICOM_ID, s.DICOM_NAME, s.CREATED_AT, s.AGASTON_SCORE
+        FROM ACCESSIONSUMMARY s
+        WHERE s.PATIENT_ID = aid_input
+      $$ LANGUAGE sql STABLE
+    """)
+    op.execute("""
+      CREATE OR REPLACE FUNCTION get_accession(aid_input INT, dicom_id_input INT)
+      RETURNS TABLE (
+        DICOM_NAME VARCHAR,
+        CREATED_AT TIMESTAMP,
+        FILETYPE VARCHAR,
+        OBJECT_KEY VARCHAR,
+        AGASTON_SCORE INT
+      ) AS $$
+        SELECT s.DICOM_NAME, s.CREATED_AT, f.FILETYPE, f.OBJECT_KEY, s.AGASTON_SCORE
+        FROM ACCESSIONSUMMARY s
+        JOIN DICOMFILES df ON df.DICOM_ID = s.DICOM_ID
+        JOIN FILERECORDS f ON f.FILE_ID = df.FILE_ID
+        WHERE s.PATIENT_ID = aid_input AND s.DICOM_ID = dicom_id_input
+      $$ LANGUAGE sql STABLE
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("""
+      CREATE OR REPLACE FUNCTION get_dicoms_by_aid(aid_input INT)
+      RETURNS TABLE (
+        DICOM_ID INT,
+        DICOM_NAME VARCHAR,
+        CREATED_AT TIMESTAMP,
+        AGASTON_SCORE INT
+      ) AS $$
+      BEGIN
+        RETURN QUERY
+          SELECT px.DICOM_ID, px.DICOM_NAME, px.CREATED_AT, px.AGASTON_SCORE
+          FROM patient_files_n_stats_by_dicom px
+          WHERE px.PATIENT_ID = aid_input;
+      END;
+      $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+      CREATE OR REPLACE FUNCTION get_accession(aid_input INT, dicom_id_input INT)
+      RETURNS TABLE (
+        DICOM_NAME VARCHAR,
+        CREATED_AT TIMESTAMP,
+        FILETYPE VARCHAR,
+        OBJECT_KEY VARCHAR,
+        AGASTON_SCORE INT
+      ) AS $$
+      BEGIN
+        RETURN QUERY
+          SELECT D.DICOM_NAME, D.CREATED_AT, D.FILETYPE, D.OBJECT_KEY, D.AGASTON_SCORE
+          FROM patient_files_n_stats_by_dicom D
+          WHERE D.PATIENT_ID = aid_input AND D.dicom_id = dicom_id_input;
+      END;
+      $$ LANGUAGE plpgsql
+    """)
+    op.execute("DROP TRIGGER PATIENT_STATS_SUMMARY_UPDATE ON PATIENT_STATS")
+    op.execute("DROP TRIGGER DICOMS_SUMMARY_UPDATE ON DICOMS")
+    for table in ("PATIENTDICOMS", "DICOMFILES"):
+        op.execute(f"DROP TRIGGER {table}_SUMMARY_DELETE ON {table}")
+        op.execute(f"DROP TRIGGER {table}_SUMMARY_INSERT ON {table}")
+    op.execute("DROP FUNCTION accession_summary_from_stats()")
+    op.execute("DROP FUNCTION accession_summary_from_dicoms()")
+    op.execute("DROP FUNCTION accession_summary_from_links()")
+    op.execute("DROP FUNCTION refresh_accession_summary(INT[])")
+    op.execute("DROP TABLE ACCESSIONSUMMARY")
+    op.execute("DROP INDEX PATIENTDICOMS_DICOM_ID_IDX")
+    op.execute("DROP INDEX DICOMFILES_FILE_ID_IDX")
@@ -0,0 +1,40 @@
+"""mask stacks
+
+Revision ID: c6d03b5a2e18
+Revises: a41f6c0e9b27
+Create Date: 2026-10-16 21:52:14.663802
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c6d03b5a2e18'
+down_revision: Union[str, Sequence[str], None] = 'a41f6c0e9b27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("""
+      CREATE TABLE MASKSTACKS (
+        DICOM_ID INT PRIMARY KEY,
+        OBJECT_KEY VARCHAR(255) NOT NULL,
+        SLICES INT NOT NULL,
+        RAW_BYTES BIGINT NOT NULL,
+        SIZE_BYTES BIGINT NOT NULL,
+        ETAG CHAR(32) NOT NULL,
+        FILE_IDS INT[] NOT NULL,
+        CREATED_AT TIMESTAMP DEFAULT NOW(),
+        FOREIGN KEY (DICOM_ID) REFERENCES DICOMS(DICOM_ID)
+      )
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TABLE MASKSTACKS")
@@ -0,0 +1,43 @@
+"""resumable uploads
+
+Revision ID: d9939b7c00ab
+Revises: 39a4f87c30f1
+Create Date: 2026-10-16 20:55:58.488496
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd9939b7c00ab'
+down_revision: Union[str, Sequence[str], None] = '39a4f87c30f1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("""
+      CREATE TABLE UPLOADS (
+        UPLOAD_ID UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+        AID INT NOT NULL,
+        FILENAME VARCHAR(255) NOT NULL,
+        FILETYPE VARCHAR(50) NOT NULL DEFAULT 'slice' CHECK (FILETYPE IN ('slice', 'mask')),
+        OBJECT_KEY VARCHAR(255) NOT NULL,
+        S3_UPLOAD_ID VARCHAR(1024) NOT NULL,
+        TOTAL_SIZE BIGINT NOT NULL,
+        CHUNK_SIZE INT NOT NULL,
+        STATUS VARCHAR(20) NOT NULL DEFAULT 'open' CHECK (STATUS IN ('open', 'complete', 'aborted', 'consumed')),
+        CREATED_AT TIMESTAMP DEFAULT NOW(),
+        FOREIGN KEY (AID) REFERENCES ACCOUNTS(AID)
+      )
+    """)
+    op.execute("CREATE INDEX UPLOADS_AID_IDX ON UPLOADS (AID, STATUS)")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TABLE UPLOADS")
@@ -0,0 +1,48 @@
+"""storage outbox
+
+Revision ID: e83b1f5c7a90
+Revises: c6d03b5a2e18
+Create Date: 2026-10-16 23:08:41.207519
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e83b1f5c7a90'
+down_revision: Union[str, Sequence[str], None] = 'c6d03b5a2e18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("""
+      CREATE TABLE STORAGE_OUTBOX (
+        OUTBOX_ID BIGSERIAL PRIMARY KEY,
+        KIND VARCHAR(32) NOT NULL CHECK (KIND IN ('derivatives', 'delete_objects', 'release_files', 'sweep')),
+        PAYLOAD JSONB NOT NULL,
+        ATTEMPTS INT NOT NULL DEFAULT 0,
+        NEXT_ATTEMPT_AT TIMESTAMP NOT NULL DEFAULT NOW(),
+        LAST_ERROR TEXT,
+        CREATED_AT TIMESTAMP DEFAULT NOW()
+      )
+    """)
+    op.execute("CREATE INDEX STORAGE_OUTBOX_DUE_IDX ON STORAGE_OUTBOX (NEXT_ATTEMPT_AT)")
+    # the sweep is one recurring row
+    op.execute("INSERT INTO STORAGE_OUTBOX (KIND, PAYLOAD) VALUES ('sweep', '{\"after\": \"\"}')")
+    # the reconciler looks objects up by key
+    op.execute("CREATE INDEX FILERECORDS_OBJECT_KEY_IDX ON FILERECORDS (OBJECT_KEY)")
+    op.execute("CREATE INDEX FILEPREVIEWS_OBJECT_KEY_IDX ON FILEPREVIEWS (OBJECT_KEY)")
+    op.execute("CREATE INDEX FILETRANSCODES_ORIGINAL_KEY_IDX ON FILETRANSCODES (ORIGINAL_KEY) WHERE ORIGINAL_KEY IS NOT NULL")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP INDEX FILETRANSCODES_ORIGINAL_KEY_IDX")
+    op.execute("DROP INDEX FILEPREVIEWS_OBJECT_KEY_IDX")
+    op.execute("DROP INDEX FILERECORDS_OBJECT_KEY_IDX")
+    op.execute("DROP TABLE STORAGE_OUTBOX")
@@ -0,0 +1,58 @@
+"""intensity stats
+
+Revision ID: f2a7c4d19e36
+Revises: e83b1f5c7a90
+Create Date: 2026-10-17 00:41:09.318254
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2a7c4d19e36'
+down_revision: Union[str, Sequence[str], None] = 'e83b1f5c7a90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("""
+      CREATE TABLE SLICEINTENSITY (
+        FILE_ID INT PRIMARY KEY,
+        HU_MIN DOUBLE PRECISION NOT NULL,
+        HU_MAX DOUBLE PRECISION NOT NULL,
+        HU_SUM DOUBLE PRECISION NOT NULL,
+        VOXELS BIGINT NOT NULL,
+        CALCIUM_VOXELS BIGINT NOT NULL,
+        HISTOGRAM INT[] NOT NULL,
+        FOREIGN KEY (FILE_ID) REFERENCES FILERECORDS(FILE_ID)
+      )
+    """)
+    op.execute("""
+      CREATE TABLE SERIESINTENSITY (
+        DICOM_ID INT NOT NULL,
+        SERIES_INSTANCE_UID VARCHAR(64) NOT NULL,
+        MODALITY VARCHAR(16),
+        SLICES INT NOT NULL,
+        HU_MIN DOUBLE PRECISION NOT NULL,
+        HU_MAX DOUBLE PRECISION NOT NULL,
+        HU_MEAN DOUBLE PRECISION,
+        VOXELS BIGINT NOT NULL,
+        CALCIUM_VOXELS BIGINT NOT NULL,
+        CALCIUM_VOLUME_MM3 DOUBLE PRECISION,
+        HISTOGRAM BIGINT[] NOT NULL,
+        CREATED_AT TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (DICOM_ID, SERIES_INSTANCE_UID),
+        FOREIGN KEY (DICOM_ID) REFERENCES DICOMS(DICOM_ID)
+      )
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TABLE SERIESINTENSITY")
+    op.execute("DROP TABLE SLICEINTENSITY")
@@ -4,7 +4,8 @@ from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from auth.models.token import Token
-from auth.services.auth_service import authenticate_user, create_access_token
+from auth.services.auth_service import authenticate_user, create_access_token, get_current_active_user
+from auth.utils.auth_utils import HashPoolBusy, hash_stats
 from db_service.utils.db_utils import get_session
 
 from datetime import timedelta
@@ -21,7 +22,14 @@ async def login_for_access_token(
   form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
   session: AsyncSession = Depends(get_session)
 ) -> Token:
-  user: Accounts | None = await authenticate_user(form_data.username, form_data.password, session)
+  try:
+    user: Accounts | None = await authenticate_user(form_data.username, form_data.password, session)
+  except HashPoolBusy as e:
+    raise HTTPException(
+      status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+      detail=str(e),
+      headers={"Retry-After": "1"}
+    )
   if not user:
     raise HTTPException(
       status_code=status.HTTP_401_UNAUTHORIZED,
@@ -31,8 +39,14 @@ async def login_for_access_token(
   access_token_expires = timedelta(minutes=30)
   token = create_access_token(
     data={
-      "sub": user.email
+      "sub": form_data.username
     },
     expires_delta=access_token_expires
   )
   return Token(access_token=token, token_type="bearer")
+
+
+@auth_router.get("/hash-pool", dependencies=[Depends(get_current_active_user)])
+async def get_hash_pool_stats() -> dict:
+  """Queue depth and timings of the password hashing pool of this worker."""
+  return hash_stats.as_dict()
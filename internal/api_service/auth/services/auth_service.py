@@ -6,8 +6,9 @@ import jwt
 from jwt.exceptions import InvalidTokenError
 from sqlalchemy.ext.asyncio import AsyncSession
 from auth.models.token import TokenData
-from auth.utils.auth_utils import verify_password
-from users.services.user_service import get_user_by_email
+from auth.utils.auth_utils import verify_password_async
+from auth.services.principal_service import principal_cache
+from users.services.user_service import get_credentials, get_user_by_email
 from db_service.utils.db_utils import get_session
 import os
 from datetime import datetime, timedelta, timezone
@@ -33,11 +34,17 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None) -> s
 
 
 async def authenticate_user(email: str, password: str, session: AsyncSession) -> Accounts | None:
-  """Validate user credentials and return the matching account."""
-  user: Accounts | None = await get_user_by_email(email, session)
-  if not user:
+  """
+  Validate user credentials and return the matching account. The bcrypt
+  check runs on the hashing pool; raises HashPoolBusy when it is saturated.
+  """
+  credentials = await get_credentials(email, session)
+  if credentials is None:
     return None
-  if not verify_password(password, user.pswrd_hash):
+  user, pswrd_hash = credentials
+  # release the pooled connection before waiting on the hash
+  await session.rollback()
+  if not await verify_password_async(password, pswrd_hash):
     return None
   return user
 
@@ -46,7 +53,14 @@ async def get_current_user(
   token: Annotated[str, Depends(oauth2_scheme)],
   session: AsyncSession = Depends(get_session)
 ) -> Accounts:
-  """Get the current user from the JWT token."""
+  """
+  Get the current user from the JWT token. A token seen recently resolves
+  from the principal cache, without decoding it again or touching the
+  database; the session is then never used, so no connection is taken.
+  """
+  user: Accounts | None = principal_cache.get(token)
+  if user is not None:
+    return user
   credentials_exception = HTTPException(
     status_code=status.HTTP_401_UNAUTHORIZED,
     detail="Could not validate credentials",
@@ -62,11 +76,12 @@ async def get_current_user(
   except InvalidTokenError:
     raise credentials_exception
 
-  user: Accounts | None = await get_user_by_email(email=token_data.email, session=session)
+  user = await get_user_by_email(email=token_data.email, session=session)
   if user is None:
     raise credentials_exception
+  principal_cache.put(token, user, payload.get("exp"))
   return user
 
 
 async def get_current_active_user(current_user: Accounts = Depends(get_current_user)) -> Accounts | None:
-  return await current_user
+  return current_user
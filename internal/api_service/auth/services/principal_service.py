@@ -0,0 +1,68 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from users.models.accounts import Accounts
+
+# how long a verified token is trusted without looking the account up again;
+# nothing invalidates entries early, so this is how long an account change
+# (or removal) can go unnoticed by a worker
+PRINCIPAL_TTL_SECONDS = int(os.getenv("PRINCIPAL_TTL_SECONDS", "60"))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+
+
+class PrincipalCache:
+  """
+  Accounts by verified bearer token, least recently used first. An entry
+  lives PRINCIPAL_TTL_SECONDS or until its token expires, whichever is
+  sooner. Only used from the event loop, so it needs no lock.
+  """
+
+  def __init__(self, size: int = PRINCIPAL_CACHE_SIZE, ttl: int = PRINCIPAL_TTL_SECONDS) -> None:
+    self.size = size
+    self.ttl = ttl
+    self.entries: "OrderedDict[str, Tuple[Accounts, float]]" = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evicted = 0
+
+  def get(self, token: str) -> Optional[Accounts]:
+    entry = self.entries.get(token)
+    if entry is None or entry[1] <= time.time():
+      if entry is not None:
+        del self.entries[token]
+      self.misses += 1
+      return None
+    self.entries.move_to_end(token)
+    self.hits += 1
+    return entry[0]
+
+  def put(self, token: str, user: Accounts, token_expires: Optional[float]) -> None:
+    """Cache the account a verified token resolved to; token_expires is its exp claim."""
+    expires = time.time() + self.ttl
+    if token_expires is not None:
+      expires = min(expires, token_expires)
+    self.entries[token] = (user, expires)
+    self.entries.move_to_end(token)
+    while len(self.entries) > self.size:
+      self.entries.popitem(last=False)
+      self.evicted += 1
+
+  def clear(self) -> None:
+    self.entries.clear()
+
+  def stats(self) -> dict:
+    lookups = self.hits + self.misses
+    return {
+      "entries": len(self.entries),
+      "size": self.size,
+      "ttl_seconds": self.ttl,
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_ratio": self.hits / lookups if lookups else None,
+      "evicted": self.evicted,
+    }
+
+
+principal_cache = PrincipalCache()
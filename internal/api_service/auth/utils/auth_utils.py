@@ -1,11 +1,101 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 from bcrypt import checkpw, hashpw, gensalt
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+# bcrypt releases the GIL while it hashes, so a few threads verify logins
+# in parallel without stalling the event loop
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(min(4, os.cpu_count() or 2))))
+# hashes allowed to wait for a worker; past that a login is refused rather
+# than queued behind seconds of work
+MAX_HASH_QUEUE = int(os.getenv("MAX_HASH_QUEUE", str(64 * HASH_WORKERS)))
+
+hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+_slots = asyncio.Semaphore(HASH_WORKERS)
+
+
+class HashPoolBusy(Exception):
+  pass
+
+
+class HashPoolStats:
+  """Queue depth and timings of the hashing pool, for the event loop's eyes only."""
+
+  def __init__(self) -> None:
+    self.queued = 0
+    self.running = 0
+    self.peak_queued = 0
+    self.completed = 0
+    self.rejected = 0
+    self.wait_seconds = 0.0
+    self.hash_seconds = 0.0
+
+  def as_dict(self) -> dict:
+    return {
+      "workers": HASH_WORKERS,
+      "max_queue": MAX_HASH_QUEUE,
+      "queued": self.queued,
+      "running": self.running,
+      "peak_queued": self.peak_queued,
+      "completed": self.completed,
+      "rejected": self.rejected,
+      "mean_wait_ms": 1000 * self.wait_seconds / self.completed if self.completed else None,
+      "mean_hash_ms": 1000 * self.hash_seconds / self.completed if self.completed else None,
+    }
+
+
+hash_stats = HashPoolStats()
+
+
+def verify_password(plain_password: str, hashed_password: str | bytes) -> bool:
+  # ACCOUNTS.PSWRD_HASH is BYTEA, so the stored hash arrives as bytes
+  if isinstance(hashed_password, str):
+    hashed_password = hashed_password.encode("utf-8")
   try:
-    return checkpw(plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
+    return checkpw(plain_password.encode("utf-8"), bytes(hashed_password))
   except ValueError:
     return False
     
     
 def get_password_hash(plain_password: str) -> str:
   return hashpw(plain_password.encode("utf-8"), gensalt()).decode("utf-8")
+
+
+async def _run_hash(fn, *args):
+  """
+  Run a bcrypt call on the hashing pool. At most HASH_WORKERS run at once;
+  the rest wait here, where they are counted, and raise HashPoolBusy when
+  MAX_HASH_QUEUE are already waiting.
+  """
+  if hash_stats.queued >= MAX_HASH_QUEUE:
+    hash_stats.rejected += 1
+    raise HashPoolBusy("Too many logins in progress, try again shortly")
+  queued_at = time.perf_counter()
+  hash_stats.queued += 1
+  hash_stats.peak_queued = max(hash_stats.peak_queued, hash_stats.queued)
+  try:
+    await _slots.acquire()
+  finally:
+    hash_stats.queued -= 1
+  started = time.perf_counter()
+  hash_stats.running += 1
+  try:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(hash_executor, partial(fn, *args))
+  finally:
+    hash_stats.running -= 1
+    _slots.release()
+    hash_stats.completed += 1
+    hash_stats.wait_seconds += started - queued_at
+    hash_stats.hash_seconds += time.perf_counter() - started
+
+
+async def verify_password_async(plain_password: str, hashed_password: str | bytes) -> bool:
+  return await _run_hash(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(plain_password: str) -> str:
+  return await _run_hash(get_password_hash, plain_password)
@@ -0,0 +1,94 @@
+"""
+Serial vs concurrent S3 ingest for /user/new_accession.
+
+S3 is replaced by a fake client whose upload_fileobj blocks for a fixed
+round-trip latency plus size / bandwidth, which is what boto3 does from the
+caller's point of view. While a series is "landing", a probe coroutine plays
+the role of /user/sessions and records how long it waits for the event loop.
+
+  python benchmarks/bench_concurrent_upload.py --slices 300 --latency-ms 20
+"""
+import argparse
+import asyncio
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from users.services.upload_service import upload_files  # noqa: E402
+
+
+class FakeS3:
+  def __init__(self, latency_s: float, bandwidth_bps: float):
+    self.latency_s = latency_s
+    self.bandwidth_bps = bandwidth_bps
+
+  def upload_fileobj(self, fileobj, bucket, key, Config=None):
+    size = len(fileobj.read())
+    time.sleep(self.latency_s + size / self.bandwidth_bps)
+
+  def head_object(self, Bucket, Key):
+    time.sleep(self.latency_s)
+    raise KeyError(Key)
+
+
+async def serial_ingest(client, files):
+  # the loop create_accession used to run: blocking boto3 call per file
+  for filename, fileobj in files:
+    client.upload_fileobj(fileobj, "bucket", f"/Dicoms/1/{filename}")
+
+
+async def concurrent_ingest(client, files):
+  outcomes = await upload_files(client, "bucket", files)
+  assert all(outcome.status == "uploaded" for outcome in outcomes)
+
+
+async def probe(stop: asyncio.Event, waits: list, interval_s: float = 0.005):
+  # stands in for /user/sessions requests hitting the same worker
+  while not stop.is_set():
+    start = time.perf_counter()
+    await asyncio.sleep(interval_s)
+    waits.append(time.perf_counter() - start - interval_s)
+
+
+async def run(name, ingest, client, n_slices, slice_bytes):
+  files = [(f"{i}.dcm", io.BytesIO(os.urandom(slice_bytes))) for i in range(n_slices)]
+  stop = asyncio.Event()
+  waits: list = []
+  probe_task = asyncio.create_task(probe(stop, waits))
+  await asyncio.sleep(0.05)
+  start = time.perf_counter()
+  await ingest(client, files)
+  elapsed = time.perf_counter() - start
+  stop.set()
+  await probe_task
+  waits = waits or [elapsed]
+  mb = n_slices * slice_bytes / 1e6
+  print(
+    f"{name:<11} {elapsed:8.2f} s {n_slices / elapsed:9.1f} files/s {mb / elapsed:8.1f} MB/s"
+    f"   probe wait p50 {statistics.median(waits) * 1000:7.1f} ms  max {max(waits) * 1000:8.1f} ms"
+  )
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--slices", type=int, default=300)
+  parser.add_argument("--slice-kb", type=int, default=513)
+  parser.add_argument("--latency-ms", type=float, default=20.0)
+  parser.add_argument("--bandwidth-mbps", type=float, default=400.0, help="per connection, megabits/s")
+  args = parser.parse_args()
+
+  client = FakeS3(args.latency_ms / 1000, args.bandwidth_mbps * 1e6 / 8)
+  print(
+    f"{args.slices} slices x {args.slice_kb} KiB, {args.latency_ms:.0f} ms/PUT, "
+    f"{args.bandwidth_mbps:.0f} Mbit/s per connection"
+  )
+  asyncio.run(run("serial", serial_ingest, client, args.slices, args.slice_kb * 1024))
+  asyncio.run(run("concurrent", concurrent_ingest, client, args.slices, args.slice_kb * 1024))
+
+
+if __name__ == "__main__":
+  main()
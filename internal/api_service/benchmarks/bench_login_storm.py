@@ -0,0 +1,85 @@
+"""
+Inline vs pooled bcrypt verification during a login storm.
+
+A burst of logins verifies real bcrypt hashes, either in the handler the
+way authenticate_user used to (blocking the event loop) or through
+verify_password_async. Meanwhile a probe coroutine plays the role of an
+authenticated read such as /user/sessions and records how long it waits
+for the event loop.
+
+  python benchmarks/bench_login_storm.py --logins 40 --rounds 12
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bcrypt  # noqa: E402
+
+from auth.utils.auth_utils import HASH_WORKERS, hash_stats, verify_password, verify_password_async  # noqa: E402
+
+
+async def inline_login(password: str, hashed: str) -> bool:
+  return verify_password(password, hashed)
+
+
+async def pooled_login(password: str, hashed: str) -> bool:
+  return await verify_password_async(password, hashed)
+
+
+async def probe(stop: asyncio.Event, waits: list, interval_s: float = 0.005):
+  # stands in for authenticated reads hitting the same worker
+  while not stop.is_set():
+    start = time.perf_counter()
+    await asyncio.sleep(interval_s)
+    waits.append(time.perf_counter() - start - interval_s)
+
+
+async def run(name, login, n_logins, password, hashed):
+  stop = asyncio.Event()
+  waits: list = []
+  probe_task = asyncio.create_task(probe(stop, waits))
+  await asyncio.sleep(0.05)
+  start = time.perf_counter()
+  results = await asyncio.gather(*(login(password, hashed) for _ in range(n_logins)))
+  elapsed = time.perf_counter() - start
+  stop.set()
+  await probe_task
+  assert all(results)
+  waits = waits or [elapsed]
+  print(
+    f"{name:<7} {elapsed:8.2f} s {n_logins / elapsed:8.1f} logins/s"
+    f"   probe wait p50 {statistics.median(waits) * 1000:7.1f} ms"
+    f"  max {max(waits) * 1000:8.1f} ms"
+  )
+
+
+async def storm(n_logins, rounds):
+  password = "correct horse battery staple"
+  hashed = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+  start = time.perf_counter()
+  verify_password(password, hashed)
+  print(
+    f"{n_logins} logins, bcrypt cost {rounds} ({(time.perf_counter() - start) * 1000:.0f} ms per check), "
+    f"{HASH_WORKERS} hashing workers"
+  )
+  await run("inline", inline_login, n_logins, password, hashed)
+  await run("pooled", pooled_login, n_logins, password, hashed)
+  stats = hash_stats.as_dict()
+  print(f"pool: peak queue {stats['peak_queued']}, mean wait {stats['mean_wait_ms']:.0f} ms")
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--logins", type=int, default=40)
+  parser.add_argument("--rounds", type=int, default=12)
+  args = parser.parse_args()
+  asyncio.run(storm(args.logins, args.rounds))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,123 @@
+"""
+Serialization time and bytes on the wire of a get-session manifest.
+
+Builds a 500-file accession (3 previews per file, presigned URLs of
+realistic length) and encodes it the way get-session used to (a model per
+row, then jsonable_encoder and json.dumps) and the way it does now (plain
+dicts validated once by the response model, then orjson or msgpack), and
+compresses each body with gzip and brotli.
+
+  python benchmarks/bench_manifest_encoding.py --files 500
+"""
+import argparse
+import gzip
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import brotli  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+from starlette.responses import JSONResponse  # noqa: E402
+
+from db_service.models.py_models import FileResponse, PreviewResponse, ReadAccession  # noqa: E402
+from users.services.response_service import (  # noqa: E402
+  BROTLI_QUALITY, GZIP_LEVEL, JSON, MSGPACK, encode
+)
+
+LEVELS = (("thumb", 64), ("128", 128), ("256", 256))
+
+
+def presigned(key: str, i: int) -> str:
+  # the shape of a SigV4 GET URL for a content-addressed key
+  return (
+    f"https://xray-dicoms.s3.amazonaws.com{key}?X-Amz-Algorithm=AWS4-HMAC-SHA256"
+    f"&X-Amz-Credential=AKIAEXAMPLE{i:08d}%2F20261017%2Fus-east-1%2Fs3%2Faws4_request"
+    f"&X-Amz-Date=20261017T091244Z&X-Amz-Expires=3600&X-Amz-SignedHeaders=host"
+    f"&X-Amz-Signature={os.urandom(32).hex()}"
+  )
+
+
+def manifest(n_files: int) -> dict:
+  files = []
+  for i in range(n_files):
+    key = f"/Dicoms/sha256/{os.urandom(32).hex()}"
+    files.append({
+      "type": "mask" if i == n_files - 1 else "slice",
+      "object_key": key,
+      "s3_url": presigned(key, i),
+      "previews": [
+        {
+          "level": level,
+          "content_type": "image/jpeg",
+          "width": side,
+          "height": side,
+          "size": side * side // 12,
+          "s3_url": presigned(f"{key}.{level}.jpg", i),
+        }
+        for level, side in LEVELS
+      ],
+    })
+  return {
+    "aid": 1, "created_at": datetime(2026, 10, 17, 9, 12, 44), "dicom_name": "Chest CT",
+    "dicom_id": 42, "agaston_score": 112, "files": files,
+  }
+
+
+def before(data: dict) -> bytes:
+  accession = ReadAccession(
+    **{key: value for key, value in data.items() if key != "files"},
+    files=[
+      FileResponse(**{**file, "previews": [PreviewResponse(**preview) for preview in file["previews"]]})
+      for file in data["files"]
+    ],
+  )
+  return JSONResponse(jsonable_encoder(accession)).body
+
+
+adapter = TypeAdapter(ReadAccession)
+
+
+def after(data: dict, media_type: str) -> bytes:
+  return encode(adapter.dump_python(adapter.validate_python(data), mode="json"), media_type)
+
+
+def timed(fn, *args, repeat: int):
+  best = float("inf")
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = fn(*args)
+    best = min(best, time.perf_counter() - start)
+  return result, best
+
+
+def report(name: str, body: bytes, seconds: float, repeat: int):
+  line = f"{name:<22} {seconds * 1000:8.2f} ms {len(body) / 1024:9.1f} KiB"
+  packed, gz_s = timed(gzip.compress, body, GZIP_LEVEL, repeat=repeat)
+  line += f"   gzip {len(packed) / 1024:7.1f} KiB {gz_s * 1000:6.2f} ms"
+  packed, br_s = timed(brotli.compress, body, 0, BROTLI_QUALITY, repeat=repeat)
+  line += f"   br {len(packed) / 1024:7.1f} KiB {br_s * 1000:6.2f} ms"
+  print(line)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--files", type=int, default=500)
+  parser.add_argument("--repeat", type=int, default=20)
+  args = parser.parse_args()
+
+  data = manifest(args.files)
+  print(f"{args.files} files, 3 previews each; best of {args.repeat}")
+  body, seconds = timed(before, data, repeat=args.repeat)
+  report("models + json.dumps", body, seconds, args.repeat)
+  body, seconds = timed(after, data, JSON, repeat=args.repeat)
+  report("validate once + orjson", body, seconds, args.repeat)
+  body, seconds = timed(after, data, MSGPACK, repeat=args.repeat)
+  report("validate once + msgpack", body, seconds, args.repeat)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,111 @@
+-- Accession read path at 1M files: listing and get-session queries, before
+-- and after the accession_read_path migration (b4e9d2a61c58).
+--
+-- Seeds 10 000 patients x 10 accessions x 10 files (9 slices, 1 mask) into
+-- an empty scratch database, then prints EXPLAIN ANALYZE of each query.
+-- Run it once at f2a7c4d19e36, then `alembic upgrade head` and run it again
+-- (the seed is skipped when data is there):
+--
+--   psql -v patient=4242 -f benchmarks/bench_read_path.sql scratch_db
+--
+-- Before: the listing runs the plpgsql get_dicoms_by_aid, which cannot be
+-- inlined and reads every file row of the patient through the five-table
+-- view, then de-duplicates; "which accessions hold this file" and "who owns
+-- this accession" scan their link tables. After: the listing reads the
+-- patient's ACCESSIONSUMMARY rows through ACCESSIONSUMMARY_PATIENT_IDX,
+-- get_accession is inlined into the caller, and both link lookups are
+-- index scans. The write is timed both ways: after the migration its
+-- trigger lines show what keeping ACCESSIONSUMMARY current costs.
+--
+-- Measured on PostgreSQL 16.2 (shared_buffers 256MB, warm cache), patient
+-- 4242, execution time of three runs each:
+--
+--   query                          before (f2a7c4d19e36)    after (b4e9d2a61c58)
+--   listing (get_dicoms_by_aid)    2.5 / 6.6 / 2.1 ms       0.08 / 0.08 / 0.09 ms
+--   accession files                0.68 / 0.68 / 0.45 ms    0.13 / 0.08 / 0.08 ms
+--   accessions holding a file      125 / 127 / 110 ms       0.04 / 0.02 / 0.03 ms
+--   owner of an accession          14 / 16 / 11 ms          0.02 / 0.01 / 0.02 ms
+--   first page of /user/sessions   -                        0.08 / 0.08 / 0.20 ms
+--   500-slice accession write      63 / 48 / 36 ms          68 / 62 / 60 ms
+--
+-- The write pays for the two summary triggers, 12 to 16 ms per 500-slice
+-- accession (DICOMFILES 7.4 to 7.9 ms, PATIENTDICOMS 4.6 to 8.5 ms), plus
+-- the upkeep of the two new indexes. The migration itself took 10.3 s on
+-- the 1M-file seed, almost all of it the ACCESSIONSUMMARY backfill; the
+-- indexes took 0.7 s and 0.1 s.
+
+\set ON_ERROR_STOP on
+\if :{?patient}
+\else
+  \set patient 4242
+\endif
+
+SELECT NOT EXISTS (SELECT 1 FROM DICOMFILES) AS needs_seed \gset
+\if :needs_seed
+BEGIN;
+INSERT INTO ACCOUNTS (USERNAME, EMAIL, FNAME, LNAME, PSWRD_HASH, DOB)
+SELECT 'bench_' || i, 'bench_' || i || '@example.com', 'First' || i, 'Last' || i,
+  decode(md5(i::text), 'hex'), DATE '1970-01-01' + i % 15000
+FROM generate_series(1, 10000) AS i;
+INSERT INTO PATIENTS (AID, MRN) SELECT AID, 1000000 + AID FROM ACCOUNTS WHERE USERNAME LIKE 'bench\_%';
+INSERT INTO PATIENT_STATS (AGASTON_SCORE) SELECT (random() * 1000)::INT FROM generate_series(1, 100000);
+INSERT INTO DICOMS (DICOM_NAME, STAT_ID, CREATED_AT)
+SELECT 'Accession ' || i, i, TIMESTAMP '2020-01-01' + i * INTERVAL '17 minutes'
+FROM generate_series(1, 100000) AS i;
+INSERT INTO PATIENTDICOMS (PATIENT_ID, DICOM_ID)
+SELECT p.AID, d.DICOM_ID
+FROM (SELECT AID, row_number() OVER (ORDER BY AID) AS n FROM PATIENTS) p
+JOIN DICOMS d ON (d.DICOM_ID - 1) % 10000 + 1 = p.n;
+INSERT INTO FILERECORDS (FILETYPE, OBJECT_KEY, CONTENT_HASH)
+SELECT CASE WHEN i % 10 = 0 THEN 'mask' ELSE 'slice' END,
+  '/Dicoms/sha256/' || encode(sha256(i::text::bytea), 'hex'), encode(sha256(i::text::bytea), 'hex')
+FROM generate_series(1, 1000000) AS i;
+INSERT INTO DICOMFILES (DICOM_ID, FILE_ID)
+SELECT (FILE_ID - 1) / 10 + 1, FILE_ID FROM FILERECORDS;
+COMMIT;
+\endif
+ANALYZE;
+
+SELECT to_regclass('accessionsummary') IS NOT NULL AS has_summary \gset
+SELECT pd.DICOM_ID AS dicom FROM PATIENTDICOMS pd WHERE pd.PATIENT_ID = :patient LIMIT 1 \gset
+SELECT df.FILE_ID AS file FROM DICOMFILES df WHERE df.DICOM_ID = :dicom LIMIT 1 \gset
+
+\echo '== listing, as /user/sessions used to run it'
+EXPLAIN (ANALYZE, BUFFERS) SELECT DISTINCT * FROM get_dicoms_by_aid(:patient);
+
+\echo '== accession files, as /user/get-session runs it'
+EXPLAIN (ANALYZE, BUFFERS) SELECT * FROM get_accession(:patient, :dicom);
+
+\echo '== accessions holding a file (release, reference checks)'
+EXPLAIN (ANALYZE, BUFFERS) SELECT DICOM_ID FROM DICOMFILES WHERE FILE_ID = :file;
+
+\echo '== owner of an accession'
+EXPLAIN (ANALYZE, BUFFERS) SELECT PATIENT_ID FROM PATIENTDICOMS WHERE DICOM_ID = :dicom;
+
+\echo '== writing a 500-slice accession the way insert_accession does (rolled back)'
+BEGIN;
+EXPLAIN (ANALYZE, BUFFERS)
+WITH new_stat AS (
+  INSERT INTO PATIENT_STATS (AGASTON_SCORE) VALUES (0) RETURNING STAT_ID
+), new_dicom AS (
+  INSERT INTO DICOMS (DICOM_NAME, STAT_ID) SELECT 'bench write', STAT_ID FROM new_stat RETURNING DICOM_ID
+), new_files AS (
+  INSERT INTO FILERECORDS (FILETYPE, OBJECT_KEY, CONTENT_HASH)
+  SELECT 'slice', '/Dicoms/sha256/' || h, h
+  FROM (SELECT encode(sha256(('write' || i)::bytea), 'hex') AS h FROM generate_series(1, 500) AS i) hashes
+  RETURNING FILE_ID
+), dicom_files AS (
+  INSERT INTO DICOMFILES (DICOM_ID, FILE_ID) SELECT d.DICOM_ID, f.FILE_ID FROM new_dicom d CROSS JOIN new_files f
+)
+INSERT INTO PATIENTDICOMS (PATIENT_ID, DICOM_ID) SELECT :patient, DICOM_ID FROM new_dicom;
+ROLLBACK;
+
+\if :has_summary
+\echo '== first page of /user/sessions'
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT s.DICOM_ID, s.DICOM_NAME, s.CREATED_AT, s.AGASTON_SCORE, s.SLICES, s.MASKS
+FROM ACCESSIONSUMMARY s
+WHERE s.PATIENT_ID = :patient
+ORDER BY s.CREATED_AT DESC, s.DICOM_ID DESC
+LIMIT 101;
+\endif
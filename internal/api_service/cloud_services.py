@@ -1,18 +1,48 @@
+import asyncio
 import boto3, os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 from fastapi import Request
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_REGION = os.getenv("AWS_REGION", "us-east-2")
 BUCKET_NAME = os.getenv("BUCKET_NAME", "pulseimaging-files")
 
+# max number of S3 transfers a single API worker runs at once
+S3_MAX_CONCURRENCY = int(os.getenv("S3_MAX_CONCURRENCY", "16"))
+MB = 1024 * 1024
+
+# large objects (multi-frame series, archives) are split into parallel
+# multipart uploads, single slices go up with one PUT
+transfer_config = TransferConfig(
+  multipart_threshold=8 * MB,
+  multipart_chunksize=8 * MB,
+  max_concurrency=4,
+  use_threads=True,
+)
+
 client = boto3.client(
   "s3",
   aws_access_key_id=AWS_ACCESS_KEY_ID,
   aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
   region_name=AWS_REGION,
+  config=Config(max_pool_connections=S3_MAX_CONCURRENCY * transfer_config.max_request_concurrency),
 )
 bucket_name = BUCKET_NAME
 
+# boto3 is blocking, so every S3 call made from a request handler runs here
+# instead of on the event loop
+s3_executor = ThreadPoolExecutor(max_workers=S3_MAX_CONCURRENCY, thread_name_prefix="s3")
+
+
+async def run_s3(fn, *args, **kwargs):
+  """Run a blocking boto3 call on the S3 thread pool."""
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(s3_executor, partial(fn, *args, **kwargs))
+
+
 def get_s3(request: Request):
   return client, bucket_name
-  
\ No newline at end of file
+
@@ -1,5 +1,5 @@
-from typing import Optional, List
-from datetime import datetime
+from typing import Dict, Optional, List
+from datetime import date, datetime
 from pydantic import BaseModel
 
 class BaseFile(BaseModel):
@@ -11,8 +11,28 @@ class UploadNewFile(BaseModel):
   type: str = "slice"
   s3_url: Optional[str] = ""
     
+class PreviewResponse(BaseModel):
+  level: str  # thumb | 128 | 256
+  content_type: str
+  width: int
+  height: int
+  size: int
+  s3_url: Optional[str] = None
+
 class FileResponse(BaseFile):
   s3_url: Optional[str]   
+  previews: List[PreviewResponse] = []
+
+class FileUploadOutcome(BaseModel):
+  filename: str
+  object_key: str
+  filetype: str = "slice"
+  status: str = "pending"  # pending | uploaded | failed
+  size: int = 0
+  error: Optional[str] = None
+  content_hash: Optional[str] = None
+  deduplicated: bool = False  # nothing was sent to S3; reported only for content the caller already owned
+  file_id: Optional[int] = None
 
     
 class BaseAccession(BaseModel):
@@ -28,13 +48,191 @@ class ReadAccession(BaseAccession):
 class DBAccession(BaseAccession):
   dicom_id: int = -1
   created_at:datetime
-  agaston_score: int
+  agaston_score: Optional[int]
+  slices: Optional[int] = None
+  masks: Optional[int] = None
   
+class RejectedFile(BaseModel):
+  filename: str
+  reason: str
+
 class WriteAccession(BaseAccession):
   agaston_score: int = -1
   files: List[UploadNewFile]
+  uploads: List[FileUploadOutcome] = []
+  rejected: List[RejectedFile] = []  # archive members that were not ingested
   
+class FileChange(BaseModel):
+  op: str  # add | replace | remove
+  filetype: Optional[str] = None  # slice | mask; add defaults to slice, replace keeps the old file's
+  filename: Optional[str] = None  # file part holding the new content, for add / replace
+  object_key: Optional[str] = None  # stored file to replace / remove
+  sha256: Optional[str] = None  # its stored content; checked against object_key when both are set
+
 class UpdateAccession(BaseModel):
   dicom_id: int = -1
+  dicom_name: Optional[str] = None  # renames the accession when set
+  changes: List[FileChange] = []
+
+class UpdatedAccession(BaseModel):
+  dicom_id: int
   dicom_name: str
-  files: List[BaseFile]
\ No newline at end of file
+  added: List[FileUploadOutcome] = []
+  removed: List[str] = []  # object keys unlinked from the accession
+  unchanged: List[FileUploadOutcome] = []  # content the accession already held
+
+class CreateUpload(BaseModel):
+  filename: str
+  size: int
+  filetype: str = "slice"
+  chunk_size: Optional[int] = None
+
+class UploadStatus(BaseModel):
+  upload_id: str
+  filename: str
+  filetype: str
+  object_key: str
+  size: int
+  chunk_size: int
+  total_chunks: int
+  status: str
+  received_chunks: List[int] = []
+  received_bytes: int = 0
+  missing_chunks: List[int] = []
+
+class ChunkReceipt(BaseModel):
+  upload_id: str
+  chunk: int
+  size: int
+  etag: str
+
+class FinalizeUploads(BaseAccession):
+  agaston_score: int = -1
+  upload_ids: List[str]
+
+class PresignFile(BaseModel):
+  filename: str
+  filetype: str = "slice"
+  sha256: Optional[str] = None  # hex digest, enables deduplication
+
+class PresignRequest(BaseModel):
+  files: List[PresignFile]
+
+class DirectUploadFile(BaseModel):
+  filename: str
+  filetype: str = "slice"
+  object_key: str
+
+class PresignedUpload(DirectUploadFile):
+  url: str = ""
+  method: str = "PUT"
+  headers: Dict[str, str] = {}
+  exists: bool = False  # the caller already holds this content, skip the PUT
+
+class PresignResponse(BaseModel):
+  expires_in: int
+  files: List[PresignedUpload]
+
+class FinalizeDirectUpload(BaseAccession):
+  agaston_score: int = -1
+  files: List[DirectUploadFile]
+
+class DicomInstance(BaseModel):
+  dicom_id: int
+  file_id: int
+  filetype: str
+  object_key: str
+  sop_instance_uid: Optional[str] = None
+  study_instance_uid: Optional[str] = None
+  series_instance_uid: Optional[str] = None
+  modality: Optional[str] = None
+  study_date: Optional[date] = None
+  series_description: Optional[str] = None
+  series_number: Optional[int] = None
+  instance_number: Optional[int] = None
+  slice_location: Optional[float] = None
+  image_position: Optional[List[float]] = None
+  pixel_spacing: Optional[List[float]] = None
+  slice_thickness: Optional[float] = None
+  rows: Optional[int] = None
+  columns: Optional[int] = None
+  transfer_syntax_uid: Optional[str] = None
+
+class DicomSeries(BaseModel):
+  study_instance_uid: Optional[str] = None
+  series_instance_uid: Optional[str] = None
+  modality: Optional[str] = None
+  series_number: Optional[int] = None
+  series_description: Optional[str] = None
+  number_of_instances: int
+  dicom_ids: List[int]
+
+class DicomStudy(BaseModel):
+  study_instance_uid: Optional[str] = None
+  study_date: Optional[date] = None
+  modalities: List[str] = []
+  number_of_series: int
+  number_of_instances: int
+  dicom_ids: List[int]
+
+class SeriesVolume(BaseModel):
+  dicom_id: int
+  series_instance_uid: str
+  slices: int
+  rows: int
+  columns: int
+  dtype: str  # numpy dtype string, e.g. <i2
+  data_offset: int
+  slice_bytes: int
+  size: int
+  header: dict  # spacing, per-slice rescale and positions, slice offsets
+  s3_url: Optional[str] = None  # accepts Range requests
+
+class SeriesCompression(BaseModel):
+  series_instance_uid: Optional[str] = None
+  stored_syntax: str
+  files: int
+  original_bytes: int
+  stored_bytes: int
+  compression_ratio: Optional[float] = None
+  mean_encode_ms: Optional[float] = None
+  mean_original_decode_ms: Optional[float] = None
+  mean_stored_decode_ms: Optional[float] = None
+  originals_kept: int = 0
+
+class SliceIntensity(BaseModel):
+  file_id: int
+  object_key: str
+  instance_number: Optional[int] = None
+  hu_min: float
+  hu_max: float
+  hu_mean: Optional[float] = None
+  voxels: int
+  calcium_voxels: int
+  histogram: List[int]
+
+class SeriesIntensity(BaseModel):
+  series_instance_uid: str
+  modality: Optional[str] = None
+  slices: int
+  hu_min: float
+  hu_max: float
+  hu_mean: Optional[float] = None
+  voxels: int
+  calcium_voxels: int  # voxels at or above calcium_threshold
+  calcium_volume_mm3: Optional[float] = None
+  calcium_threshold: int
+  histogram_min: int  # lower edge of the first bin
+  bin_width: int
+  histogram: List[int]
+  per_slice: List[SliceIntensity] = []
+
+class PresignCacheStats(BaseModel):
+  entries: int
+  size: int
+  ttl_seconds: int  # a URL is reissued this long after signing
+  hits: int
+  misses: int
+  hit_ratio: Optional[float] = None
+  expired: int
+  evicted: int
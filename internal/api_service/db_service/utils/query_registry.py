@@ -0,0 +1,88 @@
+import os
+import time
+from typing import Dict, List, NamedTuple, Type
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# prepared statements asyncpg keeps per connection; registered queries have
+# fixed SQL, so after a connection's first call they are bind and execute only
+STATEMENT_CACHE_SIZE = int(os.getenv("STATEMENT_CACHE_SIZE", "500"))
+
+
+class QueryStats:
+  def __init__(self) -> None:
+    self.calls = 0
+    self.rows = 0
+    self.total_seconds = 0.0
+    self.max_seconds = 0.0
+
+  def add(self, seconds: float, rows: int) -> None:
+    self.calls += 1
+    self.rows += rows
+    self.total_seconds += seconds
+    self.max_seconds = max(self.max_seconds, seconds)
+
+
+class Query:
+  """
+  A named read query with fixed SQL and the NamedTuple its rows decode to.
+  The row type's fields must match the selected columns in order; this is
+  checked on the first call.
+  """
+
+  def __init__(self, name: str, sql: str, row: Type[NamedTuple]) -> None:
+    self.name = name
+    self.statement = text(sql)
+    self.row = row
+    self.stats = QueryStats()
+    self.checked = False
+
+
+REGISTRY: Dict[str, Query] = {}
+
+
+def register(name: str, sql: str, row: Type[NamedTuple]) -> Query:
+  if name in REGISTRY:
+    raise ValueError(f"Query {name!r} is already registered")
+  query = Query(name, sql, row)
+  REGISTRY[name] = query
+  return query
+
+
+async def fetch(session: AsyncSession, query: Query, **params) -> list:
+  """
+  Run a registered query and decode its rows straight into query.row
+  tuples, skipping mappings and model validation; validate at the
+  response boundary instead.
+  """
+  start = time.perf_counter()
+  result = await session.execute(query.statement, params)
+  if not query.checked:
+    columns = tuple(key.lower() for key in result.keys())
+    if columns != query.row._fields:
+      raise RuntimeError(f"Query {query.name!r} returns {columns}, {query.row.__name__} expects {query.row._fields}")
+    query.checked = True
+  make = query.row._make
+  rows = [make(row) for row in result.all()]
+  query.stats.add(time.perf_counter() - start, len(rows))
+  return rows
+
+
+def query_stats() -> List[dict]:
+  """Call counts and timings of every registered query in this worker, slowest total first."""
+  return sorted(
+    (
+      {
+        "name": query.name,
+        "calls": query.stats.calls,
+        "rows": query.stats.rows,
+        "total_ms": 1000 * query.stats.total_seconds,
+        "mean_ms": 1000 * query.stats.total_seconds / query.stats.calls if query.stats.calls else None,
+        "max_ms": 1000 * query.stats.max_seconds,
+      }
+      for query in REGISTRY.values()
+    ),
+    key=lambda stats: stats["total_ms"],
+    reverse=True,
+  )
@@ -1,12 +1,17 @@
 from cloud_services import *
+from workers import cpu_executor
+from auth.utils.auth_utils import hash_executor
 from fastapi import FastAPI, Request,Depends
 from contextlib import asynccontextmanager
 from sqlmodel import SQLModel
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+import asyncio
 import os
 
 from auth.routes.auth_router import auth_router
 from users.routes.user_router import user_router
+from users.services.outbox_service import RECONCILE, run_reconciler
+from db_service.utils.query_registry import STATEMENT_CACHE_SIZE
 
 db_conn_string = (
   "postgresql+asyncpg://"
@@ -25,7 +30,8 @@ async def lifespan(app: FastAPI):
     echo=True,
     pool_pre_ping=True,
     pool_recycle=3600,
-    future=True
+    future=True,
+    connect_args={"prepared_statement_cache_size": STATEMENT_CACHE_SIZE},
   )
   session_maker = async_sessionmaker(
     bind=engine,
@@ -44,11 +50,18 @@ async def lifespan(app: FastAPI):
   app.state.sessionmaker = session_maker
   app.state.s3_client = client
   app.state.s3_bucket_name = bucket_name
+  # drains the storage outbox: unfinished derivatives, deferred deletes, the orphan sweep
+  reconciler = asyncio.create_task(run_reconciler(session_maker, client, bucket_name)) if RECONCILE else None
   
   try:
     yield
   finally:
+    if reconciler is not None:
+      reconciler.cancel()
     await engine.dispose()
+    s3_executor.shutdown(wait=False)
+    cpu_executor.shutdown(wait=False, cancel_futures=True)
+    hash_executor.shutdown(wait=False, cancel_futures=True)
     
     
 
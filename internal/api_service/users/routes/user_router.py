@@ -1,9 +1,12 @@
+from datetime import datetime
 from sqlalchemy import text
 from cloud_services import get_s3
-from typing_extensions import Annotated, List
-from fastapi import APIRouter, Form, UploadFile, File, Depends, HTTPException, status
+from typing_extensions import Annotated, List, Optional, Tuple
+from fastapi import APIRouter, BackgroundTasks, Form, UploadFile, File, Depends, Header, HTTPException, Request, status
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from botocore.exceptions import BotoCoreError, ClientError
+import asyncio
 import secrets, base64
 
 from auth.models.token import Token
@@ -11,110 +14,296 @@ from auth.services.auth_service import *
 from db_service.utils.db_utils import *
 from db_service.models.py_models import *
 from db_service.models.models import *
-from users.services.stream_service import StreamWrapper
-
-URL_EXPIRATION_TIME=3600
-
-def get_temp_url(client, bucket, key):
-  try:
-    response = client.generate_presigned_url(
-        ClientMethod='get_object',
-        Params={'Bucket': bucket, 'Key':key},
-        ExpiresIn=URL_EXPIRATION_TIME
-      )
-    return response
-  except Exception as e:
-    print(f"{e}")
+from db_service.utils.query_registry import query_stats
+from users.services.stream_service import stream_multipart_to_s3
+from users.services.archive_service import ArchiveError, expand_archive, member_filename
+from users.services.upload_service import (
+  upload_files, delete_objects, make_object_key, owner_prefix, reported_outcomes, stored_content, uploaded_here,
+  CONTENT_PREFIX, hash_from_key
+)
+from users.services.response_service import FastResponse, NegotiatedRoute
+from users.services.url_service import presigned_url, presigned_urls, url_cache
+from users.services.presign_service import presign_uploads, verify_uploads, normalize_hashes, UPLOAD_URL_EXPIRATION_TIME
+from users.services.accession_service import (
+  accession_files, insert_accession, known_content, list_accessions, owned_content, SESSIONS_PAGE_SIZE
+)
+from users.services.dicom_service import load_headers, read_head
+from users.services.update_service import (
+  ChangeConflict, ChangeError, apply_changes, drop_stale_volumes, lock_accession, plan_changes, resolve_changes
+)
+from users.services.derivative_service import previews_for_accession
+from users.services.outbox_service import LEASE_SECONDS, derivative_files, discard_objects, enqueue, run_derivatives
+from users.services.export_service import archive_name, export_files, stream_zip
+from users.services.transcode_service import compression_by_series
+from users.services.intensity_service import (
+  BIN_WIDTH, CALCIUM_THRESHOLD, HISTOGRAM_MIN, series_intensities, slice_intensities
+)
+from users.services.mask_service import CONTENT_TYPE as MASK_CONTENT_TYPE, get_mask_stack, read_mask_stack
+from users.services.volume_service import SlabTooLarge, VolumeError, slab_range, slab_stop, stream_slab, volumes_for_accession
+from users.services.index_service import insert_headers, search_instances, search_series, search_studies, MAX_LIMIT
+from users.services.wado_service import (
+  FrameError, CACHE_CONTROL, CACHE_REVALIDATE, MAX_RETRIEVE_INSTANCES, accepts, content_type, etag, fetch_frames, frames_body, new_boundary,
+  not_modified, parse_frame_list, stream_instances
+)
+from users.services.idempotency_service import (
+  IdempotencyError, StillInProgress, request_fingerprint, claim_key, wait_for_result, save_result, release_key
+)
+from users.services.resumable_service import (
+  UploadError, check_chunk, create_upload, get_upload, read_chunk, received_chunks, upload_chunk,
+  complete_upload, abort_upload, consume_uploads, to_status
+)
 
+# JSON via orjson or msgpack per Accept, large bodies compressed per Accept-Encoding
 user_router = APIRouter(
-  tags=["User"]
+  tags=["User"],
+  route_class=NegotiatedRoute,
+  default_response_class=FastResponse,
 )
 # @app.get("/dicoms/{aid}", dependencies=[Depends(get_current_active_user)], response_model=List[Record])
 @user_router.get("/sessions")
-async def get_dicoms_by_user(user = Depends(get_current_active_user), session: tuple = Depends(get_session)) -> List[DBAccession]:
+async def get_dicoms_by_user(
+  response: Response,
+  limit: int = SESSIONS_PAGE_SIZE,
+  cursor: Optional[str] = None,
+  created_from: Optional[datetime] = None,
+  created_to: Optional[datetime] = None,
+  name: Optional[str] = None,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session)) -> List[DBAccession]:
   """
-  Fetch all 'Accessions' by user
+  Fetch a page of the user's 'Accessions', newest first. created_from /
+  created_to bound the creation time (to is exclusive), name matches part
+  of the accession name. When more remain, the X-Next-Cursor header holds
+  the cursor of the next page.
   """
   aid = user.aid
-  result = await session.execute(
-    text("select distinct * from get_dicoms_by_aid(:aid_input)").bindparams(aid_input=aid)
-  )
-  return [
-    DBAccession(
-      aid=aid,
-      dicom_id=row["dicom_id"],
-      created_at=row["created_at"],
-      agaston_score=row["agaston_score"],
-      dicom_name=row["dicom_name"],
-    )
-    for row in result.mappings()
-  ]
+  try:
+    rows, next_cursor = await list_accessions(session, aid, limit, cursor, created_from, created_to, name)
+  except ValueError as e:
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+  if next_cursor is not None:
+    response.headers["X-Next-Cursor"] = next_cursor
+  # plain dicts: the response model validates each row once, on the way out
+  return [{"aid": aid, **row._asdict()} for row in rows]
 
 
-@user_router.get("get-session/{session_id}")
+@user_router.get("/get-session/{session_id}")
 async def get_data_by_session(
-  aid: int, 
   session_id: int, 
+  aid: Optional[int] = None, 
   user = Depends(get_current_active_user),
   session: AsyncSession = Depends(get_session), 
   data: tuple = Depends(get_s3),
-  ):
+  ) -> Optional[ReadAccession]:
   """
   Fetch all Coned CTs by Accession (currently called 'Dicoms')
   return (most importantly) 
   """
   client, bucket = data
   aid = user.aid
-  result = await session.execute(
-    text("select * from get_accession(:aid_input,:dicom_id_input)").bindparams(
-      aid_input=aid,dicom_id_input=session_id)
-  )
-  res = result.mappings().all()
-  files: List[FileResponse] = []
-  created_at = None
-  dicom_name = None
-  agaston_score = None
+  res = await accession_files(session, aid, session_id)
   if len(res) == 0:
     return None
-  for row in res:    
-    created_at = row["created_at"]
-    dicom_name = row["dicom_name"]
-    agaston_score = row["agaston_score"]
-    temp_url = get_temp_url(client,bucket,row["object_key"])
-    files.append(
-      FileResponse(
-        type=row["filetype"],
-        object_key=row["object_key"],
-        s3_url=temp_url 
-      )
-    )
-  accession = ReadAccession(
-    aid=aid,
-    created_at=created_at,
-    dicom_name=dicom_name,
-    dicom_id=session_id,
-    agaston_score=agaston_score,
-    files=files
-  )
-  return accession
+  previews = await previews_for_accession(session, session_id)
+  # the whole accession, files and previews, is signed in one batch
+  urls = await presigned_urls(client, bucket, [
+    *(row.object_key for row in res),
+    *(preview.object_key for rendered in previews.values() for preview in rendered),
+  ])
+  files = [
+    {
+      "type": row.filetype,
+      "object_key": row.object_key,
+      "s3_url": urls.get(row.object_key),
+      "previews": [
+        {
+          "level": preview.level,
+          "content_type": preview.content_type,
+          "width": preview.width,
+          "height": preview.height,
+          "size": preview.size_bytes,
+          "s3_url": urls.get(preview.object_key),
+        }
+        for preview in previews.get(row.object_key, ())
+      ],
+    }
+    for row in res
+  ]
+  last = res[-1]
+  return {
+    "aid": aid,
+    "created_at": last.created_at,
+    "dicom_name": last.dicom_name,
+    "dicom_id": session_id,
+    "agaston_score": last.agaston_score,
+    "files": files,
+  }
 
 # make new accession? 
   # upload new dicoms?
 
-async def add_record(record: any, session: AsyncSession) -> int:
-  session.add(record)
-  await session.flush()
-  await session.refresh(record)
-  return record
+async def commit_accession(
+  session: AsyncSession,
+  client,
+  bucket: str,
+  accession: WriteAccession,
+  outcomes: List[FileUploadOutcome],
+  claim: Optional[Tuple[str, str]] = None,
+  heads: Optional[List[Optional[bytes]]] = None,
+  headers: Optional[List[Optional[dict]]] = None,
+) -> Tuple[WriteAccession, int]:
+  """
+  Record a series whose files are already in S3, with their DICOM headers
+  indexed. `headers` are the parsed headers when the caller has them;
+  otherwise `heads` are the leading bytes of each file when the caller
+  still has them, and anything else is range-read back from S3.
+  Raises 502 with the per-file outcomes if any upload failed.
+  With an idempotency (key, claim token), the response is stored in the
+  same transaction as the accession.
+  Returns the response and the outbox row of the series' derivatives.
+  """
+  uploaded_keys = [outcome.object_key for outcome in outcomes if outcome.status == "uploaded"]
+  if len(uploaded_keys) != len(outcomes) or not outcomes:
+    raise HTTPException(
+      status_code=status.HTTP_502_BAD_GATEWAY,
+      detail={
+        "message": "Error occured while file upload",
+        "files": [outcome.model_dump(exclude={"deduplicated"}) for outcome in outcomes]
+      }
+    )
+  if headers is None:
+    try:
+      headers = await load_headers(client, bucket, outcomes, heads)
+    except Exception as e:
+      # the index is a convenience, the series is stored either way
+      print(f"failed to parse DICOM headers: {e}")
+      headers = [None] * len(outcomes)
+  # read before the insert, which makes every hash the caller's
+  owned = await owned_content(
+    session, accession.aid, [outcome.content_hash for outcome in outcomes if outcome.deduplicated]
+  )
+  # every DB row for the series goes in with one statement
+  accession_id, _, file_rows, outbox_id = await insert_accession(
+    session,
+    aid=accession.aid,
+    dicom_name=accession.dicom_name,
+    files=[(outcome.filetype, outcome.object_key, outcome.content_hash) for outcome in outcomes],
+    agaston_score=accession.agaston_score if accession.agaston_score >= 0 else None,
+    outbox_delay=LEASE_SECONDS
+  )
+  # shared files come back with the key they are stored under, which may
+  # be a compressed copy, so they are matched on their content hash
+  stored = {row["content_hash"] or row["object_key"]: row for row in file_rows}
+  for outcome in outcomes:
+    row = stored.get(outcome.content_hash or outcome.object_key)
+    if row is not None:
+      outcome.file_id = row["file_id"]
+      outcome.object_key = row["object_key"]
+  await insert_headers(session, list({
+    outcome.file_id: header
+    for outcome, header in zip(outcomes, headers)
+    if header is not None and outcome.file_id is not None
+  }.items()))
+  # get pre-signed URL for DUMMY 
+  # AI generated image mask
+  mask_url = await presigned_url(client, bucket, uploaded_keys[-1])
+  # dummy function: ML pipeline generates:
+  #   1. Mask
+  #   2. Agaston
+  # introduce dummy func as celery task?
+  annotated_file = UploadNewFile(
+    type="mask",
+    object_key="",
+    s3_url=mask_url
+  )
+  written = WriteAccession(
+    aid=accession_id,
+    dicom_name=accession.dicom_name,
+    agaston_score=0,
+    files=[annotated_file],
+    uploads=reported_outcomes(outcomes, owned)
+  )
+  if claim is not None:
+    key, token = claim
+    try:
+      await save_result(session, accession.aid, key, token, written.model_dump(mode="json"))
+    except StillInProgress as e:
+      raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+  
+  await session.commit()
+  
+  return written, outbox_id
+
+
+def caller_aid(user, requested: Optional[int]) -> int:
+  """
+  The account an accession is written for is always the caller's; an aid
+  sent in the request must match it.
+  """
+  if requested is not None and requested != user.aid:
+    raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Accessions can only be filed under your own account")
+  return user.aid
+
+
+# callers creating an accession pass WriteAccession.aid, which carries the new accession's id
+def schedule_derivatives(
+  request: Request,
+  background_tasks: BackgroundTasks,
+  client,
+  bucket: str,
+  dicom_id: int,
+  uploads: List[FileUploadOutcome],
+  outbox_id: int,
+) -> None:
+  """
+  Build the preview pyramid, packed series volumes and intensity
+  statistics, then compress the slices, once the response is out. The work is already in the outbox
+  (`outbox_id`), so the reconciler finishes it if this worker does not.
+  """
+  background_tasks.add_task(
+    run_derivatives, request.app.state.sessionmaker, client, bucket, dicom_id, derivative_files(uploads), outbox_id
+  )
+
+
+async def claim_or_replay(
+  session: AsyncSession, aid: int, key: str, fingerprint: str
+) -> Tuple[Optional[str], Optional[dict]]:
+  """
+  Claim an idempotency key, or wait for the request that holds it and return
+  its stored response. Returns (claim token, None) or (None, response).
+  """
+  try:
+    while True:
+      token, existing = await claim_key(session, aid, key, fingerprint)
+      if token is not None:
+        return token, None
+      response = await wait_for_result(session, aid, key, existing)
+      if response is not None:
+        return None, response
+      # the first attempt failed and released the key: run it ourselves
+  except StillInProgress as e:
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e), headers={"Retry-After": "5"})
+  except IdempotencyError as e:
+    raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
 
 
 @user_router.post("/new_accession")
 async def create_accession(
+  request: Request,
+  background_tasks: BackgroundTasks,
   files: Annotated[List[UploadFile], File()],
   accession: str = Form(),
+  idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+  user = Depends(get_current_active_user),
   session: AsyncSession = Depends(get_session), 
   s3_data: tuple = Depends(get_s3)):
   """
+  The accession is filed under the caller's account, and Idempotency-Keys
+  are scoped to it.
+  Requests sent with the same Idempotency-Key header (and the same accession
+  and file names) are run once; repeats get the stored response back with
+  an Idempotent-Replayed header, waiting for the first one if it is still
+  running.
   Returns 1 DicomFiles object:
   {
     "dicom_id": x,
@@ -133,70 +322,861 @@ async def create_accession(
   """
   # write to S3, get object key  
   client, bucket = s3_data
-  accession_id = -1
+  uploaded_keys: List[str] = []
+  claim = None
   try:
+    fingerprint = request_fingerprint(accession, [file.filename for file in files])
     accession = WriteAccession.model_validate_json(accession)
-    mask_url = ""
-    for i, file in enumerate(files):
-      # background task? 
-      key = f"/Dicoms/{accession.aid}/{datetime.now()}_{file.filename}"
-      client.upload_fileobj(file.file, bucket, key)
-      
-      # get pre-signed URL for DUMMY 
-      # AI generated image mask
-      mask_url = get_temp_url(client,bucket,key)
-      
-      # add to: FileRecords, Dicoms, Dicomfiles
-      file_record = FileRecords(filetype="slice", object_key=key)
-      file_record = await add_record(file_record, session)
-      if i == 0:
-        new_accession = Dicoms(dicom_name=accession.dicom_name)
-        new_accession = await add_record(new_accession, session)
-        accession_id = new_accession.dicom_id
-      
-      # add to DICOMFiles junction table,
-      await session.execute(
-        text("""
-             INSERT INTO DICOMFILES (DICOM_ID, FILE_ID)
-             VALUES (:dicom_id, :file_id)
-             """).bindparams(
-               dicom_id=accession_id,
-               file_id=file_record.file_id
-             )
-      )
-      # then PatientDicoms junction table
-      
-      patient_dicom_record = PatientDicoms(patient_id=accession.aid, dicom_id=accession_id)
-      patient_dicom_record = await add_record(patient_dicom_record, session)
-      
-      # dummy function: ML pipeline generates:
-      #   1. Mask
-      #   2. Agaston
-      # introduce dummy func as celery task?
-    annotated_file = UploadNewFile(
-      type="mask",
-      object_key="",
-      s3_url=mask_url
-    )
-    
-    await session.commit()
-    
-    return WriteAccession(
-      aid=accession_id,
-      dicom_name=accession.dicom_name,
-      agaston_score=0,
-      files=[annotated_file]
+    accession.aid = caller_aid(user, accession.aid)
+    if idempotency_key is not None:
+      token, replay = await claim_or_replay(session, accession.aid, idempotency_key, fingerprint)
+      if replay is not None:
+        return JSONResponse(replay, headers={"Idempotent-Replayed": "true"})
+      claim = (idempotency_key, token)
+    heads = [read_head(file.file) for file in files]
+    # push every slice to S3 concurrently, off the event loop,
+    # skipping content that is already stored
+    outcomes = await upload_files(
+      client,
+      bucket,
+      [(file.filename, file.file) for file in files],
+      session=session
     )
+    uploaded_keys = uploaded_here(outcomes)
+    written, outbox_id = await commit_accession(session, client, bucket, accession, outcomes, claim, heads)
+    schedule_derivatives(request, background_tasks, client, bucket, written.aid, written.uploads, outbox_id)
+    return written
       
+  except HTTPException:
+    await session.rollback()
+    await discard_objects(session, client, bucket, uploaded_keys)
+    if claim is not None:
+      await release_key(session, accession.aid, *claim)
+    raise
   except Exception as e:
     await session.rollback()
+    await discard_objects(session, client, bucket, uploaded_keys)
+    if claim is not None:
+      await release_key(session, accession.aid, *claim)
     # send to kafka next time
     raise HTTPException(status_code=501, detail=f"Error occured while file upload: {e}")
 
 
+@user_router.post("/new_accession/stream")
+async def create_accession_streaming(
+  request: Request,
+  background_tasks: BackgroundTasks,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)):
+  """
+  Same contract as /new_accession, but file parts are piped from the
+  request body into S3 as they arrive instead of being spooled first.
+  The `accession` form field must precede the files; it is filed under
+  the caller's account.
+  """
+  client, bucket = s3_data
+  parsed = {}
+
+  def key_for(fields: dict, filename: str) -> str:
+    if "accession" not in parsed:
+      if "accession" not in fields:
+        raise HTTPException(
+          status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+          detail="The accession field must be sent before any file"
+        )
+      accession = WriteAccession.model_validate_json(fields["accession"])
+      accession.aid = caller_aid(user, accession.aid)
+      parsed["accession"] = accession
+    return make_object_key(parsed["accession"].aid, filename)
+
+  # files finish concurrently, but the session takes one query at a time
+  lookup = asyncio.Lock()
+
+  async def exists(content_hash: str) -> bool:
+    # a FILERECORDS row counts even when its object moved (e.g. to a
+    # compressed copy); the HEAD of the content key runs outside the lock
+    async with lookup:
+      if await known_content(session, [content_hash]):
+        return True
+    return content_hash in await stored_content(client, bucket, None, [content_hash])
+
+  outcomes: List[FileUploadOutcome] = []
+  try:
+    _, outcomes, headers = await stream_multipart_to_s3(
+      request.headers.get("content-type", ""), request.stream(), client, bucket, key_for, exists
+    )
+    if "accession" not in parsed:
+      raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="No files were sent")
+    written, outbox_id = await commit_accession(session, client, bucket, parsed["accession"], outcomes, headers=headers)
+    schedule_derivatives(request, background_tasks, client, bucket, written.aid, written.uploads, outbox_id)
+    return written
+  except HTTPException:
+    await session.rollback()
+    await discard_objects(session, client, bucket, uploaded_here(outcomes))
+    raise
+  except Exception as e:
+    await session.rollback()
+    await discard_objects(session, client, bucket, uploaded_here(outcomes))
+    raise HTTPException(status_code=501, detail=f"Error occured while file upload: {e}")
+
+
+@user_router.post("/new_accession/archive")
+async def create_accession_from_archive(
+  request: Request,
+  background_tasks: BackgroundTasks,
+  archive: UploadFile = File(),
+  accession: str = Form(),
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)):
+  """
+  Same contract as /new_accession, for a whole study sent as one ZIP
+  (optionally with a DICOMDIR, which then decides the members). Members
+  are expanded in parallel batches and pushed to S3 as they come out;
+  anything under a mask/ or masks/ folder is a mask. Members that are not
+  DICOM (or, for masks, an image) are skipped and listed in `rejected`.
+  The accession is filed under the caller's account; archives past
+  MAX_ARCHIVE_MEMBERS or MAX_ARCHIVE_TOTAL_BYTES are refused unread.
+  """
+  client, bucket = s3_data
+  outcomes: List[FileUploadOutcome] = []
+  heads: List[bytes] = []
+  rejected: List[RejectedFile] = []
+  try:
+    accession = WriteAccession.model_validate_json(accession)
+    accession.aid = caller_aid(user, accession.aid)
+    async for members, refused in expand_archive(archive.file):
+      rejected.extend(refused)
+      try:
+        heads.extend(read_head(spool) for _, _, spool in members)
+        batch = await upload_files(
+          client, bucket, [(member_filename(name), spool) for name, _, spool in members], session=session
+        )
+      finally:
+        for _, _, spool in members:
+          spool.close()
+      for outcome, (_, filetype, _) in zip(batch, members):
+        outcome.filetype = filetype
+      outcomes.extend(batch)
+    if not outcomes:
+      raise HTTPException(
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        detail={"message": "The archive holds no DICOM files", "rejected": [r.model_dump() for r in rejected]}
+      )
+    written, outbox_id = await commit_accession(session, client, bucket, accession, outcomes, heads=heads)
+    written.rejected = rejected
+    schedule_derivatives(request, background_tasks, client, bucket, written.aid, written.uploads, outbox_id)
+    return written
+  except ArchiveError as e:
+    await session.rollback()
+    await discard_objects(session, client, bucket, uploaded_here(outcomes))
+    raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+  except HTTPException:
+    await session.rollback()
+    await discard_objects(session, client, bucket, uploaded_here(outcomes))
+    raise
+  except Exception as e:
+    await session.rollback()
+    await discard_objects(session, client, bucket, uploaded_here(outcomes))
+    raise HTTPException(status_code=501, detail=f"Error occured while file upload: {e}")
+
+
+# ----------------------------------------------------------------------
+# resumable uploads: create, PUT numbered chunks, query, complete, then
+# finalize the completed uploads into an accession
+# ----------------------------------------------------------------------
+
+async def _owned_upload(session: AsyncSession, upload_id: str, aid: int, for_update: bool = False) -> dict:
+  upload = await get_upload(session, upload_id, aid, for_update=for_update)
+  if upload is None:
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
+  return upload
+
+
+@user_router.post("/uploads")
+async def create_resumable_upload(
+  body: CreateUpload,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> UploadStatus:
+  client, bucket = s3_data
+  try:
+    upload = await create_upload(session, client, bucket, user.aid, body)
+  except UploadError as e:
+    raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+  return to_status(upload)
+
+
+@user_router.get("/uploads/{upload_id}")
+async def get_resumable_upload(
+  upload_id: str,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> UploadStatus:
+  """Which chunks the server already has, so a client can resume after a dropped connection."""
+  client, bucket = s3_data
+  upload = await _owned_upload(session, upload_id, user.aid)
+  return to_status(upload, await received_chunks(client, bucket, upload))
+
+
+@user_router.put("/uploads/{upload_id}/chunks/{chunk}")
+async def put_upload_chunk(
+  upload_id: str,
+  chunk: int,
+  request: Request,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> ChunkReceipt:
+  client, bucket = s3_data
+  upload = await _owned_upload(session, upload_id, user.aid)
+  # release the pooled connection before the body and S3 round trip
+  await session.close()
+  try:
+    # refused before the body is read when it cannot be the expected chunk
+    expected = check_chunk(upload, chunk, request.headers.get("content-length"))
+    body = await read_chunk(request.stream(), expected)
+    etag = await upload_chunk(client, bucket, upload, chunk, body)
+  except UploadError as e:
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+  return ChunkReceipt(upload_id=str(upload["upload_id"]), chunk=chunk, size=len(body), etag=etag)
+
+
+@user_router.post("/uploads/{upload_id}/complete")
+async def complete_resumable_upload(
+  upload_id: str,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> UploadStatus:
+  client, bucket = s3_data
+  upload = await _owned_upload(session, upload_id, user.aid, for_update=True)
+  try:
+    upload = await complete_upload(session, client, bucket, upload)
+  except UploadError as e:
+    await session.rollback()
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+  return to_status(upload, await received_chunks(client, bucket, upload))
+
+
+@user_router.delete("/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def abort_resumable_upload(
+  upload_id: str,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> None:
+  client, bucket = s3_data
+  upload = await _owned_upload(session, upload_id, user.aid, for_update=True)
+  try:
+    await abort_upload(session, client, bucket, upload)
+  except UploadError as e:
+    await session.rollback()
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+
+@user_router.post("/uploads/finalize")
+async def finalize_resumable_uploads(
+  body: FinalizeUploads,
+  request: Request,
+  background_tasks: BackgroundTasks,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> WriteAccession:
+  """Create an accession from completed uploads, in one transaction."""
+  client, bucket = s3_data
+  try:
+    uploads = await consume_uploads(session, body.upload_ids, user.aid)
+  except UploadError as e:
+    await session.rollback()
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+  outcomes = [
+    FileUploadOutcome(
+      filename=upload["filename"],
+      object_key=upload["object_key"],
+      filetype=upload["filetype"],
+      status="uploaded",
+      size=upload["total_size"],
+    )
+    for upload in uploads
+  ]
+  accession = WriteAccession(aid=caller_aid(user, body.aid), dicom_name=body.dicom_name, agaston_score=body.agaston_score, files=[])
+  try:
+    written, outbox_id = await commit_accession(session, client, bucket, accession, outcomes)
+  except HTTPException:
+    await session.rollback()
+    raise
+  except Exception as e:
+    await session.rollback()
+    raise HTTPException(status_code=501, detail=f"Error occured while finalizing upload: {e}")
+  schedule_derivatives(request, background_tasks, client, bucket, written.aid, written.uploads, outbox_id)
+  return written
+
+
+# ----------------------------------------------------------------------
+# direct uploads: clients PUT slices straight to the bucket with presigned
+# URLs, the API only signs and then records what landed
+# ----------------------------------------------------------------------
+
+@user_router.post("/uploads/presign")
+async def presign_direct_uploads(
+  body: PresignRequest,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> PresignResponse:
+  """
+  One presigned PUT per file. Files sent with their sha256 are checked by
+  S3 against the hash, and get no URL at all when the caller already holds
+  that content. Whether other users store it is never revealed.
+  """
+  client, bucket = s3_data
+  if any(file.filetype not in ("slice", "mask") for file in body.files):
+    raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="filetype must be 'slice' or 'mask'")
+  try:
+    normalize_hashes(body.files)
+  except ValueError as e:
+    raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+  owned = await owned_content(session, user.aid, [file.sha256 for file in body.files if file.sha256])
+  files = await presign_uploads(client, bucket, user.aid, body.files, owned)
+  return PresignResponse(expires_in=UPLOAD_URL_EXPIRATION_TIME, files=files)
+
+
+@user_router.post("/uploads/presigned/finalize")
+async def finalize_direct_uploads(
+  body: FinalizeDirectUpload,
+  request: Request,
+  background_tasks: BackgroundTasks,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> WriteAccession:
+  """Check the presigned uploads landed, then write the accession in one transaction."""
+  client, bucket = s3_data
+  prefix = owner_prefix(user.aid)
+  if any(not file.object_key.startswith((prefix, CONTENT_PREFIX)) for file in body.files):
+    raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Object keys were not issued to this user")
+  owned = await owned_content(session, user.aid, [hash_from_key(file.object_key) for file in body.files if hash_from_key(file.object_key)])
+  outcomes = await verify_uploads(client, bucket, user.aid, body.files, owned)
+  accession = WriteAccession(aid=caller_aid(user, body.aid), dicom_name=body.dicom_name, agaston_score=body.agaston_score, files=[])
+  try:
+    written, outbox_id = await commit_accession(session, client, bucket, accession, outcomes)
+  except HTTPException:
+    await session.rollback()
+    raise
+  except Exception as e:
+    await session.rollback()
+    raise HTTPException(status_code=501, detail=f"Error occured while finalizing upload: {e}")
+  schedule_derivatives(request, background_tasks, client, bucket, written.aid, written.uploads, outbox_id)
+  return written
+
+
+# ----------------------------------------------------------------------
+# QIDO-RS style search over the DICOM header index: studies, series and
+# instances the caller owns, without downloading any pixel data
+# ----------------------------------------------------------------------
+
+def qido_filters(
+  StudyInstanceUID: Optional[str] = None,
+  SeriesInstanceUID: Optional[str] = None,
+  SOPInstanceUID: Optional[str] = None,
+  Modality: Optional[str] = None,
+  StudyDate: Optional[str] = None,
+  SeriesDescription: Optional[str] = None,
+  InstanceNumber: Optional[str] = None,
+  dicom_id: Optional[int] = None,
+) -> dict:
+  return {
+    "StudyInstanceUID": StudyInstanceUID,
+    "SeriesInstanceUID": SeriesInstanceUID,
+    "SOPInstanceUID": SOPInstanceUID,
+    "Modality": Modality,
+    "StudyDate": StudyDate,
+    "SeriesDescription": SeriesDescription,
+    "InstanceNumber": InstanceNumber,
+    "dicom_id": dicom_id,
+  }
+
+
+async def _search(search, session: AsyncSession, aid: int, filters: dict, limit: int, offset: int):
+  try:
+    return await search(session, aid, filters, limit, offset)
+  except ValueError as e:
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+@user_router.get("/dicomweb/studies")
+async def qido_studies(
+  filters: dict = Depends(qido_filters),
+  limit: int = 100,
+  offset: int = 0,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session)) -> List[DicomStudy]:
+  return await _search(search_studies, session, user.aid, filters, limit, offset)
+
+
+@user_router.get("/dicomweb/series")
+async def qido_series(
+  filters: dict = Depends(qido_filters),
+  limit: int = 100,
+  offset: int = 0,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session)) -> List[DicomSeries]:
+  return await _search(search_series, session, user.aid, filters, limit, offset)
+
+
+@user_router.get("/dicomweb/studies/{study_uid}/series")
+async def qido_study_series(
+  study_uid: str,
+  filters: dict = Depends(qido_filters),
+  limit: int = 100,
+  offset: int = 0,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session)) -> List[DicomSeries]:
+  filters["StudyInstanceUID"] = study_uid
+  return await _search(search_series, session, user.aid, filters, limit, offset)
+
+
+@user_router.get("/dicomweb/instances")
+async def qido_instances(
+  filters: dict = Depends(qido_filters),
+  limit: int = 100,
+  offset: int = 0,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session)) -> List[DicomInstance]:
+  """Instances in display order: by series, then InstanceNumber and SliceLocation."""
+  return await _search(search_instances, session, user.aid, filters, limit, offset)
+
+
+@user_router.get("/dicomweb/studies/{study_uid}/series/{series_uid}/instances")
+async def qido_series_instances(
+  study_uid: str,
+  series_uid: str,
+  filters: dict = Depends(qido_filters),
+  limit: int = 100,
+  offset: int = 0,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session)) -> List[DicomInstance]:
+  filters["StudyInstanceUID"] = study_uid
+  filters["SeriesInstanceUID"] = series_uid
+  return await _search(search_instances, session, user.aid, filters, limit, offset)
+
+
+@user_router.get("/export/{dicom_id}")
+async def export_accession(
+  dicom_id: int,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> StreamingResponse:
+  """
+  The whole accession (slices, masks and a manifest.json) as one ZIP,
+  built from the S3 objects while it is sent.
+  """
+  client, bucket = s3_data
+  files = await export_files(session, user.aid, dicom_id)
+  if not files:
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Accession not found")
+  # release the pooled connection before streaming from S3
+  await session.close()
+  return StreamingResponse(
+    stream_zip(client, bucket, files),
+    media_type="application/zip",
+    headers={"Content-Disposition": f'attachment; filename="{archive_name(files[0]["dicom_name"], dicom_id)}"'},
+  )
+
+
+# ----------------------------------------------------------------------
+# WADO-RS style retrieval: whole instances of a study / series / instance,
+# or single frames, as multipart/related responses
+# ----------------------------------------------------------------------
+
+async def _retrieve_targets(session: AsyncSession, aid: int, filters: dict) -> List[dict]:
+  """
+  Owned instances matching the path UIDs, once per stored file, in display
+  order. Every page is read: responses are cached as immutable, so a
+  retrieve is either complete or refused with 413.
+  """
+  instances = []
+  while True:
+    page = await search_instances(session, aid, filters, MAX_LIMIT, len(instances))
+    instances.extend(page)
+    if len(instances) > MAX_RETRIEVE_INSTANCES:
+      raise HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"More than {MAX_RETRIEVE_INSTANCES} instances match, retrieve them by series or instance"
+      )
+    if len(page) < MAX_LIMIT:
+      break
+  if not instances:
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No matching instances")
+  unique = {}
+  for instance in instances:
+    unique.setdefault(instance.file_id, instance.model_dump())
+  return list(unique.values())
+
+
+async def _retrieve_instances(
+  filters: dict, accept: Optional[str], if_none_match: Optional[str], aid: int, session: AsyncSession, s3_data: tuple
+) -> Response:
+  client, bucket = s3_data
+  if not accepts(accept, "application/dicom"):
+    raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail='Only multipart/related; type="application/dicom" is supported')
+  instances = await _retrieve_targets(session, aid, filters)
+  # release the pooled connection before streaming from S3
+  await session.close()
+  tag = etag([instance["file_id"] for instance in instances])
+  cache_control = CACHE_CONTROL if "SOPInstanceUID" in filters else CACHE_REVALIDATE
+  headers = {"Cache-Control": cache_control, "ETag": tag, "Vary": "Accept"}
+  if not_modified(if_none_match, tag):
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+  boundary = new_boundary()
+  return StreamingResponse(
+    stream_instances(client, bucket, boundary, instances),
+    media_type=content_type(boundary, "application/dicom"),
+    headers=headers,
+  )
+
+
+@user_router.get("/dicomweb/studies/{study_uid}")
+async def wado_study(
+  study_uid: str,
+  accept: Optional[str] = Header(default=None),
+  if_none_match: Optional[str] = Header(default=None),
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> Response:
+  return await _retrieve_instances(
+    {"StudyInstanceUID": study_uid}, accept, if_none_match, user.aid, session, s3_data
+  )
+
+
+@user_router.get("/dicomweb/studies/{study_uid}/series/{series_uid}")
+async def wado_series(
+  study_uid: str,
+  series_uid: str,
+  accept: Optional[str] = Header(default=None),
+  if_none_match: Optional[str] = Header(default=None),
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> Response:
+  return await _retrieve_instances(
+    {"StudyInstanceUID": study_uid, "SeriesInstanceUID": series_uid}, accept, if_none_match, user.aid, session, s3_data
+  )
+
+
+@user_router.get("/dicomweb/studies/{study_uid}/series/{series_uid}/instances/{sop_uid}")
+async def wado_instance(
+  study_uid: str,
+  series_uid: str,
+  sop_uid: str,
+  accept: Optional[str] = Header(default=None),
+  if_none_match: Optional[str] = Header(default=None),
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> Response:
+  return await _retrieve_instances(
+    {"StudyInstanceUID": study_uid, "SeriesInstanceUID": series_uid, "SOPInstanceUID": sop_uid},
+    accept, if_none_match, user.aid, session, s3_data
+  )
+
+
+@user_router.get("/dicomweb/studies/{study_uid}/series/{series_uid}/instances/{sop_uid}/frames/{frames}")
+async def wado_frames(
+  study_uid: str,
+  series_uid: str,
+  sop_uid: str,
+  frames: str,
+  request: Request,
+  accept: Optional[str] = Header(default=None),
+  if_none_match: Optional[str] = Header(default=None),
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> Response:
+  """
+  Frames (1-based, comma separated) of one instance as stored: native
+  pixel data as application/octet-stream parts, compressed instances as
+  their encoded bitstream (image/jpeg, image/jls, ...).
+  """
+  client, bucket = s3_data
+  try:
+    numbers = parse_frame_list(frames)
+  except FrameError as e:
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+  instance = (await _retrieve_targets(session, user.aid, {
+    "StudyInstanceUID": study_uid, "SeriesInstanceUID": series_uid, "SOPInstanceUID": sop_uid
+  }))[0]
+  await session.close()
+  tag = etag([instance["file_id"]], frames)
+  headers = {"Cache-Control": CACHE_CONTROL, "ETag": tag, "Vary": "Accept"}
+  if not_modified(if_none_match, tag):
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+  try:
+    parts, media_type, syntax = await fetch_frames(client, bucket, instance["object_key"], numbers)
+  except FrameError as e:
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+  if not accepts(accept, media_type):
+    raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail=f"Frames are only available as {media_type}")
+  boundary = new_boundary()
+  location = str(request.url).split("/frames/", 1)[0]
+  return Response(
+    content=frames_body(boundary, parts, media_type, location, numbers),
+    media_type=content_type(boundary, media_type, syntax),
+    headers=headers,
+  )
+
+
+@user_router.get("/transcoding/{dicom_id}")
+async def get_transcoding_report(
+  dicom_id: int,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session)) -> List[SeriesCompression]:
+  """Compression ratio and encode / decode cost of each series stored compressed."""
+  return [SeriesCompression(**row) for row in await compression_by_series(session, user.aid, dicom_id)]
+
+
+@user_router.get("/intensity/{dicom_id}")
+async def get_intensity_stats(
+  dicom_id: int,
+  slices: bool = False,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session)) -> List[SeriesIntensity]:
+  """
+  Per-series intensity statistics measured at ingest, in modality units
+  (HU for CT): range, mean, histogram and the calcium (>= 130 HU) voxel
+  count and volume. With slices=true each series also lists its slices.
+  Series appear once the background measurement has run.
+  """
+  series = await series_intensities(session, user.aid, dicom_id)
+  per_slice = {}
+  if slices and series:
+    for row in await slice_intensities(session, dicom_id):
+      per_slice.setdefault(row["series_instance_uid"], []).append(
+        SliceIntensity(**row, hu_mean=row["hu_sum"] / row["voxels"] if row["voxels"] else None)
+      )
+  return [
+    SeriesIntensity(
+      **row,
+      calcium_threshold=CALCIUM_THRESHOLD,
+      histogram_min=HISTOGRAM_MIN,
+      bin_width=BIN_WIDTH,
+      per_slice=per_slice.get(row["series_instance_uid"], []),
+    )
+    for row in series
+  ]
+
+
+@user_router.get("/masks/{dicom_id}")
+async def get_masks(
+  dicom_id: int,
+  if_none_match: Optional[str] = Header(default=None),
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> Response:
+  """
+  Every mask of an accession in the compact mask stack format (bit-packed
+  or run-length encoded slices behind an index), built on first request.
+  """
+  client, bucket = s3_data
+  stack = await get_mask_stack(session, client, bucket, user.aid, dicom_id)
+  if stack is None:
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No masks for this accession")
+  await session.close()
+  headers = {
+    "ETag": f'"{stack["etag"]}"',
+    "Cache-Control": "private, no-cache",
+    "X-Mask-Slices": str(stack["slices"]),
+  }
+  if not_modified(if_none_match, headers["ETag"]):
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+  return Response(content=await read_mask_stack(client, bucket, stack), media_type=MASK_CONTENT_TYPE, headers=headers)
+
+
+# ----------------------------------------------------------------------
+# packed series volumes: every slice of a series in one object, read whole
+# or by byte range
+# ----------------------------------------------------------------------
+
+def to_volume(volume: dict, s3_url: Optional[str]) -> SeriesVolume:
+  return SeriesVolume(
+    dicom_id=volume["dicom_id"],
+    series_instance_uid=volume["series_instance_uid"],
+    slices=volume["slices"],
+    rows=volume["rows"],
+    columns=volume["columns"],
+    dtype=volume["dtype"],
+    data_offset=volume["data_offset"],
+    slice_bytes=volume["slice_bytes"],
+    size=volume["size_bytes"],
+    header=volume["header"],
+    s3_url=s3_url,
+  )
+
+
+@user_router.get("/volumes/{dicom_id}")
+async def get_volumes(
+  dicom_id: int,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> List[SeriesVolume]:
+  """
+  Packed volumes of an accession, one per series. Slice i occupies bytes
+  header.offsets[i] to offsets[i] + slice_bytes - 1 of the object, so the
+  presigned URL can be fetched whole or with a Range header.
+  """
+  client, bucket = s3_data
+  volumes = await volumes_for_accession(session, user.aid, dicom_id)
+  urls = await presigned_urls(client, bucket, [volume["object_key"] for volume in volumes])
+  return [to_volume(volume, urls.get(volume["object_key"])) for volume in volumes]
+
+
+@user_router.get("/query-stats", dependencies=[Depends(get_current_active_user)])
+async def get_query_stats() -> List[dict]:
+  """Call counts and timings of the registered read queries of this worker."""
+  return query_stats()
+
+
+@user_router.get("/presign-cache", dependencies=[Depends(get_current_active_user)])
+async def get_presign_cache_stats() -> PresignCacheStats:
+  """Hit / miss counters of the presigned URL cache of this worker."""
+  return PresignCacheStats(**url_cache.stats())
+
+
+@user_router.get("/volumes/{dicom_id}/{series_uid}/slices")
+async def get_volume_slices(
+  dicom_id: int,
+  series_uid: str,
+  start: int = 0,
+  stop: Optional[int] = None,
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)) -> Response:
+  """
+  Raw pixels of slices [start, stop) of a packed series, streamed from one
+  ranged GET. A slab is at most MAX_SLAB_BYTES: without a stop it ends
+  where that runs out (see X-Volume-Shape), a longer explicit slab is 413.
+  """
+  client, bucket = s3_data
+  volumes = await volumes_for_accession(session, user.aid, dicom_id, series_uid)
+  if not volumes:
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Volume not found")
+  volume = volumes[0]
+  # release the pooled connection before the S3 round trip
+  await session.close()
+  try:
+    stop = slab_stop(volume, start, stop)
+    first, last = slab_range(volume, start, stop)
+  except SlabTooLarge as e:
+    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+  except VolumeError as e:
+    raise HTTPException(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, detail=str(e))
+  return StreamingResponse(
+    stream_slab(client, bucket, volume, first, last),
+    media_type="application/octet-stream",
+    headers={
+      "Content-Length": str(last - first + 1),
+      "X-Volume-Dtype": volume["dtype"],
+      "X-Volume-Shape": f"{stop - start},{volume['rows']},{volume['columns']}",
+    },
+  )
+
+
 def get_random_str(k=32):
   return base64.urlsafe_b64decode(secrets.token_bytes(k)).rstrip(b'=').decode("utf-8")
 
 @user_router.post("/update_accession")
-async def update_accession(accession: UpdateAccession):
-  return
\ No newline at end of file
+async def update_accession(
+  request: Request,
+  background_tasks: BackgroundTasks,
+  changes: str = Form(),
+  files: Annotated[List[UploadFile], File()] = [],
+  user = Depends(get_current_active_user),
+  session: AsyncSession = Depends(get_session),
+  s3_data: tuple = Depends(get_s3)):
+  """
+  Apply a diff to an accession instead of uploading it again. `changes` is
+  an UpdateAccession: each add / replace names the file part with the new
+  content, each replace / remove names the stored file by object_key
+  and/or sha256 (as returned by get-session and /new_accession). Only new
+  content is uploaded and only the changed DICOMFILES rows are touched, in
+  one transaction; a change against a file the accession no longer holds
+  fails with 409 and nothing is applied.
+  """
+  client, bucket = s3_data
+  outcomes: List[FileUploadOutcome] = []
+  try:
+    update = UpdateAccession.model_validate_json(changes)
+    locked = await lock_accession(session, user.aid, update.dicom_id)
+    if locked is None:
+      raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Accession not found")
+    accession, current = locked
+    parts = {file.filename: file.file for file in files}
+    uploads, removed = plan_changes(current, update.changes, parts)
+    heads = [read_head(parts[change.filename]) for change, _, _ in uploads]
+    # content the bucket already holds is not sent again
+    outcomes = await upload_files(
+      client, bucket, [(change.filename, parts[change.filename]) for change, _, _ in uploads], session=session
+    )
+    for outcome, (_, filetype, _) in zip(outcomes, uploads):
+      outcome.filetype = filetype
+    if any(outcome.status != "uploaded" for outcome in outcomes):
+      raise HTTPException(
+        status_code=status.HTTP_502_BAD_GATEWAY,
+        detail={
+          "message": "Error occured while file upload",
+          "files": [outcome.model_dump(exclude={"deduplicated"}) for outcome in outcomes]
+        }
+      )
+    link, unlink, unchanged = resolve_changes(current, uploads, outcomes, removed)
+    owned = await owned_content(session, user.aid, [outcome.content_hash for outcome in link if outcome.deduplicated])
+    rows = await apply_changes(session, user.aid, update.dicom_id, link, unlink, update.dicom_name)
+    stored = {(row["filetype"], row["content_hash"] or row["object_key"]): row for row in rows}
+    for outcome in link:
+      row = stored.get((outcome.filetype, outcome.content_hash or outcome.object_key))
+      if row is not None:
+        outcome.file_id = row["file_id"]
+        outcome.object_key = row["object_key"]
+    head_of = {id(outcome): head for outcome, head in zip(outcomes, heads)}
+    try:
+      headers = await load_headers(client, bucket, link, [head_of[id(outcome)] for outcome in link])
+    except Exception as e:
+      # the index is a convenience, the files are linked either way
+      print(f"failed to parse DICOM headers: {e}")
+      headers = [None] * len(link)
+    await insert_headers(session, list({
+      outcome.file_id: header
+      for outcome, header in zip(link, headers)
+      if header is not None and outcome.file_id is not None
+    }.items()))
+    stale_volumes = await drop_stale_volumes(
+      session, update.dicom_id, [file["file_id"] for file in unlink] + [outcome.file_id for outcome in link]
+    )
+    outbox_id = None
+    if link or unlink:
+      outbox_id = await enqueue(
+        session, "derivatives", {"dicom_id": update.dicom_id, "files": derivative_files(link)}, delay=LEASE_SECONDS
+      )
+    await session.commit()
+  except ChangeConflict as e:
+    await session.rollback()
+    await discard_objects(session, client, bucket, uploaded_here(outcomes))
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+  except ChangeError as e:
+    await session.rollback()
+    await discard_objects(session, client, bucket, uploaded_here(outcomes))
+    raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+  except HTTPException:
+    await session.rollback()
+    await discard_objects(session, client, bucket, uploaded_here(outcomes))
+    raise
+  except Exception as e:
+    await session.rollback()
+    await discard_objects(session, client, bucket, uploaded_here(outcomes))
+    raise HTTPException(status_code=501, detail=f"Error occured while updating the accession: {e}")
+  # volumes of the touched series are packed again under the same keys;
+  # a series that lost every slice just loses its volume
+  await delete_objects(client, bucket, stale_volumes)
+  if outbox_id is not None:
+    schedule_derivatives(request, background_tasks, client, bucket, update.dicom_id, link, outbox_id)
+  return UpdatedAccession(
+    dicom_id=update.dicom_id,
+    dicom_name=update.dicom_name if update.dicom_name is not None else accession["dicom_name"],
+    added=reported_outcomes(link, owned),
+    removed=[file["object_key"] for file in unlink],
+    unchanged=unchanged,
+  )
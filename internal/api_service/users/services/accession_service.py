@@ -0,0 +1,233 @@
+import base64
+from datetime import datetime, timezone
+from typing import Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_service.utils.query_registry import fetch, register
+
+
+# one round trip per series: every row an accession needs is written by a
+# single statement, and the file rows go in as arrays, so the cost stays
+# flat whether the series has 5 slices or 500.
+# Files with a content hash are shared: a slice that is already stored
+# bumps REF_COUNT on the existing FILERECORDS row instead of adding one.
+# The follow-up work (previews, volumes, transcoding) is recorded in the
+# outbox by the same statement, so it survives a crash after commit.
+INSERT_ACCESSION = text("""
+  WITH new_stat AS (
+    INSERT INTO PATIENT_STATS (AGASTON_SCORE)
+    VALUES (CAST(:agaston_score AS INT))
+    RETURNING STAT_ID
+  ), new_dicom AS (
+    INSERT INTO DICOMS (DICOM_NAME, STAT_ID)
+    SELECT CAST(:dicom_name AS VARCHAR), STAT_ID FROM new_stat
+    RETURNING DICOM_ID, CREATED_AT
+  ), new_files AS (
+    INSERT INTO FILERECORDS (FILETYPE, OBJECT_KEY, CONTENT_HASH)
+    SELECT * FROM unnest(
+      CAST(:filetypes AS VARCHAR[]), CAST(:object_keys AS VARCHAR[]), CAST(:content_hashes AS CHAR(64)[])
+    )
+    ON CONFLICT (CONTENT_HASH, FILETYPE) WHERE CONTENT_HASH IS NOT NULL
+    DO UPDATE SET REF_COUNT = FILERECORDS.REF_COUNT + 1
+    RETURNING FILE_ID, FILETYPE, OBJECT_KEY, CONTENT_HASH
+  ), dicom_files AS (
+    INSERT INTO DICOMFILES (DICOM_ID, FILE_ID)
+    SELECT d.DICOM_ID, f.FILE_ID FROM new_dicom d CROSS JOIN new_files f
+  ), patient_dicoms AS (
+    INSERT INTO PATIENTDICOMS (PATIENT_ID, DICOM_ID)
+    SELECT CAST(:aid AS INT), DICOM_ID FROM new_dicom
+  ), patient_files AS (
+    INSERT INTO PATIENTFILES (FILE_ID, AID)
+    SELECT FILE_ID, CAST(:aid AS INT) FROM new_files
+    ON CONFLICT DO NOTHING
+  ), derivatives AS (
+    INSERT INTO STORAGE_OUTBOX (KIND, PAYLOAD, NEXT_ATTEMPT_AT)
+    SELECT 'derivatives',
+      jsonb_build_object('dicom_id', d.DICOM_ID, 'files', jsonb_agg(jsonb_build_array(f.FILE_ID, f.FILETYPE, f.OBJECT_KEY))),
+      NOW() + make_interval(secs => CAST(:outbox_delay AS DOUBLE PRECISION))
+    FROM new_dicom d CROSS JOIN new_files f
+    GROUP BY d.DICOM_ID
+    RETURNING OUTBOX_ID
+  )
+  SELECT d.DICOM_ID, d.CREATED_AT, o.OUTBOX_ID, f.FILE_ID, f.FILETYPE, f.OBJECT_KEY, f.CONTENT_HASH
+  FROM new_dicom d CROSS JOIN derivatives o CROSS JOIN new_files f
+""")
+
+
+async def known_content(session: AsyncSession, content_hashes: Iterable[str]) -> Set[str]:
+  """Content hashes that already have a FILERECORDS row, in one query."""
+  content_hashes = list(set(content_hashes))
+  if not content_hashes:
+    return set()
+  result = await session.execute(
+    text("SELECT DISTINCT CONTENT_HASH FROM FILERECORDS WHERE CONTENT_HASH = ANY(CAST(:hashes AS CHAR(64)[]))").bindparams(
+      hashes=content_hashes)
+  )
+  return {row[0] for row in result}
+
+
+async def owned_content(session: AsyncSession, aid: int, content_hashes: Iterable[str]) -> Set[str]:
+  """
+  Content hashes the caller already holds through PATIENTFILES. Only these
+  may be linked without sending the bytes: knowing a hash proves nothing.
+  """
+  content_hashes = list(set(content_hashes))
+  if not content_hashes:
+    return set()
+  result = await session.execute(
+    text("""
+      SELECT DISTINCT f.CONTENT_HASH
+      FROM FILERECORDS f
+      JOIN PATIENTFILES pf ON pf.FILE_ID = f.FILE_ID
+      WHERE pf.AID = :aid AND f.CONTENT_HASH = ANY(CAST(:hashes AS CHAR(64)[]))
+    """).bindparams(aid=aid, hashes=content_hashes)
+  )
+  return {row[0] for row in result}
+
+
+async def insert_accession(
+  session: AsyncSession,
+  aid: int,
+  dicom_name: str,
+  files: List[Tuple[str, str, Optional[str]]],
+  agaston_score: Optional[int] = None,
+  outbox_delay: float = 0,
+) -> Tuple[int, datetime, List[dict], int]:
+  """
+  Write DICOMS, PATIENT_STATS, FILERECORDS, DICOMFILES, PATIENTDICOMS and
+  PATIENTFILES rows for a series of (filetype, object_key, content_hash)
+  files, and the outbox row of its derivatives (due after `outbox_delay`
+  seconds), in one statement. Does not commit.
+  Returns (dicom_id, created_at, file rows, outbox id).
+  """
+  if not files:
+    raise ValueError("An accession needs at least one file")
+  # the same content twice in one series is stored and linked once
+  unique, seen = [], set()
+  for filetype, object_key, content_hash in files:
+    if content_hash is not None:
+      if (filetype, content_hash) in seen:
+        continue
+      seen.add((filetype, content_hash))
+    unique.append((filetype, object_key, content_hash))
+  result = await session.execute(
+    INSERT_ACCESSION.bindparams(
+      aid=aid,
+      dicom_name=dicom_name,
+      agaston_score=agaston_score,
+      filetypes=[filetype for filetype, _, _ in unique],
+      object_keys=[object_key for _, object_key, _ in unique],
+      content_hashes=[content_hash for _, _, content_hash in unique],
+      outbox_delay=outbox_delay,
+    )
+  )
+  rows = result.mappings().all()
+  return rows[0]["dicom_id"], rows[0]["created_at"], [dict(row) for row in rows], rows[0]["outbox_id"]
+
+
+SESSIONS_PAGE_SIZE = 100
+MAX_SESSIONS_PAGE = 500
+
+
+class AccessionRow(NamedTuple):
+  dicom_id: int
+  dicom_name: str
+  created_at: Optional[datetime]
+  agaston_score: Optional[int]
+  slices: int
+  masks: int
+
+
+class AccessionFileRow(NamedTuple):
+  dicom_name: str
+  created_at: Optional[datetime]
+  filetype: str
+  object_key: str
+  agaston_score: Optional[int]
+
+
+# the listing is two fixed statements, first page and after a cursor, so
+# both stay prepared; absent filters bind NULL and drop out
+_SESSIONS_SQL = """
+  SELECT s.DICOM_ID, s.DICOM_NAME, s.CREATED_AT, s.AGASTON_SCORE, s.SLICES, s.MASKS
+  FROM ACCESSIONSUMMARY s
+  WHERE s.PATIENT_ID = :aid
+    AND s.CREATED_AT >= COALESCE(CAST(:created_from AS TIMESTAMP), '-infinity')
+    AND s.CREATED_AT < COALESCE(CAST(:created_to AS TIMESTAMP), 'infinity')
+    AND (CAST(:name AS VARCHAR) IS NULL OR s.DICOM_NAME ILIKE CAST(:name AS VARCHAR)){after}
+  ORDER BY s.CREATED_AT DESC, s.DICOM_ID DESC
+  LIMIT :limit
+"""
+SESSIONS_FIRST_PAGE = register("sessions_first_page", _SESSIONS_SQL.format(after=""), AccessionRow)
+SESSIONS_NEXT_PAGE = register("sessions_next_page", _SESSIONS_SQL.format(after="""
+    AND (s.CREATED_AT, s.DICOM_ID) < (CAST(:after_created_at AS TIMESTAMP), CAST(:after_dicom_id AS INT))"""
+), AccessionRow)
+
+ACCESSION_FILES = register(
+  "accession_files",
+  "SELECT DICOM_NAME, CREATED_AT, FILETYPE, OBJECT_KEY, AGASTON_SCORE FROM get_accession(:aid, :dicom_id)",
+  AccessionFileRow,
+)
+
+
+def encode_cursor(created_at: datetime, dicom_id: int) -> str:
+  """Opaque cursor pointing just past an accession in listing order."""
+  return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{dicom_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+  try:
+    created_at, _, dicom_id = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().partition("|")
+    return datetime.fromisoformat(created_at), int(dicom_id)
+  except ValueError:
+    raise ValueError("Malformed cursor")
+
+
+def _naive_utc(value: datetime) -> datetime:
+  # CREATED_AT is a TIMESTAMP without time zone, written by NOW() in UTC
+  return value if value.tzinfo is None else value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+async def list_accessions(
+  session: AsyncSession,
+  aid: int,
+  limit: int = SESSIONS_PAGE_SIZE,
+  cursor: Optional[str] = None,
+  created_from: Optional[datetime] = None,
+  created_to: Optional[datetime] = None,
+  name: Optional[str] = None,
+) -> Tuple[List[AccessionRow], Optional[str]]:
+  """
+  One page of the caller's accessions, newest first, from ACCESSIONSUMMARY
+  only: no file row is read, and the (PATIENT_ID, CREATED_AT, DICOM_ID)
+  index walks straight to the page, so a page costs the same however long
+  the history. `name` matches a substring, case-insensitively.
+  Returns (rows, cursor of the next page or None on the last page).
+  Raises ValueError on a bad limit or cursor.
+  """
+  if limit < 1:
+    raise ValueError("limit must be positive")
+  limit = min(limit, MAX_SESSIONS_PAGE)
+  params = {
+    "aid": aid,
+    "limit": limit + 1,
+    "created_from": _naive_utc(created_from) if created_from is not None else None,
+    "created_to": _naive_utc(created_to) if created_to is not None else None,
+    "name": "%" + name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%" if name else None,
+  }
+  query = SESSIONS_FIRST_PAGE
+  if cursor:
+    params["after_created_at"], params["after_dicom_id"] = decode_cursor(cursor)
+    query = SESSIONS_NEXT_PAGE
+  rows = await fetch(session, query, **params)
+  if len(rows) <= limit:
+    return rows, None
+  last = rows[limit - 1]
+  return rows[:limit], encode_cursor(last.created_at, last.dicom_id)
+
+
+async def accession_files(session: AsyncSession, aid: int, dicom_id: int) -> List[AccessionFileRow]:
+  """Files of an accession the caller owns, with the accession's fields repeated on each."""
+  return await fetch(session, ACCESSION_FILES, aid=aid, dicom_id=dicom_id)
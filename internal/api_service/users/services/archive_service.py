@@ -0,0 +1,206 @@
+import asyncio
+import os
+import posixpath
+import tempfile
+import zipfile
+from io import BytesIO
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional, Tuple
+
+import pydicom
+
+from cloud_services import run_s3, MB
+from db_service.models.py_models import RejectedFile
+
+# members expanded and uploaded together; bounds the spooled bytes in flight
+EXPAND_BATCH = 32
+# members larger than this (uncompressed) are refused, which also stops zip bombs
+MAX_MEMBER_BYTES = int(os.getenv("MAX_ARCHIVE_MEMBER_BYTES", str(1024 * MB)))
+# whole-archive limits, checked against the central directory before anything
+# is inflated (zipfile never inflates a member past its declared size)
+MAX_ARCHIVE_MEMBERS = int(os.getenv("MAX_ARCHIVE_MEMBERS", "20000"))
+MAX_ARCHIVE_TOTAL_BYTES = int(os.getenv("MAX_ARCHIVE_TOTAL_BYTES", str(16 * 1024 * MB)))
+# members are spooled in memory up to this size, then to disk
+SPOOL_BYTES = 8 * MB
+# DICOM part 10 files: 128 byte preamble, then "DICM"
+DICOM_PREFIX = 132
+IMAGE_MAGIC = (b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff", b"II*\x00", b"MM\x00*", b"BM")
+# folders whose members are masks (the layout of /user/export archives)
+MASK_FOLDERS = {"mask", "masks"}
+# members that are part of an archive's packaging, never data
+SKIPPED_NAMES = {"manifest.json", ".ds_store", "thumbs.db"}
+MEDIA_STORAGE_DIRECTORY = "1.2.840.10008.1.3.10"
+
+
+class ArchiveError(Exception):
+  pass
+
+
+def _filetype(name: str) -> str:
+  folders = {part.lower() for part in posixpath.dirname(name).split("/")}
+  return "mask" if folders & MASK_FOLDERS else "slice"
+
+
+def _skipped(name: str) -> bool:
+  base = posixpath.basename(name).lower()
+  return not base or base in SKIPPED_NAMES or name.startswith("__MACOSX/") or base.startswith("._")
+
+
+def _dicomdir_members(archive: zipfile.ZipFile, infos: List[zipfile.ZipInfo]) -> Optional[List[zipfile.ZipInfo]]:
+  """
+  Files referenced by a DICOMDIR in the archive, or None when there is no
+  DICOMDIR. Referenced IDs are matched case-insensitively, relative to the
+  DICOMDIR's own folder.
+  """
+  dicomdirs = [info for info in infos if posixpath.basename(info.filename).upper() == "DICOMDIR"]
+  if not dicomdirs:
+    return None
+  by_name = {info.filename.upper(): info for info in infos}
+  referenced: Dict[str, zipfile.ZipInfo] = {}
+  for dicomdir in dicomdirs:
+    if dicomdir.file_size > MAX_MEMBER_BYTES:
+      raise ArchiveError("DICOMDIR is too large")
+    try:
+      ds = pydicom.dcmread(BytesIO(archive.read(dicomdir)), force=True)
+    except Exception as e:
+      raise ArchiveError(f"Unreadable DICOMDIR: {e}")
+    root = posixpath.dirname(dicomdir.filename)
+    for record in ds.get("DirectoryRecordSequence", []):
+      file_id = record.get("ReferencedFileID")
+      if not file_id:
+        continue
+      parts = [file_id] if isinstance(file_id, str) else list(file_id)
+      info = by_name.get(posixpath.join(root, *parts).upper())
+      if info is not None:
+        referenced[info.filename] = info
+  return list(referenced.values())
+
+
+def plan_members(archive: zipfile.ZipFile) -> Tuple[List[Tuple[zipfile.ZipInfo, str]], List[RejectedFile]]:
+  """(member, filetype) pairs to ingest, and the members refused up front."""
+  infos = [info for info in archive.infolist() if not info.is_dir() and not _skipped(info.filename)]
+  rejected: List[RejectedFile] = []
+  referenced = _dicomdir_members(archive, infos)
+  if referenced is not None:
+    # a DICOMDIR says exactly which files form the study; masks sit beside it
+    referenced_names = {info.filename for info in referenced}
+    infos = referenced + [
+      info for info in infos if _filetype(info.filename) == "mask" and info.filename not in referenced_names
+    ]
+  members = []
+  for info in infos:
+    if info.file_size > MAX_MEMBER_BYTES:
+      rejected.append(RejectedFile(filename=info.filename, reason="member is too large"))
+    else:
+      members.append((info, _filetype(info.filename)))
+  return members, rejected
+
+
+def _valid_prefix(head: bytes, filetype: str) -> Optional[str]:
+  """None when the leading bytes look right, otherwise why the member is refused."""
+  if head[128:132] == b"DICM":
+    return None
+  if filetype == "mask" and head.startswith(IMAGE_MAGIC):
+    return None
+  return "not a DICOM file" if filetype == "slice" else "not a DICOM file or image"
+
+
+def _is_directory_file(spool: BinaryIO) -> bool:
+  try:
+    spool.seek(0)
+    ds = pydicom.dcmread(spool, stop_before_pixels=True, specific_tags=["SOPClassUID"])
+    return str(ds.file_meta.get("MediaStorageSOPClassUID", "")) == MEDIA_STORAGE_DIRECTORY
+  except Exception:
+    return False
+  finally:
+    spool.seek(0)
+
+
+def extract_member(archive: zipfile.ZipFile, info: zipfile.ZipInfo, filetype: str) -> Tuple[Optional[BinaryIO], Optional[str]]:
+  """
+  Decompress one member into a spooled file. Only the first bytes are
+  inflated before the member is checked, so a non-DICOM member costs next
+  to nothing. Returns (spooled file, None) or (None, rejection reason).
+  """
+  with archive.open(info) as member:
+    head = member.read(DICOM_PREFIX)
+    reason = _valid_prefix(head, filetype)
+    if reason is not None:
+      return None, reason
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+    spool.write(head)
+    copied = len(head)
+    while chunk := member.read(MB):
+      copied += len(chunk)
+      if copied > MAX_MEMBER_BYTES:
+        spool.close()
+        return None, "member is too large"
+      spool.write(chunk)
+  if head[128:132] == b"DICM" and _is_directory_file(spool):
+    spool.close()
+    return None, "DICOMDIR index, not an image"
+  spool.seek(0)
+  return spool, None
+
+
+def check_limits(archive: zipfile.ZipFile) -> None:
+  """Refuse an archive whose central directory lists too many members or too many bytes."""
+  infos = archive.infolist()
+  if len(infos) > MAX_ARCHIVE_MEMBERS:
+    raise ArchiveError(f"The archive holds {len(infos)} members, at most {MAX_ARCHIVE_MEMBERS} are accepted")
+  total = sum(info.file_size for info in infos)
+  if total > MAX_ARCHIVE_TOTAL_BYTES:
+    raise ArchiveError(f"The archive expands to {total} bytes, at most {MAX_ARCHIVE_TOTAL_BYTES} are accepted")
+
+
+def open_archive(fileobj: BinaryIO) -> zipfile.ZipFile:
+  try:
+    fileobj.seek(0)
+    archive = zipfile.ZipFile(fileobj)
+  except (zipfile.BadZipFile, OSError) as e:
+    raise ArchiveError(f"Not a ZIP archive: {e}")
+  try:
+    check_limits(archive)
+  except ArchiveError:
+    archive.close()
+    raise
+  return archive
+
+
+async def expand_archive(
+  fileobj: BinaryIO, batch: int = EXPAND_BATCH
+) -> AsyncIterator[Tuple[List[Tuple[str, str, BinaryIO]], List[RejectedFile]]]:
+  """
+  Yield batches of accepted (member name, filetype, spooled file) and the
+  members rejected along the way. Members of a batch are decompressed in
+  parallel on the worker threads (zlib releases the GIL); the caller owns
+  and must close the spooled files.
+  """
+  archive = await run_s3(open_archive, fileobj)
+  try:
+    members, rejected = await run_s3(plan_members, archive)
+    if rejected:
+      yield [], rejected
+    for i in range(0, len(members), batch):
+      chunk = members[i:i + batch]
+      results = await asyncio.gather(
+        *(run_s3(extract_member, archive, info, filetype) for info, filetype in chunk),
+        return_exceptions=True
+      )
+      accepted, refused = [], []
+      for (info, filetype), result in zip(chunk, results):
+        if isinstance(result, BaseException):
+          refused.append(RejectedFile(filename=info.filename, reason=f"could not be decompressed: {result}"))
+          continue
+        spool, reason = result
+        if spool is None:
+          refused.append(RejectedFile(filename=info.filename, reason=reason))
+        else:
+          accepted.append((info.filename, filetype, spool))
+      yield accepted, refused
+  finally:
+    archive.close()
+
+
+def member_filename(name: str) -> str:
+  """Object-key friendly name of a member: its path with folders joined by '_'."""
+  return name.strip("/").replace("/", "_")
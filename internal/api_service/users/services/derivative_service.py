@@ -0,0 +1,231 @@
+import asyncio
+import json
+from io import BytesIO
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pydicom
+from PIL import Image
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from cloud_services import run_s3
+from db_service.utils.query_registry import fetch, register
+from workers import run_cpu, CPU_WORKERS
+
+# longest side, in pixels, of each preview level
+PREVIEW_LEVELS = {"thumb": 64, "128": 128, "256": 256}
+JPEG_QUALITY = 85
+CONTENT_TYPES = {"jpg": "image/jpeg", "png": "image/png"}
+# window used when a CT slice carries none (mediastinal window, HU)
+DEFAULT_CT_WINDOW = (40.0, 400.0)
+# files decoded at once; bounds the original bytes held in memory
+FILES_IN_FLIGHT = 2 * CPU_WORKERS
+# previews are recorded in batches so they show up while a series is processed
+INSERT_BATCH = 64
+
+
+def preview_key(file_id: int, level: str, extension: str) -> str:
+  return f"/Dicoms/previews/{file_id}/{level}.{extension}"
+
+
+def _first(value) -> Optional[float]:
+  if value is None:
+    return None
+  if isinstance(value, pydicom.multival.MultiValue):
+    value = value[0] if len(value) else None
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return None
+
+
+def _window(ds, pixels: np.ndarray) -> np.ndarray:
+  """Rescale to modality units, apply the slice's VOI window and return uint8."""
+  pixels = pixels.astype(np.float32)
+  pixels = pixels * float(ds.get("RescaleSlope", 1) or 1) + float(ds.get("RescaleIntercept", 0) or 0)
+  center, width = _first(ds.get("WindowCenter")), _first(ds.get("WindowWidth"))
+  if center is None or not width:
+    if ds.get("Modality") == "CT":
+      center, width = DEFAULT_CT_WINDOW
+    else:
+      low, high = float(pixels.min()), float(pixels.max())
+      center, width = (low + high) / 2, max(high - low, 1.0)
+  lower = center - width / 2
+  image = np.clip((pixels - lower) / width * 255.0, 0, 255).astype(np.uint8)
+  if ds.get("PhotometricInterpretation") == "MONOCHROME1":
+    image = 255 - image
+  return image
+
+
+def _mask_levels(pixels: np.ndarray) -> np.ndarray:
+  """Label maps (0/1 or small integers) stretched to the full 8-bit range."""
+  pixels = np.asarray(pixels)
+  high = int(pixels.max()) if pixels.size else 0
+  if pixels.dtype == np.uint8 and high > 1:
+    return pixels
+  scale = 255 // high if 0 < high <= 255 else 1
+  return np.clip(pixels.astype(np.int64) * scale, 0, 255).astype(np.uint8)
+
+
+def _decode(data: bytes, filetype: str) -> Optional[Image.Image]:
+  try:
+    ds = pydicom.dcmread(BytesIO(data), force=True)
+    pixels = ds.pixel_array
+  except Exception:
+    ds, pixels = None, None
+  if pixels is not None:
+    if pixels.ndim == 3 and ds.get("SamplesPerPixel", 1) == 1:
+      pixels = pixels[pixels.shape[0] // 2]  # multi-frame: middle frame
+    if pixels.ndim == 3:
+      return Image.fromarray(pixels.astype(np.uint8)).convert("L")
+    return Image.fromarray(_mask_levels(pixels) if filetype == "mask" else _window(ds, pixels))
+  # masks may also arrive as ordinary images
+  try:
+    image = Image.open(BytesIO(data))
+    image.load()
+  except Exception:
+    return None
+  image = image.convert("L")
+  return Image.fromarray(_mask_levels(np.asarray(image))) if filetype == "mask" else image
+
+
+def render_previews(data: bytes, filetype: str = "slice") -> Dict[str, Tuple[bytes, str, int, int]]:
+  """
+  Windowed 8-bit previews of one slice or mask, one per PREVIEW_LEVELS entry,
+  as {level: (encoded bytes, extension, width, height)}. Slices are JPEG;
+  masks are PNG, resized with nearest neighbour so labels stay crisp.
+  Returns {} when the file has no decodable image.
+  """
+  image = _decode(data, filetype)
+  if image is None:
+    return {}
+  previews = {}
+  # largest first, each level is resampled from the one above it
+  for level, size in sorted(PREVIEW_LEVELS.items(), key=lambda item: -item[1]):
+    scale = size / max(image.size)
+    if scale < 1:
+      resample = Image.NEAREST if filetype == "mask" else Image.LANCZOS
+      image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), resample)
+    out = BytesIO()
+    if filetype == "mask":
+      image.save(out, format="PNG", optimize=True)
+      extension = "png"
+    else:
+      image.save(out, format="JPEG", quality=JPEG_QUALITY)
+      extension = "jpg"
+    previews[level] = (out.getvalue(), extension, image.width, image.height)
+  return previews
+
+
+async def _previewed(session: AsyncSession, file_ids: List[int]) -> set:
+  result = await session.execute(
+    text("""
+      SELECT FILE_ID FROM FILEPREVIEWS WHERE FILE_ID = ANY(CAST(:file_ids AS INT[]))
+      GROUP BY FILE_ID HAVING COUNT(*) >= :levels
+    """).bindparams(file_ids=file_ids, levels=len(PREVIEW_LEVELS))
+  )
+  return {row[0] for row in result}
+
+
+async def _insert_previews(session: AsyncSession, rows: List[dict]) -> None:
+  if not rows:
+    return
+  await session.execute(
+    text("""
+      INSERT INTO FILEPREVIEWS (FILE_ID, LEVEL, OBJECT_KEY, CONTENT_TYPE, WIDTH, HEIGHT, SIZE_BYTES)
+      SELECT * FROM jsonb_to_recordset(CAST(:rows AS JSONB)) AS p(
+        file_id INT, level VARCHAR, object_key VARCHAR, content_type VARCHAR, width INT, height INT, size_bytes INT
+      )
+      ON CONFLICT (FILE_ID, LEVEL) DO NOTHING
+    """).bindparams(rows=json.dumps(rows))
+  )
+  await session.commit()
+
+
+def _get_object(client, bucket: str, key: str) -> bytes:
+  return client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+
+async def _preview_file(client, bucket: str, file_id: int, filetype: str, object_key: str, slots: asyncio.Semaphore) -> List[dict]:
+  async with slots:
+    data = await run_s3(_get_object, client, bucket, object_key)
+    previews = await run_cpu(render_previews, data, filetype)
+    del data
+  rows = [
+    {
+      "file_id": file_id, "level": level, "object_key": preview_key(file_id, level, extension),
+      "content_type": CONTENT_TYPES[extension], "width": width, "height": height, "size_bytes": len(body),
+    }
+    for level, (body, extension, width, height) in previews.items()
+  ]
+  await asyncio.gather(*(
+    run_s3(
+      client.put_object, Bucket=bucket, Key=row["object_key"], Body=previews[row["level"]][0],
+      ContentType=row["content_type"], CacheControl="private, max-age=31536000, immutable"
+    )
+    for row in rows
+  ))
+  return rows
+
+
+async def generate_previews(
+  sessionmaker: async_sessionmaker,
+  client,
+  bucket: str,
+  files: Iterable[Tuple[int, str, str]],
+) -> None:
+  """
+  Build the preview pyramid for (file_id, filetype, object_key) files that
+  do not have one yet; shared (deduplicated) files are rendered only once.
+  Runs after the response is sent: originals are read back from S3, decoded
+  in the CPU process pool and the previews written next to them.
+  """
+  files = list({file_id: (file_id, filetype, key) for file_id, filetype, key in files if file_id is not None}.values())
+  if not files:
+    return
+  async with sessionmaker() as session:
+    done = await _previewed(session, [file_id for file_id, _, _ in files])
+    await session.rollback()
+    todo = [file for file in files if file[0] not in done]
+    slots = asyncio.Semaphore(FILES_IN_FLIGHT)
+    for i in range(0, len(todo), INSERT_BATCH):
+      results = await asyncio.gather(
+        *(_preview_file(client, bucket, *file, slots) for file in todo[i:i + INSERT_BATCH]),
+        return_exceptions=True
+      )
+      rows = []
+      for file, result in zip(todo[i:i + INSERT_BATCH], results):
+        if isinstance(result, BaseException):
+          print(f"failed to build previews for file {file[0]}: {result}")
+        else:
+          rows.extend(result)
+      await _insert_previews(session, rows)
+
+
+class PreviewRow(NamedTuple):
+  source_key: str
+  level: str
+  object_key: str
+  content_type: str
+  width: int
+  height: int
+  size_bytes: int
+
+
+ACCESSION_PREVIEWS = register("accession_previews", """
+  SELECT f.OBJECT_KEY AS SOURCE_KEY, p.LEVEL, p.OBJECT_KEY, p.CONTENT_TYPE, p.WIDTH, p.HEIGHT, p.SIZE_BYTES
+  FROM DICOMFILES df
+  JOIN FILERECORDS f ON f.FILE_ID = df.FILE_ID
+  JOIN FILEPREVIEWS p ON p.FILE_ID = df.FILE_ID
+  WHERE df.DICOM_ID = :dicom_id
+  ORDER BY f.OBJECT_KEY, p.WIDTH, p.LEVEL
+""", PreviewRow)
+
+
+async def previews_for_accession(session: AsyncSession, dicom_id: int) -> Dict[str, List[PreviewRow]]:
+  """Previews of every file in an accession, keyed by the original's object key, smallest first."""
+  previews: Dict[str, List[PreviewRow]] = {}
+  for row in await fetch(session, ACCESSION_PREVIEWS, dicom_id=dicom_id):
+    previews.setdefault(row.source_key, []).append(row)
+  return previews
@@ -0,0 +1,138 @@
+import asyncio
+from io import BytesIO
+from typing import List, Optional, Sequence
+
+import pydicom
+
+from cloud_services import run_s3
+from db_service.models.py_models import FileUploadOutcome
+from workers import run_cpu
+
+# headers sit in front of the pixel data; 64 KiB covers them for nearly every
+# CT slice, anything longer is read in full
+HEADER_BYTES = 64 * 1024
+# (7FE0,0010) PixelData, as it appears in little endian files
+PIXEL_DATA_TAG = b"\xe0\x7f\x10\x00"
+# files handed to one worker process per call
+PARSE_BATCH = 64
+
+
+def header_complete(head: bytes, size: int) -> bool:
+  """Whether `head` holds every header element of a file of `size` bytes."""
+  return len(head) >= size or PIXEL_DATA_TAG in head
+
+
+def read_head(fileobj, size: int = HEADER_BYTES) -> bytes:
+  fileobj.seek(0)
+  head = fileobj.read(size)
+  fileobj.seek(0)
+  return head
+
+
+def _fetch_head(client, bucket: str, key: str) -> bytes:
+  response = client.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{HEADER_BYTES - 1}")
+  head = response["Body"].read()
+  total = int(response.get("ContentRange", "").rsplit("/", 1)[-1] or len(head))
+  if header_complete(head, total):
+    return head
+  return client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+
+def _number(value, cast=float):
+  try:
+    return cast(value) if value not in (None, "") else None
+  except (TypeError, ValueError):
+    return None
+
+
+def _numbers(value, n: int) -> Optional[List[float]]:
+  try:
+    values = [float(v) for v in value]
+  except (TypeError, ValueError):
+    return None
+  return values if len(values) == n else None
+
+
+def _text(value, max_length: int = 64) -> Optional[str]:
+  return str(value)[:max_length] if value not in (None, "") else None
+
+
+def _study_date(value) -> Optional[str]:
+  value = str(value or "")
+  return f"{value[:4]}-{value[4:6]}-{value[6:8]}" if len(value) == 8 and value.isdigit() else None
+
+
+def parse_header(data: bytes) -> Optional[dict]:
+  """
+  Indexed attributes of one DICOM file, without touching its pixel data.
+  Returns None for anything that is not a DICOM instance (e.g. PNG masks).
+  """
+  try:
+    ds = pydicom.dcmread(BytesIO(data), stop_before_pixels=True, force=True)
+  except Exception:
+    # force=True reads whatever it is given; a file that is not DICOM can
+    # fail in many ways and is simply not indexed
+    return None
+  if "SOPInstanceUID" not in ds and "SeriesInstanceUID" not in ds:
+    return None
+  meta = getattr(ds, "file_meta", None)
+  return {
+    "sop_instance_uid": _text(ds.get("SOPInstanceUID")),
+    "study_instance_uid": _text(ds.get("StudyInstanceUID")),
+    "series_instance_uid": _text(ds.get("SeriesInstanceUID")),
+    "modality": _text(ds.get("Modality"), 16),
+    "study_date": _study_date(ds.get("StudyDate")),
+    "series_description": _text(ds.get("SeriesDescription")),
+    "series_number": _number(ds.get("SeriesNumber"), int),
+    "instance_number": _number(ds.get("InstanceNumber"), int),
+    "slice_location": _number(ds.get("SliceLocation")),
+    "image_position": _numbers(ds.get("ImagePositionPatient"), 3),
+    "pixel_spacing": _numbers(ds.get("PixelSpacing"), 2),
+    "slice_thickness": _number(ds.get("SliceThickness")),
+    "rows": _number(ds.get("Rows"), int),
+    "columns": _number(ds.get("Columns"), int),
+    "transfer_syntax_uid": _text(meta.get("TransferSyntaxUID")) if meta is not None else None,
+  }
+
+
+async def fetch_header(client, bucket: str, key: str) -> Optional[dict]:
+  """Header of one stored file, range-read from S3; None when it cannot be read."""
+  try:
+    head = await run_s3(_fetch_head, client, bucket, key)
+    return await run_cpu(parse_header, head)
+  except Exception as e:
+    print(f"failed to read the header of {key}: {e}")
+    return None
+
+
+def parse_headers(blobs: List[Optional[bytes]]) -> List[Optional[dict]]:
+  return [parse_header(blob) if blob is not None else None for blob in blobs]
+
+
+async def load_headers(
+  client,
+  bucket: str,
+  outcomes: List[FileUploadOutcome],
+  heads: Optional[Sequence[Optional[bytes]]] = None,
+) -> List[Optional[dict]]:
+  """
+  Parse the header of every uploaded file, one result per outcome.
+  Leading bytes the caller already has are used as they are; files without
+  them (or whose header runs past them) are range-read from S3. Parsing runs
+  in the CPU process pool, in batches.
+  """
+  heads = list(heads) if heads is not None else [None] * len(outcomes)
+  missing = [
+    i for i, (outcome, head) in enumerate(zip(outcomes, heads))
+    if head is None or not header_complete(head, outcome.size)
+  ]
+  fetched = await asyncio.gather(
+    *(run_s3(_fetch_head, client, bucket, outcomes[i].object_key) for i in missing),
+    return_exceptions=True
+  )
+  for i, head in zip(missing, fetched):
+    heads[i] = head if isinstance(head, bytes) else None
+  batches = await asyncio.gather(*(
+    run_cpu(parse_headers, heads[i:i + PARSE_BATCH]) for i in range(0, len(heads), PARSE_BATCH)
+  ))
+  return [header for batch in batches for header in batch]
@@ -0,0 +1,132 @@
+import json
+import os
+import re
+import time
+import zipfile
+from typing import AsyncIterator, List
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cloud_services import run_s3
+
+# bytes pulled from S3 per read; the most the export holds per file
+STREAM_CHUNK = 1024 * 1024
+MANIFEST_NAME = "manifest.json"
+FOLDERS = {"slice": "slices", "mask": "masks"}
+
+
+class _Sink:
+  """Write-only file object zipfile writes into; the export drains it after every write."""
+
+  def __init__(self) -> None:
+    self.parts: List[bytes] = []
+
+  def write(self, data) -> int:
+    self.parts.append(bytes(data))
+    return len(data)
+
+  def flush(self) -> None:
+    pass
+
+  def drain(self) -> bytes:
+    data = b"".join(self.parts)
+    self.parts.clear()
+    return data
+
+
+async def export_files(session: AsyncSession, aid: int, dicom_id: int) -> List[dict]:
+  """Files of an accession the caller owns, slices in display order then masks, with their index entries."""
+  result = await session.execute(
+    text("""
+      SELECT d.DICOM_ID, d.DICOM_NAME, d.CREATED_AT, ps.AGASTON_SCORE,
+        f.FILE_ID, f.FILETYPE, f.OBJECT_KEY, f.CONTENT_HASH,
+        h.STUDY_INSTANCE_UID, h.SERIES_INSTANCE_UID, h.SOP_INSTANCE_UID, h.INSTANCE_NUMBER, h.SLICE_LOCATION
+      FROM PATIENTDICOMS pd
+      JOIN DICOMS d ON d.DICOM_ID = pd.DICOM_ID
+      LEFT JOIN PATIENT_STATS ps ON ps.STAT_ID = d.STAT_ID
+      JOIN DICOMFILES df ON df.DICOM_ID = pd.DICOM_ID
+      JOIN FILERECORDS f ON f.FILE_ID = df.FILE_ID
+      LEFT JOIN DICOMHEADERS h ON h.FILE_ID = df.FILE_ID
+      WHERE pd.PATIENT_ID = :aid AND pd.DICOM_ID = :dicom_id
+      ORDER BY f.FILETYPE = 'mask', h.SERIES_INSTANCE_UID, h.INSTANCE_NUMBER NULLS LAST,
+        h.SLICE_LOCATION NULLS LAST, f.FILE_ID
+    """).bindparams(aid=aid, dicom_id=dicom_id)
+  )
+  return [dict(row) for row in result.mappings()]
+
+
+def archive_name(dicom_name: str, dicom_id: int) -> str:
+  safe = re.sub(r"[^A-Za-z0-9._-]+", "_", dicom_name).strip("._") or "accession"
+  return f"{safe}_{dicom_id}.zip"
+
+
+def _entry_names(files: List[dict]) -> List[str]:
+  """slices/0001_<name>, masks/0001_<name>: display order is kept by the prefix."""
+  names, counters = [], {}
+  for file in files:
+    folder = FOLDERS.get(file["filetype"], file["filetype"])
+    counters[folder] = counters.get(folder, 0) + 1
+    basename = os.path.basename(file["object_key"].rstrip("/")) or f"file_{file['file_id']}"
+    names.append(f"{folder}/{counters[folder]:04d}_{basename}")
+  return names
+
+
+def _manifest(files: List[dict], names: List[str]) -> bytes:
+  first = files[0]
+  return json.dumps({
+    "dicom_id": first["dicom_id"],
+    "dicom_name": first["dicom_name"],
+    "created_at": first["created_at"].isoformat() if first["created_at"] else None,
+    "agaston_score": first["agaston_score"],
+    "files": [
+      {
+        "path": name,
+        "file_id": file["file_id"],
+        "type": file["filetype"],
+        "object_key": file["object_key"],
+        "sha256": file["content_hash"],
+        "study_instance_uid": file["study_instance_uid"],
+        "series_instance_uid": file["series_instance_uid"],
+        "sop_instance_uid": file["sop_instance_uid"],
+        "instance_number": file["instance_number"],
+      }
+      for file, name in zip(files, names)
+    ],
+  }, indent=2).encode("utf-8")
+
+
+async def stream_zip(client, bucket: str, files: List[dict]) -> AsyncIterator[bytes]:
+  """
+  A ZIP of the accession (manifest first, then every file) generated while
+  it is sent: each S3 object is copied in STREAM_CHUNK reads straight into
+  its entry, so memory stays flat however large the accession is.
+  Entries are stored, not deflated; pixel data barely compresses.
+  """
+  sink = _Sink()
+  names = _entry_names(files)
+  now = time.localtime(time.time())[:6]
+  with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+    manifest = zipfile.ZipInfo(MANIFEST_NAME, date_time=now)
+    manifest.compress_type = zipfile.ZIP_DEFLATED
+    archive.writestr(manifest, _manifest(files, names))
+    yield sink.drain()
+    for file, name in zip(files, names):
+      response = await run_s3(client.get_object, Bucket=bucket, Key=file["object_key"])
+      body = response["Body"]
+      info = zipfile.ZipInfo(name, date_time=now)
+      # a known size lets zipfile pick zip64 only where it is needed
+      info.file_size = response.get("ContentLength", 0)
+      try:
+        with archive.open(info, mode="w", force_zip64=info.file_size >= zipfile.ZIP64_LIMIT) as entry:
+          while True:
+            chunk = await run_s3(body.read, STREAM_CHUNK)
+            if not chunk:
+              break
+            entry.write(chunk)
+            yield sink.drain()
+      finally:
+        body.close()
+      yield sink.drain()
+  # central directory
+  yield sink.drain()
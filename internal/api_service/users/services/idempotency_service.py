@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import json
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+MAX_KEY_LENGTH = 255
+# a claim nobody has finished within this window is assumed to belong to a
+# worker that died, and the next request with the key takes it over
+STALE_CLAIM_SECONDS = 600
+# how long a repeat request waits for the first attempt before giving up
+WAIT_SECONDS = 60
+POLL_INTERVAL_SECONDS = 0.5
+
+
+class IdempotencyError(ValueError):
+  """Raised when an idempotency key cannot be used for this request."""
+
+
+class StillInProgress(IdempotencyError):
+  """Raised when the first request with a key has not finished in time."""
+
+
+def request_fingerprint(accession: str, filenames: List[str]) -> str:
+  """What a key is bound to: the accession form field and the file names, in order."""
+  payload = json.dumps({"accession": accession, "files": filenames}, separators=(",", ":"))
+  return hashlib.sha256(payload.encode()).hexdigest()
+
+
+async def claim_key(
+  session: AsyncSession, aid: int, key: str, fingerprint: str
+) -> Tuple[Optional[str], Optional[dict]]:
+  """
+  Claim `key` for this request and commit the claim, so concurrent requests
+  with the same key see it straight away.
+  Returns (claim token, None) when the caller owns the key and should do the
+  work, or (None, existing row) when another request already has it.
+  """
+  if not key or len(key) > MAX_KEY_LENGTH:
+    raise IdempotencyError(f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters")
+  result = await session.execute(
+    text("""
+      INSERT INTO IDEMPOTENCY_KEYS (AID, IDEMPOTENCY_KEY, REQUEST_HASH)
+      VALUES (:aid, :key, :fingerprint)
+      ON CONFLICT (AID, IDEMPOTENCY_KEY) DO UPDATE SET CLAIM_TOKEN = gen_random_uuid(), CLAIMED_AT = NOW()
+      WHERE IDEMPOTENCY_KEYS.STATUS = 'in_progress'
+        AND IDEMPOTENCY_KEYS.REQUEST_HASH = EXCLUDED.REQUEST_HASH
+        AND IDEMPOTENCY_KEYS.CLAIMED_AT < NOW() - make_interval(secs => :stale)
+      RETURNING CLAIM_TOKEN
+    """).bindparams(aid=aid, key=key, fingerprint=fingerprint, stale=STALE_CLAIM_SECONDS)
+  )
+  claimed = result.scalar()
+  await session.commit()
+  if claimed is not None:
+    return str(claimed), None
+  existing = await _get_key(session, aid, key)
+  if existing is None:
+    # the owner failed and released the key between our two statements
+    return await claim_key(session, aid, key, fingerprint)
+  if existing["request_hash"] != fingerprint:
+    raise IdempotencyError("Idempotency-Key was already used for a different request")
+  return None, existing
+
+
+async def _get_key(session: AsyncSession, aid: int, key: str) -> Optional[dict]:
+  result = await session.execute(
+    text("SELECT * FROM IDEMPOTENCY_KEYS WHERE AID = :aid AND IDEMPOTENCY_KEY = :key").bindparams(
+      aid=aid, key=key)
+  )
+  row = result.mappings().first()
+  # end the read so the next poll sees commits made since
+  await session.rollback()
+  return dict(row) if row is not None else None
+
+
+async def wait_for_result(session: AsyncSession, aid: int, key: str, existing: dict) -> Optional[dict]:
+  """
+  Wait for the request that owns `key` to finish.
+  Returns the stored response, or None if the owner failed and released
+  the key, in which case the caller may claim it again.
+  """
+  loop = asyncio.get_running_loop()
+  deadline = loop.time() + WAIT_SECONDS
+  while existing is not None and existing["status"] == "in_progress":
+    if loop.time() >= deadline:
+      raise StillInProgress("A request with this Idempotency-Key is still in progress")
+    await asyncio.sleep(POLL_INTERVAL_SECONDS)
+    existing = await _get_key(session, aid, key)
+  return existing["response"] if existing is not None else None
+
+
+async def save_result(session: AsyncSession, aid: int, key: str, token: str, response: dict) -> None:
+  """
+  Store the response inside the caller's transaction, so it commits with the
+  accession. Raises if the claim was lost, which rolls the accession back too.
+  """
+  result = await session.execute(
+    text("""
+      UPDATE IDEMPOTENCY_KEYS SET STATUS = 'complete', RESPONSE = CAST(:response AS JSONB), COMPLETED_AT = NOW()
+      WHERE AID = :aid AND IDEMPOTENCY_KEY = :key AND CLAIM_TOKEN = CAST(:token AS UUID)
+      RETURNING AID
+    """).bindparams(aid=aid, key=key, token=token, response=json.dumps(response))
+  )
+  if result.first() is None:
+    raise StillInProgress("Idempotency-Key was taken over by another request")
+
+
+async def release_key(session: AsyncSession, aid: int, key: str, token: str) -> None:
+  """Drop an unfinished claim after a failure so a retry runs the request again."""
+  try:
+    await session.execute(
+      text("""
+        DELETE FROM IDEMPOTENCY_KEYS
+        WHERE AID = :aid AND IDEMPOTENCY_KEY = :key AND CLAIM_TOKEN = CAST(:token AS UUID)
+          AND STATUS = 'in_progress'
+      """).bindparams(aid=aid, key=key, token=token)
+    )
+    await session.commit()
+  except Exception as e:
+    await session.rollback()
+    print(f"failed to release idempotency key {key}: {e}")
@@ -0,0 +1,168 @@
+import json
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_service.models.py_models import DicomInstance, DicomSeries, DicomStudy
+
+MAX_LIMIT = 1000
+
+# one statement per series: the parsed headers go in as a JSON array and
+# are unpacked server side
+INSERT_HEADERS = text("""
+  INSERT INTO DICOMHEADERS (
+    FILE_ID, SOP_INSTANCE_UID, STUDY_INSTANCE_UID, SERIES_INSTANCE_UID, MODALITY, STUDY_DATE,
+    SERIES_DESCRIPTION, SERIES_NUMBER, INSTANCE_NUMBER, SLICE_LOCATION, IMAGE_POSITION,
+    PIXEL_SPACING, SLICE_THICKNESS, ROWS, COLUMNS, TRANSFER_SYNTAX_UID
+  )
+  SELECT * FROM jsonb_to_recordset(CAST(:headers AS JSONB)) AS h(
+    file_id INT, sop_instance_uid VARCHAR, study_instance_uid VARCHAR, series_instance_uid VARCHAR,
+    modality VARCHAR, study_date DATE, series_description VARCHAR, series_number INT,
+    instance_number INT, slice_location DOUBLE PRECISION, image_position DOUBLE PRECISION[],
+    pixel_spacing DOUBLE PRECISION[], slice_thickness DOUBLE PRECISION, rows INT, columns INT,
+    transfer_syntax_uid VARCHAR
+  )
+  ON CONFLICT (FILE_ID) DO NOTHING
+""")
+
+# rows the caller may see: instances in accessions they own
+FROM_OWNED = """
+  FROM PATIENTDICOMS pd
+  JOIN DICOMFILES df ON df.DICOM_ID = pd.DICOM_ID
+  JOIN FILERECORDS f ON f.FILE_ID = df.FILE_ID
+  JOIN DICOMHEADERS h ON h.FILE_ID = df.FILE_ID
+  WHERE pd.PATIENT_ID = :aid
+"""
+
+# QIDO-RS attribute keyword -> column, for UID list / exact matching
+UID_FILTERS = {
+  "StudyInstanceUID": "h.STUDY_INSTANCE_UID",
+  "SeriesInstanceUID": "h.SERIES_INSTANCE_UID",
+  "SOPInstanceUID": "h.SOP_INSTANCE_UID",
+  "Modality": "h.MODALITY",
+}
+
+
+async def insert_headers(session: AsyncSession, headers: List[Tuple[int, dict]]) -> None:
+  """Index (file_id, parsed header) pairs. Shared files keep the row they already have. Does not commit."""
+  if not headers:
+    return
+  rows = [{"file_id": file_id, **header} for file_id, header in headers]
+  await session.execute(INSERT_HEADERS.bindparams(headers=json.dumps(rows)))
+
+
+def _date(value: str) -> str:
+  if len(value) != 8 or not value.isdigit():
+    raise ValueError(f"StudyDate must be YYYYMMDD or a YYYYMMDD-YYYYMMDD range, got {value!r}")
+  return f"{value[:4]}-{value[4:6]}-{value[6:8]}"
+
+
+def build_filters(filters: Dict[str, Optional[str]]) -> Tuple[str, dict]:
+  """
+  Turn QIDO-RS style query parameters into SQL conditions.
+  UIDs and Modality take comma separated lists, StudyDate takes a date or
+  a range (either end may be open), SeriesDescription takes * and ?
+  wildcards. Raises ValueError on malformed values.
+  """
+  clauses: List[str] = []
+  params: dict = {}
+  for keyword, column in UID_FILTERS.items():
+    value = filters.get(keyword)
+    if value:
+      params[keyword] = [v.strip() for v in value.split(",") if v.strip()]
+      clauses.append(f"{column} = ANY(CAST(:{keyword} AS VARCHAR[]))")
+  study_date = filters.get("StudyDate")
+  if study_date:
+    start, sep, end = study_date.partition("-")
+    if not sep:
+      end = start
+    if start:
+      params["date_from"] = _date(start)
+      clauses.append("h.STUDY_DATE >= CAST(:date_from AS DATE)")
+    if end:
+      params["date_to"] = _date(end)
+      clauses.append("h.STUDY_DATE <= CAST(:date_to AS DATE)")
+  description = filters.get("SeriesDescription")
+  if description:
+    escaped = description.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    params["description"] = escaped.replace("*", "%").replace("?", "_")
+    clauses.append("h.SERIES_DESCRIPTION LIKE :description")
+  instance_number = filters.get("InstanceNumber")
+  if instance_number:
+    try:
+      params["instance_number"] = int(instance_number)
+    except ValueError:
+      raise ValueError("InstanceNumber must be an integer")
+    clauses.append("h.INSTANCE_NUMBER = :instance_number")
+  dicom_id = filters.get("dicom_id")
+  if dicom_id is not None:
+    params["dicom_id"] = int(dicom_id)
+    clauses.append("pd.DICOM_ID = :dicom_id")
+  return "".join(f" AND {clause}" for clause in clauses), params
+
+
+def _page(limit: int, offset: int) -> dict:
+  if limit < 1 or offset < 0:
+    raise ValueError("limit must be positive and offset must not be negative")
+  return {"limit": min(limit, MAX_LIMIT), "offset": offset}
+
+
+async def search_instances(
+  session: AsyncSession, aid: int, filters: Dict[str, Optional[str]], limit: int = 100, offset: int = 0
+) -> List[DicomInstance]:
+  """Matching instances, in series then InstanceNumber / SliceLocation order."""
+  where, params = build_filters(filters)
+  result = await session.execute(
+    text(f"""
+      SELECT pd.DICOM_ID, f.FILE_ID, f.FILETYPE, f.OBJECT_KEY,
+        h.SOP_INSTANCE_UID, h.STUDY_INSTANCE_UID, h.SERIES_INSTANCE_UID, h.MODALITY, h.STUDY_DATE,
+        h.SERIES_DESCRIPTION, h.SERIES_NUMBER, h.INSTANCE_NUMBER, h.SLICE_LOCATION, h.IMAGE_POSITION,
+        h.PIXEL_SPACING, h.SLICE_THICKNESS, h.ROWS, h.COLUMNS, h.TRANSFER_SYNTAX_UID
+      {FROM_OWNED}{where}
+      ORDER BY h.STUDY_INSTANCE_UID, h.SERIES_INSTANCE_UID, h.INSTANCE_NUMBER NULLS LAST,
+        h.SLICE_LOCATION NULLS LAST, pd.DICOM_ID, f.FILE_ID
+      LIMIT :limit OFFSET :offset
+    """).bindparams(aid=aid, **params, **_page(limit, offset))
+  )
+  return [DicomInstance(**row) for row in result.mappings()]
+
+
+async def search_series(
+  session: AsyncSession, aid: int, filters: Dict[str, Optional[str]], limit: int = 100, offset: int = 0
+) -> List[DicomSeries]:
+  where, params = build_filters(filters)
+  result = await session.execute(
+    text(f"""
+      SELECT h.STUDY_INSTANCE_UID, h.SERIES_INSTANCE_UID,
+        MIN(h.MODALITY) AS MODALITY, MIN(h.SERIES_NUMBER) AS SERIES_NUMBER,
+        MIN(h.SERIES_DESCRIPTION) AS SERIES_DESCRIPTION,
+        COUNT(DISTINCT f.FILE_ID) AS NUMBER_OF_INSTANCES,
+        array_agg(DISTINCT pd.DICOM_ID) AS DICOM_IDS
+      {FROM_OWNED}{where}
+      GROUP BY h.STUDY_INSTANCE_UID, h.SERIES_INSTANCE_UID
+      ORDER BY h.STUDY_INSTANCE_UID, MIN(h.SERIES_NUMBER) NULLS LAST, h.SERIES_INSTANCE_UID
+      LIMIT :limit OFFSET :offset
+    """).bindparams(aid=aid, **params, **_page(limit, offset))
+  )
+  return [DicomSeries(**row) for row in result.mappings()]
+
+
+async def search_studies(
+  session: AsyncSession, aid: int, filters: Dict[str, Optional[str]], limit: int = 100, offset: int = 0
+) -> List[DicomStudy]:
+  where, params = build_filters(filters)
+  result = await session.execute(
+    text(f"""
+      SELECT h.STUDY_INSTANCE_UID, MIN(h.STUDY_DATE) AS STUDY_DATE,
+        array_remove(array_agg(DISTINCT h.MODALITY), NULL) AS MODALITIES,
+        COUNT(DISTINCT h.SERIES_INSTANCE_UID) AS NUMBER_OF_SERIES,
+        COUNT(DISTINCT f.FILE_ID) AS NUMBER_OF_INSTANCES,
+        array_agg(DISTINCT pd.DICOM_ID) AS DICOM_IDS
+      {FROM_OWNED}{where}
+      GROUP BY h.STUDY_INSTANCE_UID
+      ORDER BY MIN(h.STUDY_DATE) DESC NULLS LAST, h.STUDY_INSTANCE_UID
+      LIMIT :limit OFFSET :offset
+    """).bindparams(aid=aid, **params, **_page(limit, offset))
+  )
+  return [DicomStudy(**row) for row in result.mappings()]
@@ -0,0 +1,213 @@
+import asyncio
+import json
+from io import BytesIO
+from typing import Dict, List, Optional
+
+import numpy as np
+import pydicom
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from cloud_services import run_s3
+from workers import run_cpu, CPU_WORKERS
+
+# Histograms are in modality units (HU for CT): fixed HISTOGRAM_BINS bins of
+# BIN_WIDTH starting at HISTOGRAM_MIN; values outside land in the end bins,
+# so histograms of different slices and series add up bin by bin.
+HISTOGRAM_MIN = -1024
+BIN_WIDTH = 16
+HISTOGRAM_BINS = 256
+# Agatston scoring counts voxels at or above 130 HU as calcium
+CALCIUM_THRESHOLD = 130
+# slices decoded at once; bounds the original bytes held in memory
+FILES_IN_FLIGHT = 2 * CPU_WORKERS
+INSERT_BATCH = 64
+
+
+def slice_intensity(data: bytes) -> Optional[dict]:
+  """
+  Intensity statistics of one slice (every frame of a multi-frame file) in
+  modality units, in one vectorized pass. Returns None when the file has no
+  decodable grayscale pixels.
+  """
+  try:
+    ds = pydicom.dcmread(BytesIO(data), force=True)
+    pixels = ds.pixel_array
+  except Exception:
+    return None
+  if int(ds.get("SamplesPerPixel", 1)) != 1 or not pixels.size:
+    return None
+  slope = float(ds.get("RescaleSlope", 1) or 1)
+  intercept = float(ds.get("RescaleIntercept", 0) or 0)
+  values = pixels.astype(np.float32).ravel()
+  values *= slope
+  values += intercept
+  bins = np.floor_divide(values - HISTOGRAM_MIN, BIN_WIDTH)
+  np.clip(bins, 0, HISTOGRAM_BINS - 1, out=bins)
+  histogram = np.bincount(bins.astype(np.intp), minlength=HISTOGRAM_BINS)
+  return {
+    "hu_min": float(values.min()),
+    "hu_max": float(values.max()),
+    "hu_sum": float(values.sum(dtype=np.float64)),
+    "voxels": int(values.size),
+    "calcium_voxels": int(np.count_nonzero(values >= CALCIUM_THRESHOLD)),
+    "histogram": histogram.tolist(),
+  }
+
+
+def _get_object(client, bucket: str, key: str) -> bytes:
+  return client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+
+async def _slices_to_measure(session: AsyncSession, dicom_id: int) -> List[dict]:
+  result = await session.execute(
+    text("""
+      SELECT f.FILE_ID, f.OBJECT_KEY
+      FROM DICOMFILES df
+      JOIN FILERECORDS f ON f.FILE_ID = df.FILE_ID
+      WHERE df.DICOM_ID = :dicom_id AND f.FILETYPE = 'slice'
+        AND NOT EXISTS (SELECT 1 FROM SLICEINTENSITY s WHERE s.FILE_ID = f.FILE_ID)
+    """).bindparams(dicom_id=dicom_id)
+  )
+  return [dict(row) for row in result.mappings()]
+
+
+async def _measure(client, bucket: str, file: dict, slots: asyncio.Semaphore) -> Optional[dict]:
+  async with slots:
+    data = await run_s3(_get_object, client, bucket, file["object_key"])
+    stats = await run_cpu(slice_intensity, data)
+  return None if stats is None else {"file_id": file["file_id"], **stats}
+
+
+async def _insert_slices(session: AsyncSession, rows: List[dict]) -> None:
+  if not rows:
+    return
+  await session.execute(
+    text("""
+      INSERT INTO SLICEINTENSITY (FILE_ID, HU_MIN, HU_MAX, HU_SUM, VOXELS, CALCIUM_VOXELS, HISTOGRAM)
+      SELECT r.file_id, r.hu_min, r.hu_max, r.hu_sum, r.voxels, r.calcium_voxels,
+        ARRAY(SELECT CAST(v AS INT) FROM jsonb_array_elements_text(r.histogram) WITH ORDINALITY AS e(v, n) ORDER BY n)
+      FROM jsonb_to_recordset(CAST(:rows AS JSONB)) AS r(
+        file_id INT, hu_min DOUBLE PRECISION, hu_max DOUBLE PRECISION, hu_sum DOUBLE PRECISION,
+        voxels BIGINT, calcium_voxels BIGINT, histogram JSONB
+      )
+      ON CONFLICT (FILE_ID) DO NOTHING
+    """).bindparams(rows=json.dumps(rows))
+  )
+  await session.commit()
+
+
+async def slice_intensities(session: AsyncSession, dicom_id: int) -> List[dict]:
+  """Statistics of every measured slice of an accession with the header fields they are grouped by, in display order."""
+  result = await session.execute(
+    text("""
+      SELECT s.FILE_ID, f.OBJECT_KEY, h.SERIES_INSTANCE_UID, h.MODALITY, h.INSTANCE_NUMBER,
+        h.PIXEL_SPACING, h.SLICE_THICKNESS, s.HU_MIN, s.HU_MAX, s.HU_SUM, s.VOXELS, s.CALCIUM_VOXELS, s.HISTOGRAM
+      FROM DICOMFILES df
+      JOIN SLICEINTENSITY s ON s.FILE_ID = df.FILE_ID
+      JOIN FILERECORDS f ON f.FILE_ID = df.FILE_ID
+      LEFT JOIN DICOMHEADERS h ON h.FILE_ID = df.FILE_ID
+      WHERE df.DICOM_ID = :dicom_id
+      ORDER BY h.SERIES_INSTANCE_UID NULLS LAST, h.INSTANCE_NUMBER NULLS LAST, h.SLICE_LOCATION NULLS LAST, s.FILE_ID
+    """).bindparams(dicom_id=dicom_id)
+  )
+  return [dict(row) for row in result.mappings()]
+
+
+def summarize_series(slices: List[dict]) -> List[dict]:
+  """
+  Per-series totals of slice statistics: histograms added bin by bin, and
+  the calcium volume from each slice's pixel spacing and thickness (None
+  when a slice lacks them). Slices without a series UID form one group.
+  """
+  series: Dict[Optional[str], List[dict]] = {}
+  for row in slices:
+    series.setdefault(row["series_instance_uid"], []).append(row)
+  summaries = []
+  for series_uid, rows in series.items():
+    voxels = sum(row["voxels"] for row in rows)
+    calcium_volume = 0.0
+    for row in rows:
+      spacing, thickness = row["pixel_spacing"], row["slice_thickness"]
+      if not spacing or len(spacing) < 2 or not thickness:
+        calcium_volume = None
+        break
+      calcium_volume += row["calcium_voxels"] * spacing[0] * spacing[1] * thickness
+    summaries.append({
+      "series_instance_uid": series_uid,
+      "modality": next((row["modality"] for row in rows if row["modality"]), None),
+      "slices": len(rows),
+      "hu_min": min(row["hu_min"] for row in rows),
+      "hu_max": max(row["hu_max"] for row in rows),
+      "hu_mean": sum(row["hu_sum"] for row in rows) / voxels if voxels else None,
+      "voxels": voxels,
+      "calcium_voxels": sum(row["calcium_voxels"] for row in rows),
+      "calcium_volume_mm3": calcium_volume,
+      "histogram": np.sum([row["histogram"] for row in rows], axis=0, dtype=np.int64).tolist(),
+    })
+  return summaries
+
+
+async def _store_series(session: AsyncSession, dicom_id: int, summaries: List[dict]) -> None:
+  """Replace the accession's series rows, so series an update removed go too."""
+  await session.execute(
+    text("DELETE FROM SERIESINTENSITY WHERE DICOM_ID = :dicom_id").bindparams(dicom_id=dicom_id)
+  )
+  rows = [summary for summary in summaries if summary["series_instance_uid"] is not None]
+  if rows:
+    await session.execute(
+      text("""
+        INSERT INTO SERIESINTENSITY (
+          DICOM_ID, SERIES_INSTANCE_UID, MODALITY, SLICES, HU_MIN, HU_MAX, HU_MEAN, VOXELS,
+          CALCIUM_VOXELS, CALCIUM_VOLUME_MM3, HISTOGRAM
+        )
+        SELECT CAST(:dicom_id AS INT), r.series_instance_uid, r.modality, r.slices, r.hu_min, r.hu_max, r.hu_mean,
+          r.voxels, r.calcium_voxels, r.calcium_volume_mm3, ARRAY(
+            SELECT CAST(v AS BIGINT) FROM jsonb_array_elements_text(r.histogram) WITH ORDINALITY AS e(v, n) ORDER BY n
+          )
+        FROM jsonb_to_recordset(CAST(:rows AS JSONB)) AS r(
+          series_instance_uid VARCHAR, modality VARCHAR, slices INT, hu_min DOUBLE PRECISION,
+          hu_max DOUBLE PRECISION, hu_mean DOUBLE PRECISION, voxels BIGINT, calcium_voxels BIGINT,
+          calcium_volume_mm3 DOUBLE PRECISION, histogram JSONB
+        )
+      """).bindparams(dicom_id=dicom_id, rows=json.dumps(rows))
+    )
+  await session.commit()
+
+
+async def generate_intensity_stats(sessionmaker: async_sessionmaker, client, bucket: str, dicom_id: int) -> None:
+  """
+  Measure the accession's slices that have no statistics yet (shared files
+  are measured once), then total them per series. Runs after the response
+  is sent, before the slices are transcoded.
+  """
+  async with sessionmaker() as session:
+    todo = await _slices_to_measure(session, dicom_id)
+    await session.rollback()
+    slots = asyncio.Semaphore(FILES_IN_FLIGHT)
+    for i in range(0, len(todo), INSERT_BATCH):
+      batch = todo[i:i + INSERT_BATCH]
+      results = await asyncio.gather(*(_measure(client, bucket, file, slots) for file in batch), return_exceptions=True)
+      rows = []
+      for file, result in zip(batch, results):
+        if isinstance(result, BaseException):
+          print(f"failed to measure file {file['file_id']}: {result}")
+        elif result is not None:
+          rows.append(result)
+      await _insert_slices(session, rows)
+    await _store_series(session, dicom_id, summarize_series(await slice_intensities(session, dicom_id)))
+
+
+async def series_intensities(session: AsyncSession, aid: int, dicom_id: int) -> List[dict]:
+  """Stored per-series statistics of an accession the caller owns."""
+  result = await session.execute(
+    text("""
+      SELECT s.SERIES_INSTANCE_UID, s.MODALITY, s.SLICES, s.HU_MIN, s.HU_MAX, s.HU_MEAN, s.VOXELS,
+        s.CALCIUM_VOXELS, s.CALCIUM_VOLUME_MM3, s.HISTOGRAM
+      FROM SERIESINTENSITY s
+      JOIN PATIENTDICOMS pd ON pd.DICOM_ID = s.DICOM_ID
+      WHERE pd.PATIENT_ID = :aid AND s.DICOM_ID = :dicom_id
+      ORDER BY s.SERIES_INSTANCE_UID
+    """).bindparams(aid=aid, dicom_id=dicom_id)
+  )
+  return [dict(row) for row in result.mappings()]
@@ -0,0 +1,192 @@
+import asyncio
+import hashlib
+import struct
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pydicom
+from PIL import Image
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cloud_services import run_s3
+from workers import run_cpu
+
+# Mask stack layout (little endian):
+#   preamble   MAGIC, format version, slice count
+#   index      one INDEX_DTYPE entry per slice: encoding, rows, columns,
+#              payload offset and length
+#   payload    each slice encoded on its own, whichever is smaller of
+#              bit-packed pixels or alternating background/foreground runs
+# Masks are stored as foreground (> 0) / background.
+MAGIC = b"PMSK"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("<4sHI")
+INDEX_DTYPE = np.dtype([("encoding", "u1"), ("rows", "<u4"), ("columns", "<u4"), ("offset", "<u8"), ("length", "<u8")])
+EMPTY, BITPACKED, RUNS16, RUNS32 = 0, 1, 2, 3
+CONTENT_TYPE = "application/vnd.pulseimaging.mask"
+
+
+class MaskError(Exception):
+  pass
+
+
+def mask_key(dicom_id: int) -> str:
+  return f"/Dicoms/masks/{dicom_id}.pmsk"
+
+
+def encode_slice(mask: np.ndarray) -> Tuple[int, bytes]:
+  """(encoding, payload) of one 2-D boolean slice."""
+  flat = np.ascontiguousarray(mask, dtype=bool).ravel()
+  if not flat.any():
+    return EMPTY, b""
+  packed = np.packbits(flat, bitorder="little").tobytes()
+  # run lengths alternate background/foreground, starting with background
+  changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+  runs = np.diff(np.concatenate(([0], changes, [flat.size])))
+  if flat[0]:
+    runs = np.concatenate(([0], runs))
+  if runs.max() <= np.iinfo(np.uint16).max:
+    encoding, encoded = RUNS16, runs.astype("<u2").tobytes()
+  else:
+    encoding, encoded = RUNS32, runs.astype("<u4").tobytes()
+  return (encoding, encoded) if len(encoded) < len(packed) else (BITPACKED, packed)
+
+
+def decode_slice(encoding: int, rows: int, columns: int, payload: bytes) -> np.ndarray:
+  size = rows * columns
+  if encoding == EMPTY:
+    return np.zeros((rows, columns), dtype=bool)
+  if encoding == BITPACKED:
+    flat = np.unpackbits(np.frombuffer(payload, dtype=np.uint8), count=size, bitorder="little")
+    return flat.astype(bool).reshape(rows, columns)
+  if encoding in (RUNS16, RUNS32):
+    runs = np.frombuffer(payload, dtype="<u2" if encoding == RUNS16 else "<u4")
+    if int(runs.sum()) != size:
+      raise MaskError("Run lengths do not cover the slice")
+    values = (np.arange(runs.size) % 2).astype(bool)
+    return np.repeat(values, runs).reshape(rows, columns)
+  raise MaskError(f"Unknown slice encoding {encoding}")
+
+
+def encode_masks(masks: List[np.ndarray]) -> bytes:
+  """A mask stack holding each 2-D array of `masks` as foreground (> 0) / background."""
+  index = np.zeros(len(masks), dtype=INDEX_DTYPE)
+  payloads, offset = [], PREAMBLE.size + index.nbytes
+  for i, mask in enumerate(masks):
+    if mask.ndim != 2:
+      raise MaskError("Mask slices must be 2-D")
+    encoding, payload = encode_slice(mask > 0)
+    index[i] = (encoding, mask.shape[0], mask.shape[1], offset, len(payload))
+    payloads.append(payload)
+    offset += len(payload)
+  return b"".join([PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(masks)), index.tobytes(), *payloads])
+
+
+def decode_masks(data: bytes) -> List[np.ndarray]:
+  """Boolean arrays of every slice in a mask stack."""
+  magic, version, count = PREAMBLE.unpack_from(data)
+  if magic != MAGIC or version != FORMAT_VERSION:
+    raise MaskError("Not a mask stack, or an unsupported version")
+  index = np.frombuffer(data, dtype=INDEX_DTYPE, count=count, offset=PREAMBLE.size)
+  view = memoryview(data)
+  return [
+    decode_slice(int(entry["encoding"]), int(entry["rows"]), int(entry["columns"]),
+                 view[int(entry["offset"]):int(entry["offset"]) + int(entry["length"])])
+    for entry in index
+  ]
+
+
+def mask_slices(data: bytes) -> List[np.ndarray]:
+  """
+  Label arrays of one uploaded mask file: each frame of a DICOM mask
+  (so a multi-frame segmentation gives one slice per frame), or an
+  ordinary image, where colour masks count any non-zero channel.
+  """
+  try:
+    ds = pydicom.dcmread(BytesIO(data), force=True)
+    pixels = ds.pixel_array
+    samples = int(ds.get("SamplesPerPixel", 1))
+  except Exception:
+    try:
+      image = Image.open(BytesIO(data))
+      image.load()
+    except Exception:
+      raise MaskError("Mask is neither DICOM nor a readable image")
+    if image.mode not in ("1", "L", "P", "I", "I;16", "F"):
+      # colour masks: any non-zero channel, alpha dropped
+      image = image.convert("RGB")
+    pixels, samples = np.asarray(image), len(image.getbands())
+  if samples > 1:
+    pixels = pixels.any(axis=-1)
+  if pixels.ndim == 2:
+    return [pixels]
+  return list(pixels)
+
+
+def build_mask_stack(files: List[bytes]) -> Tuple[bytes, int, int]:
+  """Encode the slices of every mask file, in order. Returns (stack, slice count, raw uint8 size)."""
+  slices = [mask for data in files for mask in mask_slices(data)]
+  return encode_masks(slices), len(slices), sum(mask.shape[0] * mask.shape[1] for mask in slices)
+
+
+async def _mask_files(session: AsyncSession, aid: int, dicom_id: int) -> List[dict]:
+  result = await session.execute(
+    text("""
+      SELECT f.FILE_ID, f.OBJECT_KEY
+      FROM PATIENTDICOMS pd
+      JOIN DICOMFILES df ON df.DICOM_ID = pd.DICOM_ID
+      JOIN FILERECORDS f ON f.FILE_ID = df.FILE_ID
+      LEFT JOIN DICOMHEADERS h ON h.FILE_ID = df.FILE_ID
+      WHERE pd.PATIENT_ID = :aid AND pd.DICOM_ID = :dicom_id AND f.FILETYPE = 'mask'
+      ORDER BY h.INSTANCE_NUMBER NULLS LAST, f.OBJECT_KEY, f.FILE_ID
+    """).bindparams(aid=aid, dicom_id=dicom_id)
+  )
+  return [dict(row) for row in result.mappings()]
+
+
+def _get_object(client, bucket: str, key: str) -> bytes:
+  return client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+
+async def get_mask_stack(session: AsyncSession, client, bucket: str, aid: int, dicom_id: int) -> Optional[dict]:
+  """
+  The accession's mask stack record, building and storing it on first use.
+  Returns None when the accession has no masks (or is not the caller's).
+  """
+  files = await _mask_files(session, aid, dicom_id)
+  if not files:
+    return None
+  file_ids = [file["file_id"] for file in files]
+  result = await session.execute(
+    text("SELECT * FROM MASKSTACKS WHERE DICOM_ID = :dicom_id").bindparams(dicom_id=dicom_id)
+  )
+  stack = result.mappings().first()
+  if stack is not None and list(stack["file_ids"]) == file_ids:
+    return dict(stack)
+  # release the transaction while the masks are fetched and encoded
+  await session.rollback()
+  blobs = await asyncio.gather(*(run_s3(_get_object, client, bucket, file["object_key"]) for file in files))
+  data, slices, raw_bytes = await run_cpu(build_mask_stack, list(blobs))
+  key = mask_key(dicom_id)
+  await run_s3(client.put_object, Bucket=bucket, Key=key, Body=data, ContentType=CONTENT_TYPE)
+  row = {
+    "dicom_id": dicom_id, "object_key": key, "slices": slices, "raw_bytes": raw_bytes,
+    "size_bytes": len(data), "etag": hashlib.sha256(data).hexdigest()[:32], "file_ids": file_ids,
+  }
+  await session.execute(
+    text("""
+      INSERT INTO MASKSTACKS (DICOM_ID, OBJECT_KEY, SLICES, RAW_BYTES, SIZE_BYTES, ETAG, FILE_IDS)
+      VALUES (:dicom_id, :object_key, :slices, :raw_bytes, :size_bytes, :etag, CAST(:file_ids AS INT[]))
+      ON CONFLICT (DICOM_ID) DO UPDATE SET
+        OBJECT_KEY = EXCLUDED.OBJECT_KEY, SLICES = EXCLUDED.SLICES, RAW_BYTES = EXCLUDED.RAW_BYTES,
+        SIZE_BYTES = EXCLUDED.SIZE_BYTES, ETAG = EXCLUDED.ETAG, FILE_IDS = EXCLUDED.FILE_IDS
+    """).bindparams(**row)
+  )
+  await session.commit()
+  return row
+
+
+async def read_mask_stack(client, bucket: str, stack: dict) -> bytes:
+  return await run_s3(_get_object, client, bucket, stack["object_key"])
@@ -0,0 +1,298 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from cloud_services import run_s3
+from users.services.derivative_service import generate_previews
+from users.services.intensity_service import generate_intensity_stats
+from users.services.transcode_service import transcode_files
+from users.services.upload_service import CONTENT_PREFIX, ORPHAN_GRACE_SECONDS, delete_objects
+from users.services.volume_service import generate_volumes
+
+# Follow-up work and deferred deletes are rows of STORAGE_OUTBOX, written in
+# the transaction that makes them necessary. The reconciler claims due rows
+# with a lease (a worker that dies mid-job just lets the lease run out),
+# deletes them when done and backs off on failure. Kinds:
+#   derivatives    previews, volumes, intensity stats and transcoding of committed files
+#   delete_objects keys to delete once no row references them
+#   release_files  FILERECORDS rows no accession links any more
+#   sweep          recurring pass over the bucket for objects no row references
+RECONCILE = os.getenv("RECONCILE", "1") == "1"
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL_SECONDS", "60"))
+# rows claimed per pass, and bucket keys listed per sweep step
+OUTBOX_BATCH = 16
+SWEEP_BATCH = 1000
+# a full pass over the bucket starts this often; with ORPHAN_GRACE_SECONDS it
+# bounds how long an orphaned object can live
+SWEEP_INTERVAL = int(os.getenv("SWEEP_INTERVAL_SECONDS", str(24 * 3600)))
+SWEEP_PREFIX = "/Dicoms/"
+# a claimed row is retried once this runs out; the request that wrote a
+# derivatives row gets the same head start before the reconciler steps in
+LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "1800"))
+MAX_ATTEMPTS = 8
+BACKOFF_SECONDS = 60
+MAX_BACKOFF_SECONDS = 6 * 3600
+
+ENQUEUE = text("""
+  INSERT INTO STORAGE_OUTBOX (KIND, PAYLOAD, NEXT_ATTEMPT_AT)
+  VALUES (:kind, CAST(:payload AS JSONB), NOW() + make_interval(secs => CAST(:delay AS DOUBLE PRECISION)))
+  RETURNING OUTBOX_ID
+""")
+
+CLAIM = text("""
+  UPDATE STORAGE_OUTBOX o
+  SET ATTEMPTS = o.ATTEMPTS + 1,
+    NEXT_ATTEMPT_AT = NOW() + make_interval(secs => CAST(:lease AS DOUBLE PRECISION))
+  WHERE o.OUTBOX_ID IN (
+    SELECT OUTBOX_ID FROM STORAGE_OUTBOX
+    WHERE NEXT_ATTEMPT_AT <= NOW()
+    ORDER BY NEXT_ATTEMPT_AT
+    LIMIT :batch
+    FOR UPDATE SKIP LOCKED
+  )
+  RETURNING o.OUTBOX_ID, o.KIND, o.PAYLOAD, o.ATTEMPTS
+""")
+
+# object keys some row still points at; everything the API writes is listed
+REFERENCED = text("""
+  SELECT k.key FROM unnest(CAST(:keys AS VARCHAR[])) AS k(key)
+  WHERE EXISTS (SELECT 1 FROM FILERECORDS f WHERE f.OBJECT_KEY = k.key)
+    OR EXISTS (SELECT 1 FROM FILETRANSCODES t WHERE t.ORIGINAL_KEY = k.key)
+    OR EXISTS (SELECT 1 FROM FILEPREVIEWS p WHERE p.OBJECT_KEY = k.key)
+    OR EXISTS (SELECT 1 FROM SERIESVOLUMES v WHERE v.OBJECT_KEY = k.key)
+    OR EXISTS (SELECT 1 FROM MASKSTACKS m WHERE m.OBJECT_KEY = k.key)
+    OR EXISTS (SELECT 1 FROM UPLOADS u WHERE u.OBJECT_KEY = k.key AND u.STATUS IN ('open', 'complete'))
+""")
+
+# files still unlinked are dropped with everything hanging off them; their
+# objects are queued, not deleted, so a request relinking the same content
+# meanwhile keeps them
+RELEASE_FILES = text("""
+  WITH doomed AS (
+    SELECT f.FILE_ID FROM FILERECORDS f
+    WHERE f.FILE_ID = ANY(CAST(:file_ids AS INT[])) AND f.REF_COUNT = 0
+      AND NOT EXISTS (SELECT 1 FROM DICOMFILES df WHERE df.FILE_ID = f.FILE_ID)
+    FOR UPDATE
+  ), headers AS (
+    DELETE FROM DICOMHEADERS h USING doomed d WHERE h.FILE_ID = d.FILE_ID
+  ), intensity AS (
+    DELETE FROM SLICEINTENSITY s USING doomed d WHERE s.FILE_ID = d.FILE_ID
+  ), patient_files AS (
+    DELETE FROM PATIENTFILES pf USING doomed d WHERE pf.FILE_ID = d.FILE_ID
+  ), previews AS (
+    DELETE FROM FILEPREVIEWS p USING doomed d WHERE p.FILE_ID = d.FILE_ID RETURNING p.OBJECT_KEY
+  ), transcodes AS (
+    DELETE FROM FILETRANSCODES t USING doomed d WHERE t.FILE_ID = d.FILE_ID RETURNING t.ORIGINAL_KEY
+  ), files AS (
+    DELETE FROM FILERECORDS f USING doomed d WHERE f.FILE_ID = d.FILE_ID RETURNING f.OBJECT_KEY
+  )
+  SELECT OBJECT_KEY FROM files
+  UNION ALL SELECT OBJECT_KEY FROM previews
+  UNION ALL SELECT ORIGINAL_KEY FROM transcodes WHERE ORIGINAL_KEY IS NOT NULL
+""")
+
+
+class Deferred(Exception):
+  """A job that made progress but has more to do; it is retried without counting as a failure."""
+
+
+async def enqueue(session: AsyncSession, kind: str, payload: dict, delay: float = 0) -> int:
+  """Add an outbox row, due in `delay` seconds, to the session's transaction. Does not commit."""
+  result = await session.execute(ENQUEUE.bindparams(kind=kind, payload=json.dumps(payload), delay=delay))
+  return result.scalar_one()
+
+
+def derivative_files(uploads) -> List[Tuple[int, str, str]]:
+  return [(outcome.file_id, outcome.filetype, outcome.object_key) for outcome in uploads]
+
+
+async def run_derivatives(
+  sessionmaker: async_sessionmaker,
+  client,
+  bucket: str,
+  dicom_id: int,
+  files: Iterable[Tuple[int, str, str]],
+  outbox_id: Optional[int] = None,
+) -> None:
+  """
+  Build the preview pyramid, packed series volumes and intensity
+  statistics, then compress the slices (last: the others read the
+  originals it may replace). Every step skips work already done, so a
+  retried job only finishes what is missing.
+  The outbox row is deleted once all of them ran.
+  """
+  files = [tuple(file) for file in files]
+  await generate_previews(sessionmaker, client, bucket, files)
+  await generate_volumes(sessionmaker, client, bucket, dicom_id)
+  await generate_intensity_stats(sessionmaker, client, bucket, dicom_id)
+  await transcode_files(sessionmaker, client, bucket, files)
+  if outbox_id is not None:
+    async with sessionmaker() as session:
+      await session.execute(text("DELETE FROM STORAGE_OUTBOX WHERE OUTBOX_ID = :outbox_id").bindparams(outbox_id=outbox_id))
+      await session.commit()
+
+
+async def discard_objects(session: AsyncSession, client, bucket: str, keys: List[str]) -> None:
+  """
+  Clean up after a request that rolled back. Keys under an owner prefix
+  belong to the request alone and are deleted now; content-addressed keys
+  may already be reused by a concurrent request, so they are queued and
+  deleted after ORPHAN_GRACE_SECONDS if nothing references them by then.
+  Deletes that fail are queued too. Commits the queued rows.
+  """
+  shared = [key for key in keys if key.startswith(CONTENT_PREFIX)]
+  failed = await delete_objects(client, bucket, [key for key in keys if not key.startswith(CONTENT_PREFIX)])
+  if not shared and not failed:
+    return
+  try:
+    await enqueue(session, "delete_objects", {"keys": shared + failed}, delay=ORPHAN_GRACE_SECONDS)
+    await session.commit()
+  except Exception as e:
+    # the sweep finds them anyway
+    await session.rollback()
+    print(f"failed to queue {len(shared) + len(failed)} objects for deletion: {e}")
+
+
+async def _unreferenced(session: AsyncSession, keys: List[str]) -> List[str]:
+  if not keys:
+    return []
+  result = await session.execute(REFERENCED.bindparams(keys=keys))
+  referenced = {row[0] for row in result}
+  await session.rollback()
+  return [key for key in keys if key not in referenced]
+
+
+def _stale_keys(client, bucket: str, keys: List[str], cutoff: datetime) -> List[str]:
+  """Keys whose object is older than the cutoff; re-uploaded objects are left for a later sweep."""
+  stale = []
+  for key in keys:
+    try:
+      response = client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+      if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+        continue
+      raise
+    if response["LastModified"] < cutoff:
+      stale.append(key)
+  return stale
+
+
+async def _delete_unreferenced(session: AsyncSession, client, bucket: str, keys: List[str]) -> int:
+  """Delete the keys no row references whose object is older than the grace period. Returns how many."""
+  keys = await _unreferenced(session, keys)
+  cutoff = datetime.now(timezone.utc) - timedelta(seconds=ORPHAN_GRACE_SECONDS)
+  stale = await run_s3(_stale_keys, client, bucket, keys, cutoff)
+  failed = await delete_objects(client, bucket, stale)
+  if failed:
+    raise RuntimeError(f"{len(failed)} objects could not be deleted")
+  return len(stale)
+
+
+async def _release_files(session: AsyncSession, file_ids: List[int]) -> None:
+  result = await session.execute(RELEASE_FILES.bindparams(file_ids=file_ids))
+  keys = [row[0] for row in result]
+  if keys:
+    await enqueue(session, "delete_objects", {"keys": keys}, delay=ORPHAN_GRACE_SECONDS)
+  await session.commit()
+
+
+def _list_page(client, bucket: str, after: str) -> Tuple[List[Tuple[str, datetime]], Optional[str]]:
+  kwargs = {"Bucket": bucket, "Prefix": SWEEP_PREFIX, "MaxKeys": SWEEP_BATCH}
+  if after:
+    kwargs["StartAfter"] = after
+  response = client.list_objects_v2(**kwargs)
+  objects = [(item["Key"], item["LastModified"]) for item in response.get("Contents", [])]
+  more = response.get("IsTruncated") and objects
+  return objects, objects[-1][0] if more else None
+
+
+async def _sweep(session: AsyncSession, client, bucket: str, outbox_id: int, payload: dict) -> None:
+  """
+  One step of the bucket sweep: list a page of keys after the cursor and
+  delete the old ones no row references. The row then points at the next
+  page (due at once) or, after the last one, at the next full pass.
+  """
+  objects, after = await run_s3(_list_page, client, bucket, payload.get("after", ""))
+  cutoff = datetime.now(timezone.utc) - timedelta(seconds=ORPHAN_GRACE_SECONDS)
+  deleted = await _delete_unreferenced(session, client, bucket, [key for key, modified in objects if modified < cutoff])
+  if deleted:
+    print(f"sweep deleted {deleted} orphaned objects")
+  await session.execute(
+    text("""
+      UPDATE STORAGE_OUTBOX
+      SET PAYLOAD = CAST(:payload AS JSONB), ATTEMPTS = 0, LAST_ERROR = NULL,
+        NEXT_ATTEMPT_AT = NOW() + make_interval(secs => CAST(:delay AS DOUBLE PRECISION))
+      WHERE OUTBOX_ID = :outbox_id
+    """).bindparams(
+      outbox_id=outbox_id, payload=json.dumps({"after": after or ""}), delay=0 if after else SWEEP_INTERVAL)
+  )
+  await session.commit()
+  raise Deferred()
+
+
+async def _run_job(sessionmaker: async_sessionmaker, client, bucket: str, job: dict) -> None:
+  payload = job["payload"]
+  if isinstance(payload, str):
+    payload = json.loads(payload)
+  kind, outbox_id = job["kind"], job["outbox_id"]
+  try:
+    async with sessionmaker() as session:
+      if kind == "derivatives":
+        await run_derivatives(sessionmaker, client, bucket, payload["dicom_id"], payload["files"])
+      elif kind == "delete_objects":
+        await _delete_unreferenced(session, client, bucket, payload["keys"])
+      elif kind == "release_files":
+        await _release_files(session, payload["file_ids"])
+      elif kind == "sweep":
+        await _sweep(session, client, bucket, outbox_id, payload)
+      else:
+        raise ValueError(f"Unknown outbox kind {kind!r}")
+      await session.execute(text("DELETE FROM STORAGE_OUTBOX WHERE OUTBOX_ID = :outbox_id").bindparams(outbox_id=outbox_id))
+      await session.commit()
+  except Deferred:
+    pass
+  except Exception as e:
+    print(f"outbox job {outbox_id} ({kind}) failed, attempt {job['attempts']}: {e}")
+    # past MAX_ATTEMPTS the row is parked for someone to look at; the sweep never is
+    delay = min(BACKOFF_SECONDS * 2 ** (job["attempts"] - 1), MAX_BACKOFF_SECONDS)
+    async with sessionmaker() as session:
+      await session.execute(
+        text("""
+          UPDATE STORAGE_OUTBOX
+          SET LAST_ERROR = :error,
+            NEXT_ATTEMPT_AT = CASE WHEN ATTEMPTS >= :max_attempts AND KIND <> 'sweep' THEN CAST('infinity' AS TIMESTAMP)
+              ELSE NOW() + make_interval(secs => CAST(:delay AS DOUBLE PRECISION)) END
+          WHERE OUTBOX_ID = :outbox_id
+        """).bindparams(outbox_id=outbox_id, error=str(e)[:1000], max_attempts=MAX_ATTEMPTS, delay=delay)
+      )
+      await session.commit()
+
+
+async def reconcile_once(sessionmaker: async_sessionmaker, client, bucket: str) -> int:
+  """Claim and run one batch of due outbox rows. Returns how many were claimed."""
+  async with sessionmaker() as session:
+    result = await session.execute(CLAIM.bindparams(lease=LEASE_SECONDS, batch=OUTBOX_BATCH))
+    jobs = [dict(row) for row in result.mappings()]
+    await session.commit()
+  await asyncio.gather(*(_run_job(sessionmaker, client, bucket, job) for job in jobs))
+  return len(jobs)
+
+
+async def run_reconciler(sessionmaker: async_sessionmaker, client, bucket: str) -> None:
+  """Drain the outbox for as long as the app runs; full batches are followed at once."""
+  while True:
+    try:
+      claimed = await reconcile_once(sessionmaker, client, bucket)
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      print(f"reconciler pass failed: {e}")
+      claimed = 0
+    if claimed < OUTBOX_BATCH:
+      await asyncio.sleep(RECONCILE_INTERVAL)
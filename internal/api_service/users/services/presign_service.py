@@ -0,0 +1,154 @@
+import asyncio
+import base64
+from typing import List, Optional, Set
+
+from botocore.exceptions import ClientError
+
+from cloud_services import run_s3
+from db_service.models.py_models import DirectUploadFile, FileUploadOutcome, PresignFile, PresignedUpload
+from users.services.upload_service import (
+  make_object_key, content_key, hash_from_key, hash_from_staged_key, staged_key
+)
+
+UPLOAD_URL_EXPIRATION_TIME = 3600
+
+
+def normalize_hashes(files: List[PresignFile]) -> None:
+  for file in files:
+    if file.sha256 is not None:
+      file.sha256 = file.sha256.lower()
+      if len(file.sha256) != 64 or any(c not in "0123456789abcdef" for c in file.sha256):
+        raise ValueError(f"invalid sha256 for {file.filename}")
+
+
+def _checksum(content_hash: str) -> str:
+  return base64.b64encode(bytes.fromhex(content_hash)).decode("ascii")
+
+
+def _sign_uploads(client, bucket: str, aid: int, files: List[PresignFile], owned: Set[str]) -> List[PresignedUpload]:
+  signed = []
+  for file in files:
+    if file.sha256 is None:
+      key = make_object_key(aid, file.filename)
+      params, headers = {"Bucket": bucket, "Key": key}, {}
+    else:
+      if file.sha256 in owned:
+        signed.append(PresignedUpload(
+          filename=file.filename, filetype=file.filetype, object_key=content_key(file.sha256), exists=True
+        ))
+        continue
+      # everything else is PUT under the caller's own prefix, and S3 rejects
+      # the PUT unless the body hashes to the checksum; finalize then moves it
+      # to the shared content key
+      key = staged_key(aid, file.sha256)
+      checksum = _checksum(file.sha256)
+      params = {"Bucket": bucket, "Key": key, "ChecksumSHA256": checksum}
+      headers = {"x-amz-checksum-sha256": checksum}
+    url = client.generate_presigned_url(
+      ClientMethod="put_object",
+      Params=params,
+      ExpiresIn=UPLOAD_URL_EXPIRATION_TIME
+    )
+    signed.append(PresignedUpload(
+      filename=file.filename, filetype=file.filetype, object_key=key, url=url, headers=headers
+    ))
+  return signed
+
+
+async def presign_uploads(
+  client, bucket: str, aid: int, files: List[PresignFile], owned: Set[str] = frozenset()
+) -> List[PresignedUpload]:
+  """
+  Issue one presigned PUT per file; the whole batch is signed in a single
+  executor call. Files whose sha256 the caller already owns (see
+  owned_content) get no URL; content stored only for other users still
+  has to be sent.
+  """
+  return await run_s3(_sign_uploads, client, bucket, aid, files, owned)
+
+
+def _promote(client, bucket: str, staged: str, content_hash: str) -> bool:
+  """
+  Move a verified staged object to its content key. Returns False when the
+  content was already stored there (the staged copy is just dropped).
+  """
+  key = content_key(content_hash)
+  try:
+    client.head_object(Bucket=bucket, Key=key)
+    created = False
+  except ClientError as e:
+    if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+      raise
+    client.copy_object(
+      Bucket=bucket, Key=key, CopySource={"Bucket": bucket, "Key": staged}, ChecksumAlgorithm="SHA256"
+    )
+    created = True
+  client.delete_object(Bucket=bucket, Key=staged)
+  return created
+
+
+async def _verify_staged(client, bucket: str, outcome: FileUploadOutcome, content_hash: str) -> FileUploadOutcome:
+  """
+  The caller proves it holds the content by a checksummed PUT to its own
+  staging key; only then is the shared content object linked.
+  """
+  try:
+    response = await run_s3(client.head_object, Bucket=bucket, Key=outcome.object_key, ChecksumMode="ENABLED")
+  except Exception as e:
+    outcome.status = "failed"
+    outcome.error = f"object was not uploaded: {e}"
+    return outcome
+  if response.get("ChecksumSHA256") != _checksum(content_hash):
+    outcome.status = "failed"
+    outcome.error = "object was not uploaded with its sha256 checksum"
+    return outcome
+  try:
+    created = await run_s3(_promote, client, bucket, outcome.object_key, content_hash)
+  except Exception as e:
+    outcome.status = "failed"
+    outcome.error = f"object could not be stored: {e}"
+    return outcome
+  outcome.object_key = content_key(content_hash)
+  outcome.content_hash = content_hash
+  outcome.size = response["ContentLength"]
+  outcome.status = "uploaded"
+  outcome.deduplicated = not created
+  return outcome
+
+
+async def _head(client, bucket: str, aid: int, file: DirectUploadFile, owned: Set[str]) -> FileUploadOutcome:
+  outcome = FileUploadOutcome(
+    filename=file.filename, object_key=file.object_key, filetype=file.filetype,
+    content_hash=hash_from_key(file.object_key)
+  )
+  staged_hash = hash_from_staged_key(aid, file.object_key)
+  if staged_hash is not None:
+    return await _verify_staged(client, bucket, outcome, staged_hash)
+  if outcome.content_hash is not None:
+    if outcome.content_hash in owned:
+      # already the caller's; its original may since have been replaced by a compressed copy
+      outcome.status = "uploaded"
+      outcome.deduplicated = True
+    else:
+      outcome.status = "failed"
+      outcome.error = "content is not held by this user, upload it to the key /uploads/presign issued"
+    return outcome
+  try:
+    response = await run_s3(client.head_object, Bucket=bucket, Key=file.object_key)
+    outcome.size = response["ContentLength"]
+    outcome.status = "uploaded"
+  except Exception as e:
+    outcome.status = "failed"
+    outcome.error = f"object was not uploaded: {e}"
+  return outcome
+
+
+async def verify_uploads(
+  client, bucket: str, aid: int, files: List[DirectUploadFile], owned: Set[str] = frozenset()
+) -> List[FileUploadOutcome]:
+  """
+  Check every directly uploaded object, concurrently: plain keys must
+  exist, staged content must carry its sha256 checksum and is moved to the
+  content key, and a content key is accepted only for hashes in `owned`.
+  """
+  return list(await asyncio.gather(*(_head(client, bucket, aid, file, owned) for file in files)))
@@ -0,0 +1,138 @@
+import gzip
+import os
+from contextvars import ContextVar
+from typing import Any, Callable, Coroutine, Optional
+
+import brotli
+import msgpack
+import orjson
+from fastapi import Request
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+MSGPACK_TYPES = {MSGPACK, "application/x-msgpack"}
+# below this a response goes out as is; compressing it would not save a packet
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1400"))
+# bodies this large are compressed on a worker thread (zlib and brotli release the GIL)
+COMPRESS_OFF_LOOP_BYTES = 256 * 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# codings we produce, preferred in this order when a client weighs them equally
+ENCODINGS = ("br", "gzip")
+
+_format: ContextVar[str] = ContextVar("response_format", default=JSON)
+
+
+def _ranges(header: str):
+  """(media range or coding, q) pairs of an Accept or Accept-Encoding header."""
+  for part in header.split(","):
+    value, *params = [piece.strip() for piece in part.split(";")]
+    q = 1.0
+    for param in params:
+      name, _, number = param.partition("=")
+      if name.strip().lower() == "q":
+        try:
+          q = float(number)
+        except ValueError:
+          q = 0.0
+    if value:
+      yield value.lower(), q
+
+
+def negotiate_format(accept: Optional[str]) -> str:
+  """MSGPACK when the client asks for it at least as strongly as for JSON, JSON otherwise."""
+  if not accept:
+    return JSON
+  msgpack_q = json_q = 0.0
+  for media_range, q in _ranges(accept):
+    if media_range in MSGPACK_TYPES:
+      msgpack_q = max(msgpack_q, q)
+    elif media_range == JSON:
+      json_q = max(json_q, q)
+  return MSGPACK if msgpack_q > 0 and msgpack_q >= json_q else JSON
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+  """
+  The coding of ENCODINGS the client weighs highest (br on a tie), or None
+  when it accepts neither. A coding not listed takes the q of "*", if any.
+  """
+  if not accept_encoding:
+    return None
+  accepted = {}
+  for coding, q in _ranges(accept_encoding):
+    accepted[coding] = max(q, accepted.get(coding, 0.0))
+  wildcard = accepted.get("*", 0.0)
+  # max keeps the first of equal weights, so ties go to the ENCODINGS order
+  best = max(ENCODINGS, key=lambda coding: accepted.get(coding, wildcard))
+  return best if accepted.get(best, wildcard) > 0 else None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+  if encoding == "br":
+    return brotli.compress(body, quality=BROTLI_QUALITY)
+  return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def encode(content: Any, media_type: str) -> bytes:
+  if media_type == MSGPACK:
+    return msgpack.packb(content, use_bin_type=True)
+  return orjson.dumps(content)
+
+
+class FastResponse(Response):
+  """
+  JSON via orjson, or msgpack when the request negotiated it. Content
+  arrives already made JSON-compatible by the response model, so both
+  encoders take it as is.
+  """
+  media_type = JSON
+
+  def render(self, content: Any) -> bytes:
+    self.media_type = _format.get()
+    return encode(content, self.media_type)
+
+
+class NegotiatedRoute(APIRoute):
+  """
+  Route that picks the body format from Accept for FastResponse, and
+  compresses JSON / msgpack bodies of COMPRESS_MIN_BYTES or more with br or
+  gzip per Accept-Encoding. Other responses (streams, images, raw pixels)
+  pass through untouched.
+  """
+
+  def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+    handler = super().get_route_handler()
+
+    async def negotiated_handler(request: Request) -> Response:
+      token = _format.set(negotiate_format(request.headers.get("accept")))
+      try:
+        response = await handler(request)
+      finally:
+        _format.reset(token)
+      # streaming responses have no body to compress
+      if response.media_type in (JSON, MSGPACK) and isinstance(getattr(response, "body", None), bytes):
+        response.headers["vary"] = "Accept, Accept-Encoding"
+        await _compress_response(request, response)
+      return response
+
+    return negotiated_handler
+
+
+async def _compress_response(request: Request, response: Response) -> None:
+  body = response.body
+  if len(body) < COMPRESS_MIN_BYTES or "content-encoding" in response.headers:
+    return
+  encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+  if encoding is None:
+    return
+  if len(body) >= COMPRESS_OFF_LOOP_BYTES:
+    compressed = await run_in_threadpool(compress, body, encoding)
+  else:
+    compressed = compress(body, encoding)
+  response.body = compressed
+  response.headers["content-encoding"] = encoding
+  response.headers["content-length"] = str(len(compressed))
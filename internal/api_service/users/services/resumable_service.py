@@ -0,0 +1,248 @@
+import math
+import os
+import uuid
+from typing import AsyncIterator, Dict, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cloud_services import run_s3, MB
+from db_service.models.py_models import CreateUpload, UploadStatus
+from users.services.upload_service import make_object_key
+
+# S3 multipart limits: every part but the last must be >= 5 MiB,
+# and an upload has at most 10000 parts
+MIN_CHUNK_SIZE = 5 * MB
+DEFAULT_CHUNK_SIZE = 8 * MB
+# a chunk is held in memory while it is sent on, so this bounds each request
+MAX_CHUNK_SIZE = int(os.getenv("MAX_CHUNK_SIZE", str(64 * MB)))
+MAX_CHUNKS = 10000
+
+
+class UploadError(ValueError):
+  """Raised when a resumable upload request does not fit the upload's layout."""
+
+
+def total_chunks(size: int, chunk_size: int) -> int:
+  return max(1, math.ceil(size / chunk_size))
+
+
+def expected_chunk_size(upload: dict, chunk: int) -> int:
+  if chunk == total_chunks(upload["total_size"], upload["chunk_size"]):
+    return upload["total_size"] - (chunk - 1) * upload["chunk_size"]
+  return upload["chunk_size"]
+
+
+def to_status(upload: dict, received: Optional[Dict[int, int]] = None) -> UploadStatus:
+  received = received or {}
+  n_chunks = total_chunks(upload["total_size"], upload["chunk_size"])
+  return UploadStatus(
+    upload_id=str(upload["upload_id"]),
+    filename=upload["filename"],
+    filetype=upload["filetype"],
+    object_key=upload["object_key"],
+    size=upload["total_size"],
+    chunk_size=upload["chunk_size"],
+    total_chunks=n_chunks,
+    status=upload["status"],
+    received_chunks=sorted(received),
+    received_bytes=sum(received.values()),
+    missing_chunks=[n for n in range(1, n_chunks + 1) if n not in received],
+  )
+
+
+async def create_upload(session: AsyncSession, client, bucket: str, aid: int, request: CreateUpload) -> dict:
+  chunk_size = request.chunk_size or DEFAULT_CHUNK_SIZE
+  if request.size < 0:
+    raise UploadError("size must not be negative")
+  if chunk_size < MIN_CHUNK_SIZE and request.size > chunk_size:
+    raise UploadError(f"chunk_size must be at least {MIN_CHUNK_SIZE} bytes")
+  if chunk_size > MAX_CHUNK_SIZE:
+    raise UploadError(f"chunk_size must be at most {MAX_CHUNK_SIZE} bytes")
+  if total_chunks(request.size, chunk_size) > MAX_CHUNKS:
+    raise UploadError(f"file needs more than {MAX_CHUNKS} chunks, use a larger chunk_size")
+  if request.filetype not in ("slice", "mask"):
+    raise UploadError("filetype must be 'slice' or 'mask'")
+
+  key = make_object_key(aid, request.filename)
+  response = await run_s3(client.create_multipart_upload, Bucket=bucket, Key=key)
+  result = await session.execute(
+    text("""
+      INSERT INTO UPLOADS (AID, FILENAME, FILETYPE, OBJECT_KEY, S3_UPLOAD_ID, TOTAL_SIZE, CHUNK_SIZE)
+      VALUES (:aid, :filename, :filetype, :object_key, :s3_upload_id, :total_size, :chunk_size)
+      RETURNING *
+    """).bindparams(
+      aid=aid,
+      filename=request.filename,
+      filetype=request.filetype,
+      object_key=key,
+      s3_upload_id=response["UploadId"],
+      total_size=request.size,
+      chunk_size=chunk_size,
+    )
+  )
+  upload = dict(result.mappings().one())
+  await session.commit()
+  return upload
+
+
+async def get_upload(session: AsyncSession, upload_id: str, aid: int, for_update: bool = False) -> Optional[dict]:
+  try:
+    uuid.UUID(upload_id)
+  except ValueError:
+    return None
+  query = "SELECT * FROM UPLOADS WHERE UPLOAD_ID = CAST(:upload_id AS UUID) AND AID = :aid"
+  if for_update:
+    query += " FOR UPDATE"
+  result = await session.execute(text(query).bindparams(upload_id=upload_id, aid=aid))
+  row = result.mappings().first()
+  return dict(row) if row is not None else None
+
+
+def _list_parts(client, bucket: str, upload: dict) -> Dict[int, int]:
+  parts: Dict[int, int] = {}
+  kwargs = {"Bucket": bucket, "Key": upload["object_key"], "UploadId": upload["s3_upload_id"]}
+  while True:
+    response = client.list_parts(**kwargs)
+    for part in response.get("Parts", []):
+      parts[part["PartNumber"]] = part["Size"]
+    if not response.get("IsTruncated"):
+      return parts
+    kwargs["PartNumberMarker"] = response["NextPartNumberMarker"]
+
+
+async def received_chunks(client, bucket: str, upload: dict) -> Dict[int, int]:
+  """Chunks S3 already holds for an open upload, as {chunk number: size}."""
+  if upload["status"] != "open":
+    n_chunks = total_chunks(upload["total_size"], upload["chunk_size"])
+    return {n: expected_chunk_size(upload, n) for n in range(1, n_chunks + 1)}
+  return await run_s3(_list_parts, client, bucket, upload)
+
+
+def check_chunk(upload: dict, chunk: int, content_length: Optional[str] = None) -> int:
+  """
+  Validate a chunk before its body is read: the upload is open, the chunk
+  number fits, and a declared Content-Length matches. Returns the chunk's
+  expected size.
+  """
+  if upload["status"] != "open":
+    raise UploadError(f"upload is {upload['status']}")
+  n_chunks = total_chunks(upload["total_size"], upload["chunk_size"])
+  if not 1 <= chunk <= n_chunks:
+    raise UploadError(f"chunk must be between 1 and {n_chunks}")
+  expected = expected_chunk_size(upload, chunk)
+  if expected > MAX_CHUNK_SIZE:
+    raise UploadError(f"chunks of this upload exceed {MAX_CHUNK_SIZE} bytes, start a new upload")
+  if content_length is not None:
+    try:
+      declared = int(content_length)
+    except ValueError:
+      raise UploadError("Content-Length is not a number")
+    if declared != expected:
+      raise UploadError(f"chunk {chunk} must be {expected} bytes, Content-Length is {declared}")
+  return expected
+
+
+async def read_chunk(stream: AsyncIterator[bytes], expected: int) -> bytes:
+  """Read a chunk body, refusing it as soon as it runs past `expected` bytes."""
+  body = bytearray()
+  async for piece in stream:
+    body += piece
+    if len(body) > expected:
+      raise UploadError(f"chunk must be {expected} bytes, got more")
+  return bytes(body)
+
+
+async def upload_chunk(client, bucket: str, upload: dict, chunk: int, body: bytes) -> str:
+  expected = check_chunk(upload, chunk)
+  if len(body) != expected:
+    raise UploadError(f"chunk {chunk} must be {expected} bytes, got {len(body)}")
+  # re-sending a chunk simply replaces the part, so retries are safe
+  response = await run_s3(
+    client.upload_part,
+    Bucket=bucket, Key=upload["object_key"], UploadId=upload["s3_upload_id"],
+    PartNumber=chunk, Body=body
+  )
+  return response["ETag"]
+
+
+def _complete(client, bucket: str, upload: dict) -> None:
+  parts = []
+  kwargs = {"Bucket": bucket, "Key": upload["object_key"], "UploadId": upload["s3_upload_id"]}
+  while True:
+    response = client.list_parts(**kwargs)
+    parts.extend({"PartNumber": p["PartNumber"], "ETag": p["ETag"]} for p in response.get("Parts", []))
+    if not response.get("IsTruncated"):
+      break
+    kwargs["PartNumberMarker"] = response["NextPartNumberMarker"]
+  n_chunks = total_chunks(upload["total_size"], upload["chunk_size"])
+  missing = sorted(set(range(1, n_chunks + 1)) - {p["PartNumber"] for p in parts})
+  if missing:
+    raise UploadError(f"missing chunks: {missing[:20]}")
+  client.complete_multipart_upload(
+    Bucket=bucket, Key=upload["object_key"], UploadId=upload["s3_upload_id"],
+    MultipartUpload={"Parts": parts}
+  )
+
+
+async def complete_upload(session: AsyncSession, client, bucket: str, upload: dict) -> dict:
+  if upload["status"] == "complete":
+    return upload
+  if upload["status"] != "open":
+    raise UploadError(f"upload is {upload['status']}")
+  await run_s3(_complete, client, bucket, upload)
+  await session.execute(
+    text("UPDATE UPLOADS SET STATUS = 'complete' WHERE UPLOAD_ID = :upload_id").bindparams(
+      upload_id=upload["upload_id"])
+  )
+  await session.commit()
+  return {**upload, "status": "complete"}
+
+
+async def abort_upload(session: AsyncSession, client, bucket: str, upload: dict) -> None:
+  if upload["status"] == "open":
+    await run_s3(
+      client.abort_multipart_upload,
+      Bucket=bucket, Key=upload["object_key"], UploadId=upload["s3_upload_id"]
+    )
+  elif upload["status"] == "complete":
+    await run_s3(client.delete_object, Bucket=bucket, Key=upload["object_key"])
+  elif upload["status"] == "consumed":
+    raise UploadError("upload already belongs to an accession")
+  await session.execute(
+    text("UPDATE UPLOADS SET STATUS = 'aborted' WHERE UPLOAD_ID = :upload_id").bindparams(
+      upload_id=upload["upload_id"])
+  )
+  await session.commit()
+
+
+async def consume_uploads(session: AsyncSession, upload_ids: List[str], aid: int) -> List[dict]:
+  """
+  Lock completed uploads and mark them consumed, inside the caller's
+  transaction, so they can be attached to exactly one accession.
+  """
+  try:
+    upload_ids = [str(uuid.UUID(upload_id)) for upload_id in upload_ids]
+  except ValueError:
+    raise UploadError("upload ids must be UUIDs")
+  result = await session.execute(
+    text("""
+      SELECT * FROM UPLOADS
+      WHERE UPLOAD_ID = ANY(CAST(:upload_ids AS UUID[])) AND AID = :aid
+      FOR UPDATE
+    """).bindparams(upload_ids=upload_ids, aid=aid)
+  )
+  found = {str(row["upload_id"]): dict(row) for row in result.mappings()}
+  uploads = []
+  for upload_id in upload_ids:
+    upload = found.get(upload_id)
+    if upload is None:
+      raise UploadError(f"unknown upload {upload_id}")
+    if upload["status"] != "complete":
+      raise UploadError(f"upload {upload_id} is {upload['status']}")
+    uploads.append(upload)
+  await session.execute(
+    text("UPDATE UPLOADS SET STATUS = 'consumed' WHERE UPLOAD_ID = ANY(CAST(:upload_ids AS UUID[]))").bindparams(
+      upload_ids=upload_ids)
+  )
+  return uploads
@@ -1,30 +1,340 @@
-import io
 import asyncio
+import hashlib
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
 
-class StreamWrapper(io.RawIOBase):
-  def __init__(self, stream_iter):
-    self.stream_iter = stream_iter
-    self.buffer = b""
-  
-  def readable(self):
-    return True
-  
-  async def fill_buffer(self):
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from cloud_services import run_s3, MB
+from workers import run_cpu
+from db_service.models.py_models import FileUploadOutcome
+from users.services.dicom_service import fetch_header, header_complete, parse_header
+from users.services.upload_service import delete_objects, content_key, uploaded_here
+
+# S3 rejects multipart parts smaller than 5 MiB (except the last one)
+PART_SIZE = 8 * MB
+# part buffers per request; bounds both memory and in-flight S3 calls
+BUFFERS_PER_UPLOAD = 4
+MAX_FORM_FIELD_SIZE = 1 * MB
+# leading bytes of every file kept in memory, enough for its DICOM header
+HEAD_BYTES = 64 * 1024
+# heads waiting to be parsed per request; the body waits when all are taken
+HEADS_IN_FLIGHT = 16
+
+
+class BufferPool:
+  """
+  Fixed set of reusable part buffers shared by every file in one request.
+  Writers wait here when all buffers are in flight to S3, which is what
+  pushes back on the request body: peak memory is size * count no matter
+  how large the series is.
+  """
+  def __init__(self, size: int = PART_SIZE, count: int = BUFFERS_PER_UPLOAD):
+    self.size = size
+    self._count = count
+    self._allocated = 0
+    self._free: asyncio.Queue[bytearray] = asyncio.Queue()
+
+  async def acquire(self) -> bytearray:
+    if self._free.empty() and self._allocated < self._count:
+      self._allocated += 1
+      return bytearray(self.size)
+    return await self._free.get()
+
+  def release(self, buffer: bytearray) -> None:
+    self._free.put_nowait(buffer)
+
+
+class S3MultipartWriter:
+  """
+  Copies incoming chunks into pooled part buffers and ships each full
+  buffer to S3 as a multipart part while the next one fills up.
+  Objects smaller than one part are sent with a single put_object.
+
+  With an `exists` check the object ends up under its content-addressed
+  key: the sha256 is computed as bytes stream through, a small file whose
+  content is already stored is never sent, and a large one is staged under
+  `key` and then copied server side (or dropped if it was a duplicate).
+  """
+  def __init__(
+    self,
+    client,
+    bucket: str,
+    key: str,
+    pool: BufferPool,
+    exists: Optional[Callable[[str], Awaitable[bool]]] = None,
+  ):
+    self.client = client
+    self.bucket = bucket
+    self.key = key
+    self.pool = pool
+    self.exists = exists
+    self.size = 0
+    self.content_hash: Optional[str] = None
+    self.deduplicated = False
+    self.head = bytearray()
+    self._digest = hashlib.sha256()
+    self._buffer: Optional[bytearray] = None
+    self._filled = 0
+    self._upload_id: Optional[str] = None
+    self._parts: List[asyncio.Task] = []
+
+  async def write(self, data) -> None:
+    view = memoryview(data)
+    self._digest.update(view)
+    if len(self.head) < HEAD_BYTES:
+      self.head += view[:HEAD_BYTES - len(self.head)]
+    while len(view):
+      if self._buffer is None:
+        self._buffer = await self.pool.acquire()
+        self._filled = 0
+      n = min(len(view), self.pool.size - self._filled)
+      self._buffer[self._filled:self._filled + n] = view[:n]
+      self._filled += n
+      self.size += n
+      view = view[n:]
+      if self._filled == self.pool.size:
+        await self._flush_part()
+
+  async def _flush_part(self) -> None:
+    if self._upload_id is None:
+      response = await run_s3(self.client.create_multipart_upload, Bucket=self.bucket, Key=self.key)
+      self._upload_id = response["UploadId"]
+    for task in self._parts:
+      if task.done() and task.exception():
+        raise task.exception()
+    buffer, filled = self._buffer, self._filled
+    self._buffer, self._filled = None, 0
+    self._parts.append(asyncio.create_task(self._upload_part(len(self._parts) + 1, buffer, filled)))
+
+  async def _upload_part(self, part_number: int, buffer: bytearray, filled: int) -> dict:
+    try:
+      # full parts go out without a copy; only the tail part is sliced
+      body = buffer if filled == len(buffer) else bytes(memoryview(buffer)[:filled])
+      response = await run_s3(
+        self.client.upload_part,
+        Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+        PartNumber=part_number, Body=body
+      )
+      return {"PartNumber": part_number, "ETag": response["ETag"]}
+    finally:
+      self.pool.release(buffer)
+
+  async def close(self) -> int:
+    """Flush what is buffered and finish the object. Returns its size."""
+    self.content_hash = self._digest.hexdigest()
+    if self._upload_id is None:
+      buffer, filled = self._buffer, self._filled
+      self._buffer = None
+      try:
+        if self.exists is not None:
+          self.key = content_key(self.content_hash)
+          if await self.exists(self.content_hash):
+            self.deduplicated = True
+            return self.size
+        body = bytes(memoryview(buffer)[:filled]) if buffer is not None else b""
+        await run_s3(self.client.put_object, Bucket=self.bucket, Key=self.key, Body=body)
+      finally:
+        if buffer is not None:
+          self.pool.release(buffer)
+      return self.size
+    if self._buffer is not None:
+      await self._flush_part()
     try:
-      chunk = await self.stream_iter.__anext__()
-      self.buffer += chunk
-    except StopAsyncIteration:
-      pass
-
-  
-  def read_into(self, b):
-    # this method is called by boto3
-    loop = asyncio.get_event_loop()
-    if not self.buffer:
-      loop.run_until_complete(self.fill_buffer())
-    if not self.buffer:
-      return 0 # EOF
-    n = min(len(b), len(self.buffer))
-    b[:n] = self.buffer[:n]
-    self.buffer = self.buffer[n:]
-    return n
\ No newline at end of file
+      parts = await asyncio.gather(*self._parts)
+      await run_s3(
+        self.client.complete_multipart_upload,
+        Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+        MultipartUpload={"Parts": list(parts)}
+      )
+    except Exception:
+      await self.abort()
+      raise
+    if self.exists is not None:
+      staged, self.key = self.key, content_key(self.content_hash)
+      self.deduplicated = await self.exists(self.content_hash)
+      if not self.deduplicated:
+        await run_s3(self.client.copy, {"Bucket": self.bucket, "Key": staged}, self.bucket, self.key)
+      await run_s3(self.client.delete_object, Bucket=self.bucket, Key=staged)
+    return self.size
+
+  async def abort(self) -> None:
+    for task in self._parts:
+      task.cancel()
+    await asyncio.gather(*self._parts, return_exceptions=True)
+    if self._buffer is not None:
+      self.pool.release(self._buffer)
+      self._buffer = None
+    if self._upload_id is not None:
+      upload_id, self._upload_id = self._upload_id, None
+      try:
+        await run_s3(self.client.abort_multipart_upload, Bucket=self.bucket, Key=self.key, UploadId=upload_id)
+      except Exception as e:
+        print(f"failed to abort multipart upload for {self.key}: {e}")
+
+
+class _PartCollector:
+  """Turns MultipartParser callbacks into a list of events the async loop can await on."""
+  def __init__(self):
+    self.events: List[Tuple[str, object]] = []
+    self._headers: Dict[bytes, bytes] = {}
+    self._field = b""
+    self._value = b""
+
+  def on_part_begin(self):
+    self._headers = {}
+
+  def on_header_field(self, data, start, end):
+    self._field += data[start:end]
+
+  def on_header_value(self, data, start, end):
+    self._value += data[start:end]
+
+  def on_header_end(self):
+    self._headers[self._field.lower()] = self._value
+    self._field, self._value = b"", b""
+
+  def on_headers_finished(self):
+    self.events.append(("part", self._headers))
+
+  def on_part_data(self, data, start, end):
+    # no copy: the slice refers to the request chunk, which is consumed
+    # before the next one is read
+    self.events.append(("data", memoryview(data)[start:end]))
+
+  def on_part_end(self):
+    self.events.append(("end", None))
+
+  def callbacks(self) -> dict:
+    return {
+      "on_part_begin": self.on_part_begin,
+      "on_header_field": self.on_header_field,
+      "on_header_value": self.on_header_value,
+      "on_header_end": self.on_header_end,
+      "on_headers_finished": self.on_headers_finished,
+      "on_part_data": self.on_part_data,
+      "on_part_end": self.on_part_end,
+    }
+
+
+async def _finish(writer: S3MultipartWriter, outcome: FileUploadOutcome) -> FileUploadOutcome:
+  try:
+    outcome.size = await writer.close()
+    outcome.object_key = writer.key
+    outcome.content_hash = writer.content_hash
+    outcome.deduplicated = writer.deduplicated
+    outcome.status = "uploaded"
+  except Exception as e:
+    outcome.status = "failed"
+    outcome.error = str(e)
+  return outcome
+
+
+async def _header(
+  client, bucket: str, head: bytes, size: int, finished: "asyncio.Task[FileUploadOutcome]", slots: asyncio.Semaphore
+) -> Optional[dict]:
+  """
+  Parsed header of a streamed file: from its head when that holds the
+  whole header, otherwise range-read back once the object is stored. The
+  head is let go before any S3 wait.
+  """
+  try:
+    if header_complete(head, size):
+      try:
+        return await run_cpu(parse_header, head)
+      except Exception as e:
+        print(f"failed to parse a DICOM header: {e}")
+        return None
+  finally:
+    del head
+    slots.release()
+  outcome = await finished
+  if outcome.status != "uploaded":
+    return None
+  return await fetch_header(client, bucket, outcome.object_key)
+
+
+async def stream_multipart_to_s3(
+  content_type: str,
+  body: AsyncIterator[bytes],
+  client,
+  bucket: str,
+  key_for: Callable[[Dict[str, str], str], str],
+  exists: Optional[Callable[[str], Awaitable[bool]]] = None,
+) -> Tuple[Dict[str, str], List[FileUploadOutcome], List[Optional[dict]]]:
+  """
+  Parse a multipart/form-data body as it arrives and stream each file part
+  straight into S3, without spooling it to disk.
+  Plain form fields are returned as a dict, along with the outcome and the
+  parsed DICOM header (see parse_header) of every file. Headers are parsed
+  as each file ends, so only HEADS_IN_FLIGHT heads are held at a time and
+  memory stays flat however many files arrive. key_for(fields, filename) picks
+  the object key for each file, so fields it needs must come before the
+  files in the body. Passing `exists` stores files content-addressed (see
+  S3MultipartWriter).
+  """
+  _, params = parse_options_header(content_type)
+  boundary = params.get(b"boundary")
+  if not boundary:
+    raise ValueError("Missing boundary in multipart body")
+
+  collector = _PartCollector()
+  parser = MultipartParser(boundary, collector.callbacks())
+  pool = BufferPool()
+  fields: Dict[str, str] = {}
+  finishing: List[asyncio.Task] = []
+  headers: List[asyncio.Task] = []
+  parsing = asyncio.Semaphore(HEADS_IN_FLIGHT)
+  writer: Optional[S3MultipartWriter] = None
+  outcome: Optional[FileUploadOutcome] = None
+  field_name: Optional[str] = None
+  field_value = bytearray()
+
+  try:
+    async for chunk in body:
+      parser.write(chunk)
+      for kind, payload in collector.events:
+        if kind == "part":
+          _, disposition = parse_options_header(payload.get(b"content-disposition", b""))
+          name = disposition.get(b"name", b"").decode("utf-8")
+          filename = disposition.get(b"filename")
+          if filename is not None:
+            filename = filename.decode("utf-8")
+            key = key_for(fields, filename)
+            writer = S3MultipartWriter(client, bucket, key, pool, exists)
+            outcome = FileUploadOutcome(filename=filename, object_key=key)
+          else:
+            field_name = name
+            field_value.clear()
+        elif kind == "data":
+          if writer is not None:
+            await writer.write(payload)
+          else:
+            if len(field_value) + len(payload) > MAX_FORM_FIELD_SIZE:
+              raise ValueError(f"Form field '{field_name}' is too large")
+            field_value += payload
+        elif kind == "end":
+          if writer is not None:
+            # let the tail part finish in the background while the next file streams in
+            finishing.append(asyncio.create_task(_finish(writer, outcome)))
+            head, writer.head = bytes(writer.head), bytearray()
+            await parsing.acquire()
+            headers.append(asyncio.create_task(_header(client, bucket, head, writer.size, finishing[-1], parsing)))
+            writer, outcome, head = None, None, None
+          elif field_name is not None:
+            fields[field_name] = field_value.decode("utf-8")
+            field_name = None
+      collector.events.clear()
+    parser.finalize()
+  except BaseException:
+    if writer is not None:
+      await writer.abort()
+    for task in headers:
+      task.cancel()
+    await asyncio.gather(*headers, return_exceptions=True)
+    finished = await asyncio.gather(*finishing, return_exceptions=True)
+    await delete_objects(client, bucket, uploaded_here(
+      [done for done in finished if isinstance(done, FileUploadOutcome)]
+    ))
+    raise
+
+  return fields, list(await asyncio.gather(*finishing)), list(await asyncio.gather(*headers))
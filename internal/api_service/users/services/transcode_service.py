@@ -0,0 +1,211 @@
+import asyncio
+import json
+import os
+import time
+from io import BytesIO
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+import pydicom
+from pydicom.uid import DeflatedExplicitVRLittleEndian, RLELossless
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from cloud_services import run_s3
+from users.services.upload_service import delete_objects
+from workers import run_cpu, CPU_WORKERS
+
+# lossless storage syntaxes pydicom encodes and decodes on CPU without plugins
+SYNTAXES = {"rle": RLELossless, "deflate": DeflatedExplicitVRLittleEndian}
+# none | rle | deflate: what new slices are stored as
+STORE_COMPRESSED = os.getenv("STORE_COMPRESSED", "none").lower()
+# keep the uncompressed upload next to the compressed copy
+KEEP_ORIGINALS = os.getenv("KEEP_ORIGINALS", "0") == "1"
+# files transcoded at once; bounds the original bytes held in memory
+FILES_IN_FLIGHT = 2 * CPU_WORKERS
+# files swapped over per transaction
+UPDATE_BATCH = 64
+
+
+def compressed_key(object_key: str, method: str) -> str:
+  return f"{object_key}.{method}"
+
+
+def _decode_ms(data: bytes) -> Tuple[np.ndarray, float]:
+  start = time.perf_counter()
+  pixels = pydicom.dcmread(BytesIO(data), force=True).pixel_array
+  return pixels, (time.perf_counter() - start) * 1000
+
+
+def transcode(data: bytes, method: str) -> Optional[Tuple[bytes, dict]]:
+  """
+  Losslessly re-encode one DICOM file with the `method` transfer syntax.
+  Returns (encoded file, stats) or None when the file is not DICOM, has no
+  pixel data, is already compressed, or would not get smaller. Every
+  result is decoded again and compared with the original pixels.
+  """
+  target = SYNTAXES[method]
+  try:
+    ds = pydicom.dcmread(BytesIO(data), force=True)
+    source = ds.file_meta.get("TransferSyntaxUID") if getattr(ds, "file_meta", None) is not None else None
+    if "PixelData" not in ds or source is None or source.is_compressed or source.is_deflated:
+      return None
+    original, original_ms = _decode_ms(data)
+    start = time.perf_counter()
+    if target.is_compressed:
+      ds.compress(target)
+    else:
+      ds.file_meta.TransferSyntaxUID = target
+    out = BytesIO()
+    ds.save_as(out, enforce_file_format=True)
+    encode_ms = (time.perf_counter() - start) * 1000
+    encoded = out.getvalue()
+    if len(encoded) >= len(data):
+      return None
+    stored, stored_ms = _decode_ms(encoded)
+  except Exception:
+    # anything pydicom cannot round trip stays as it was uploaded
+    return None
+  if not np.array_equal(original, stored):
+    return None
+  return encoded, {
+    "source_syntax": str(source),
+    "stored_syntax": str(target),
+    "original_size": len(data),
+    "stored_size": len(encoded),
+    "encode_ms": encode_ms,
+    "original_decode_ms": original_ms,
+    "stored_decode_ms": stored_ms,
+  }
+
+
+def _get_object(client, bucket: str, key: str) -> bytes:
+  return client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+
+async def _transcode_file(client, bucket: str, file_id: int, object_key: str, method: str, slots: asyncio.Semaphore) -> Optional[dict]:
+  async with slots:
+    data = await run_s3(_get_object, client, bucket, object_key)
+    result = await run_cpu(transcode, data, method)
+    del data
+  if result is None:
+    return None
+  encoded, stats = result
+  key = compressed_key(object_key, method)
+  await run_s3(
+    client.put_object, Bucket=bucket, Key=key, Body=encoded,
+    ContentType="application/dicom", CacheControl="private, max-age=31536000, immutable"
+  )
+  return {"file_id": file_id, "object_key": key, "original_key": object_key, **stats}
+
+
+async def _swap(session: AsyncSession, rows: List[dict]) -> List[dict]:
+  """
+  Point FILERECORDS at the compressed copies and record the stats, in one
+  statement. Files changed meanwhile are left alone. Returns the rows applied.
+  """
+  if not rows:
+    return []
+  result = await session.execute(
+    text("""
+      WITH t AS (
+        SELECT * FROM jsonb_to_recordset(CAST(:rows AS JSONB)) AS t(
+          file_id INT, object_key VARCHAR, original_key VARCHAR, source_syntax VARCHAR, stored_syntax VARCHAR,
+          original_size BIGINT, stored_size BIGINT, encode_ms DOUBLE PRECISION,
+          original_decode_ms DOUBLE PRECISION, stored_decode_ms DOUBLE PRECISION
+        )
+      ), swapped AS (
+        UPDATE FILERECORDS f SET OBJECT_KEY = t.object_key
+        FROM t
+        WHERE f.FILE_ID = t.file_id AND f.OBJECT_KEY = t.original_key
+        RETURNING f.FILE_ID
+      )
+      INSERT INTO FILETRANSCODES (
+        FILE_ID, ORIGINAL_KEY, SOURCE_SYNTAX, STORED_SYNTAX, ORIGINAL_SIZE, STORED_SIZE,
+        ENCODE_MS, ORIGINAL_DECODE_MS, STORED_DECODE_MS
+      )
+      SELECT t.file_id, CASE WHEN CAST(:keep AS BOOLEAN) THEN t.original_key END, t.source_syntax,
+        t.stored_syntax, t.original_size, t.stored_size, t.encode_ms, t.original_decode_ms, t.stored_decode_ms
+      FROM t JOIN swapped s ON s.FILE_ID = t.file_id
+      ON CONFLICT (FILE_ID) DO NOTHING
+      RETURNING FILE_ID
+    """).bindparams(rows=json.dumps(rows), keep=KEEP_ORIGINALS)
+  )
+  applied = {row[0] for row in result}
+  await session.commit()
+  return [row for row in rows if row["file_id"] in applied]
+
+
+async def transcode_files(
+  sessionmaker: async_sessionmaker,
+  client,
+  bucket: str,
+  files: Iterable[Tuple[int, str, str]],
+) -> None:
+  """
+  Store the (file_id, filetype, object_key) slices compressed, when
+  STORE_COMPRESSED asks for it. Runs after the response is sent and after
+  the other derivatives, which read the originals. The originals are
+  deleted once the swap commits, unless KEEP_ORIGINALS is set.
+  """
+  method = STORE_COMPRESSED
+  if method not in SYNTAXES:
+    return
+  files = list({
+    file_id: (file_id, key) for file_id, filetype, key in files if file_id is not None and filetype == "slice"
+  }.values())
+  if not files:
+    return
+  async with sessionmaker() as session:
+    # shared files may already be stored compressed
+    result = await session.execute(
+      text("SELECT FILE_ID FROM FILETRANSCODES WHERE FILE_ID = ANY(CAST(:file_ids AS INT[]))").bindparams(
+        file_ids=[file_id for file_id, _ in files])
+    )
+    done = {row[0] for row in result}
+    await session.rollback()
+    todo = [file for file in files if file[0] not in done]
+    slots = asyncio.Semaphore(FILES_IN_FLIGHT)
+    for i in range(0, len(todo), UPDATE_BATCH):
+      batch = todo[i:i + UPDATE_BATCH]
+      results = await asyncio.gather(
+        *(_transcode_file(client, bucket, file_id, key, method, slots) for file_id, key in batch),
+        return_exceptions=True
+      )
+      rows = []
+      for (file_id, _), result in zip(batch, results):
+        if isinstance(result, BaseException):
+          print(f"failed to transcode file {file_id}: {result}")
+        elif result is not None:
+          rows.append(result)
+      applied = await _swap(session, rows)
+      applied_ids = {row["file_id"] for row in applied}
+      # copies that lost the race are dropped, and so are replaced originals
+      await delete_objects(client, bucket, [row["object_key"] for row in rows if row["file_id"] not in applied_ids])
+      if not KEEP_ORIGINALS:
+        await delete_objects(client, bucket, [row["original_key"] for row in applied])
+
+
+async def compression_by_series(session: AsyncSession, aid: int, dicom_id: int) -> List[dict]:
+  """Per-series compression ratio and decode cost of an accession's transcoded slices."""
+  result = await session.execute(
+    text("""
+      SELECT h.SERIES_INSTANCE_UID, t.STORED_SYNTAX,
+        COUNT(*) AS FILES,
+        SUM(t.ORIGINAL_SIZE) AS ORIGINAL_BYTES,
+        SUM(t.STORED_SIZE) AS STORED_BYTES,
+        SUM(t.ORIGINAL_SIZE)::DOUBLE PRECISION / NULLIF(SUM(t.STORED_SIZE), 0) AS COMPRESSION_RATIO,
+        AVG(t.ENCODE_MS) AS MEAN_ENCODE_MS,
+        AVG(t.ORIGINAL_DECODE_MS) AS MEAN_ORIGINAL_DECODE_MS,
+        AVG(t.STORED_DECODE_MS) AS MEAN_STORED_DECODE_MS,
+        COUNT(t.ORIGINAL_KEY) AS ORIGINALS_KEPT
+      FROM PATIENTDICOMS pd
+      JOIN DICOMFILES df ON df.DICOM_ID = pd.DICOM_ID
+      JOIN FILETRANSCODES t ON t.FILE_ID = df.FILE_ID
+      LEFT JOIN DICOMHEADERS h ON h.FILE_ID = df.FILE_ID
+      WHERE pd.PATIENT_ID = :aid AND pd.DICOM_ID = :dicom_id
+      GROUP BY h.SERIES_INSTANCE_UID, t.STORED_SYNTAX
+      ORDER BY h.SERIES_INSTANCE_UID NULLS LAST, t.STORED_SYNTAX
+    """).bindparams(aid=aid, dicom_id=dicom_id)
+  )
+  return [dict(row) for row in result.mappings()]
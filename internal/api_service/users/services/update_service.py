@@ -0,0 +1,248 @@
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_service.models.py_models import FileChange, FileUploadOutcome
+from users.services.upload_service import ORPHAN_GRACE_SECONDS
+
+OPS = {"add", "replace", "remove"}
+
+# the accession's PATIENTDICOMS row is locked for the whole update, so two
+# updates of one accession run one after the other against the same files
+LOCK_ACCESSION = text("""
+  SELECT d.DICOM_ID, d.DICOM_NAME
+  FROM PATIENTDICOMS pd
+  JOIN DICOMS d ON d.DICOM_ID = pd.DICOM_ID
+  WHERE pd.PATIENT_ID = :aid AND pd.DICOM_ID = :dicom_id
+  FOR UPDATE OF pd
+""")
+
+CURRENT_FILES = text("""
+  SELECT f.FILE_ID, f.FILETYPE, f.OBJECT_KEY, f.CONTENT_HASH
+  FROM DICOMFILES df
+  JOIN FILERECORDS f ON f.FILE_ID = df.FILE_ID
+  WHERE df.DICOM_ID = :dicom_id
+""")
+
+# files no accession links any more keep their row and object at
+# REF_COUNT 0 for a grace period, so the same content uploaded again is
+# relinked, not resent; then the reconciler releases them
+UNLINK_FILES = text("""
+  WITH removed AS (
+    DELETE FROM DICOMFILES
+    WHERE DICOM_ID = :dicom_id AND FILE_ID = ANY(CAST(:file_ids AS INT[]))
+    RETURNING FILE_ID
+  ), released AS (
+    UPDATE FILERECORDS f SET REF_COUNT = GREATEST(f.REF_COUNT - 1, 0)
+    FROM removed r
+    WHERE f.FILE_ID = r.FILE_ID
+    RETURNING f.FILE_ID, f.OBJECT_KEY, f.REF_COUNT
+  ), queued AS (
+    INSERT INTO STORAGE_OUTBOX (KIND, PAYLOAD, NEXT_ATTEMPT_AT)
+    SELECT 'release_files', jsonb_build_object('file_ids', jsonb_agg(FILE_ID)),
+      NOW() + make_interval(secs => CAST(:grace AS DOUBLE PRECISION))
+    FROM released
+    WHERE REF_COUNT = 0
+    HAVING COUNT(*) > 0
+  )
+  SELECT FILE_ID, OBJECT_KEY, REF_COUNT FROM released
+""")
+
+# the file half of INSERT_ACCESSION, against an existing accession
+LINK_FILES = text("""
+  WITH new_files AS (
+    INSERT INTO FILERECORDS (FILETYPE, OBJECT_KEY, CONTENT_HASH)
+    SELECT * FROM unnest(
+      CAST(:filetypes AS VARCHAR[]), CAST(:object_keys AS VARCHAR[]), CAST(:content_hashes AS CHAR(64)[])
+    )
+    ON CONFLICT (CONTENT_HASH, FILETYPE) WHERE CONTENT_HASH IS NOT NULL
+    DO UPDATE SET REF_COUNT = FILERECORDS.REF_COUNT + 1
+    RETURNING FILE_ID, FILETYPE, OBJECT_KEY, CONTENT_HASH
+  ), dicom_files AS (
+    INSERT INTO DICOMFILES (DICOM_ID, FILE_ID)
+    SELECT CAST(:dicom_id AS INT), FILE_ID FROM new_files
+  ), patient_files AS (
+    INSERT INTO PATIENTFILES (FILE_ID, AID)
+    SELECT FILE_ID, CAST(:aid AS INT) FROM new_files
+    ON CONFLICT DO NOTHING
+  )
+  SELECT FILE_ID, FILETYPE, OBJECT_KEY, CONTENT_HASH FROM new_files
+""")
+
+# packed volumes of the series a change touched are dropped and repacked
+DROP_VOLUMES = text("""
+  DELETE FROM SERIESVOLUMES v
+  WHERE v.DICOM_ID = :dicom_id AND v.SERIES_INSTANCE_UID IN (
+    SELECT h.SERIES_INSTANCE_UID FROM DICOMHEADERS h
+    WHERE h.FILE_ID = ANY(CAST(:file_ids AS INT[])) AND h.SERIES_INSTANCE_UID IS NOT NULL
+  )
+  RETURNING v.OBJECT_KEY
+""")
+
+
+class ChangeError(Exception):
+  pass
+
+
+class ChangeConflict(ChangeError):
+  """The change names a file the accession does not (or no longer) hold as described."""
+
+
+async def lock_accession(session: AsyncSession, aid: int, dicom_id: int) -> Optional[Tuple[dict, List[dict]]]:
+  """
+  Lock an accession the caller owns for update and return (accession, files),
+  or None when it is not the caller's. Does not commit.
+  """
+  result = await session.execute(LOCK_ACCESSION.bindparams(aid=aid, dicom_id=dicom_id))
+  accession = result.mappings().first()
+  if accession is None:
+    return None
+  result = await session.execute(CURRENT_FILES.bindparams(dicom_id=dicom_id))
+  return dict(accession), [dict(row) for row in result.mappings()]
+
+
+def _target(change: FileChange, by_key: Dict[str, dict], by_hash: Dict[str, List[dict]]) -> dict:
+  """The stored file a replace / remove points at, by object key, content hash, or both."""
+  if change.object_key is None and change.sha256 is None:
+    raise ChangeError(f"{change.op} needs the object_key or sha256 of the file it changes")
+  if change.object_key is not None:
+    target = by_key.get(change.object_key)
+    if target is None:
+      raise ChangeConflict(f"{change.object_key} is not part of the accession")
+    if change.sha256 is not None and target["content_hash"] != change.sha256.lower():
+      raise ChangeConflict(f"{change.object_key} does not hold content {change.sha256}")
+    return target
+  candidates = [
+    file for file in by_hash.get(change.sha256.lower(), [])
+    if change.filetype is None or file["filetype"] == change.filetype
+  ]
+  if not candidates:
+    raise ChangeConflict(f"No file of the accession holds content {change.sha256}")
+  if len(candidates) > 1:
+    raise ChangeError(f"Content {change.sha256} is both a slice and a mask, set filetype")
+  return candidates[0]
+
+
+def plan_changes(
+  files: List[dict], changes: List[FileChange], parts: Dict[str, BinaryIO]
+) -> Tuple[List[Tuple[FileChange, str, Optional[dict]]], List[dict]]:
+  """
+  Check a diff against the accession's current files before anything is
+  uploaded. Returns the uploads as (change, filetype, replaced file or None)
+  and the files to remove. Raises ChangeConflict when a change names a
+  file the accession does not hold, ChangeError when the diff is malformed.
+  """
+  by_key = {file["object_key"]: file for file in files}
+  by_hash: Dict[str, List[dict]] = {}
+  for file in files:
+    if file["content_hash"] is not None:
+      by_hash.setdefault(file["content_hash"], []).append(file)
+  uploads, removed, touched = [], [], set()
+  for change in changes:
+    if change.op not in OPS:
+      raise ChangeError(f"Unknown op {change.op!r}, expected add, replace or remove")
+    if change.filetype is not None and change.filetype not in ("slice", "mask"):
+      raise ChangeError(f"Unknown filetype {change.filetype!r}")
+    target = None
+    if change.op in ("replace", "remove"):
+      target = _target(change, by_key, by_hash)
+      if target["file_id"] in touched:
+        raise ChangeError(f"{target['object_key']} is changed more than once")
+      touched.add(target["file_id"])
+    if change.op in ("add", "replace"):
+      if not change.filename or change.filename not in parts:
+        raise ChangeError(f"{change.op} needs a file part, {change.filename!r} was not sent")
+      filetype = change.filetype or (target["filetype"] if target is not None else "slice")
+      uploads.append((change, filetype, target))
+    else:
+      removed.append(target)
+  return uploads, removed
+
+
+def resolve_changes(
+  files: List[dict],
+  uploads: List[Tuple[FileChange, str, Optional[dict]]],
+  outcomes: List[FileUploadOutcome],
+  removed: List[dict],
+) -> Tuple[List[FileUploadOutcome], List[dict], List[FileUploadOutcome]]:
+  """
+  Drop the changes that would leave the accession as it is, now the new
+  contents are hashed: content the accession already holds is not linked
+  twice, and a file replaced (or removed and added back) with its own
+  content stays linked. Returns (outcomes to link, files to unlink,
+  unchanged outcomes).
+  """
+  unlink = {file["file_id"]: file for file in removed}
+  unlink.update({target["file_id"]: target for _, _, target in uploads if target is not None})
+  unlinking = {
+    (file["filetype"], file["content_hash"]): file["file_id"]
+    for file in unlink.values()
+    if file["content_hash"] is not None
+  }
+  linked = {
+    (file["filetype"], file["content_hash"])
+    for file in files
+    if file["content_hash"] is not None and file["file_id"] not in unlink
+  }
+  link, unchanged = [], []
+  for (_, filetype, _), outcome in zip(uploads, outcomes):
+    content = (filetype, outcome.content_hash)
+    if content in unlinking and content not in linked:
+      unlink.pop(unlinking.pop(content))
+      linked.add(content)
+      unchanged.append(outcome)
+    elif content in linked:
+      unchanged.append(outcome)
+    else:
+      linked.add(content)
+      link.append(outcome)
+  return link, list(unlink.values()), unchanged
+
+
+async def apply_changes(
+  session: AsyncSession,
+  aid: int,
+  dicom_id: int,
+  link: List[FileUploadOutcome],
+  unlink: List[dict],
+  dicom_name: Optional[str] = None,
+) -> List[dict]:
+  """
+  Unlink and link the changed files of a locked accession: only their
+  DICOMFILES rows and REF_COUNTs are touched. Does not commit.
+  Returns the linked file rows.
+  """
+  if unlink:
+    await session.execute(UNLINK_FILES.bindparams(
+      dicom_id=dicom_id, file_ids=[file["file_id"] for file in unlink], grace=ORPHAN_GRACE_SECONDS))
+  rows = []
+  if link:
+    result = await session.execute(
+      LINK_FILES.bindparams(
+        aid=aid,
+        dicom_id=dicom_id,
+        filetypes=[outcome.filetype for outcome in link],
+        object_keys=[outcome.object_key for outcome in link],
+        content_hashes=[outcome.content_hash for outcome in link],
+      )
+    )
+    rows = [dict(row) for row in result.mappings()]
+  if dicom_name is not None:
+    await session.execute(
+      text("UPDATE DICOMS SET DICOM_NAME = :dicom_name WHERE DICOM_ID = :dicom_id").bindparams(
+        dicom_name=dicom_name, dicom_id=dicom_id)
+    )
+  return rows
+
+
+async def drop_stale_volumes(session: AsyncSession, dicom_id: int, file_ids: List[int]) -> List[str]:
+  """
+  Drop the packed volumes of every series a linked or unlinked file belongs
+  to; call it once the new files' headers are indexed. Does not commit.
+  Returns the keys of the dropped volume objects.
+  """
+  if not file_ids:
+    return []
+  result = await session.execute(DROP_VOLUMES.bindparams(dicom_id=dicom_id, file_ids=file_ids))
+  return [row[0] for row in result]
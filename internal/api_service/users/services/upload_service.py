@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import os
+from datetime import datetime, timedelta, timezone
+from typing import BinaryIO, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cloud_services import run_s3, transfer_config, MB
+from db_service.models.py_models import FileUploadOutcome
+from users.services.accession_service import known_content
+
+# identical files are stored once, under a key derived from their sha256
+CONTENT_PREFIX = "/Dicoms/sha256/"
+# objects no row references are deleted by the reconciler once they are
+# this old; until half of that they may still be reused by a new upload
+ORPHAN_GRACE_SECONDS = int(os.getenv("ORPHAN_GRACE_SECONDS", str(6 * 3600)))
+
+
+def owner_prefix(aid: int) -> str:
+  return f"/Dicoms/{aid}/"
+
+
+def make_object_key(aid: int, filename: str) -> str:
+  return f"{owner_prefix(aid)}{datetime.now()}_{filename}"
+
+
+def content_key(content_hash: str) -> str:
+  return f"{CONTENT_PREFIX}{content_hash[:2]}/{content_hash}"
+
+
+def staged_key(aid: int, content_hash: str) -> str:
+  """Where a client PUTs content it has not proven to hold yet, under its own prefix."""
+  return f"{owner_prefix(aid)}sha256/{content_hash}"
+
+
+def hash_from_staged_key(aid: int, key: str) -> Optional[str]:
+  prefix = f"{owner_prefix(aid)}sha256/"
+  if not key.startswith(prefix):
+    return None
+  return key[len(prefix):]
+
+
+def hash_from_key(key: str) -> Optional[str]:
+  if not key.startswith(CONTENT_PREFIX):
+    return None
+  return key.rsplit("/", 1)[-1]
+
+
+def _hash_file(fileobj: BinaryIO) -> Tuple[str, int]:
+  digest = hashlib.sha256()
+  size = 0
+  fileobj.seek(0)
+  while chunk := fileobj.read(MB):
+    digest.update(chunk)
+    size += len(chunk)
+  fileobj.seek(0)
+  return digest.hexdigest(), size
+
+
+def _reusable_object(client, bucket: str, key: str) -> bool:
+  # an older object may be an orphan the reconciler is about to delete: it
+  # is uploaded again instead, which also resets its age
+  try:
+    response = client.head_object(Bucket=bucket, Key=key)
+  except Exception:
+    return False
+  return response["LastModified"] >= datetime.now(timezone.utc) - timedelta(seconds=ORPHAN_GRACE_SECONDS / 2)
+
+
+async def stored_content(client, bucket: str, session: Optional[AsyncSession], content_hashes: Iterable[str]) -> Set[str]:
+  """
+  Which content hashes are already in the bucket: one query for the ones
+  with a FILERECORDS row, then a HEAD for the rest (objects left behind by
+  requests that never committed are reused too).
+  """
+  content_hashes = set(content_hashes)
+  known = await known_content(session, content_hashes) if session is not None else set()
+  unknown = sorted(content_hashes - known)
+  found = await asyncio.gather(*(run_s3(_reusable_object, client, bucket, content_key(h)) for h in unknown))
+  return known | {h for h, exists in zip(unknown, found) if exists}
+
+
+def _put_file(client, bucket: str, key: str, fileobj: BinaryIO) -> None:
+  fileobj.seek(0)
+  client.upload_fileobj(fileobj, bucket, key, Config=transfer_config)
+
+
+async def upload_file(client, bucket: str, outcome: FileUploadOutcome, fileobj: BinaryIO) -> FileUploadOutcome:
+  try:
+    await run_s3(_put_file, client, bucket, outcome.object_key, fileobj)
+    outcome.status = "uploaded"
+  except Exception as e:
+    outcome.status = "failed"
+    outcome.error = str(e)
+  return outcome
+
+
+async def upload_files(
+  client,
+  bucket: str,
+  uploads: List[Tuple[str, BinaryIO]],
+  session: Optional[AsyncSession] = None,
+) -> List[FileUploadOutcome]:
+  """
+  Upload (filename, fileobj) pairs to S3 concurrently under content-addressed
+  keys, skipping files whose content is already stored.
+  Hashing and transfers run on the shared S3 thread pool, so at most
+  S3_MAX_CONCURRENCY files are in flight per worker and the event loop keeps
+  serving requests. Returns one outcome per file, in input order.
+  """
+  hashed = await asyncio.gather(*(run_s3(_hash_file, fileobj) for _, fileobj in uploads))
+  stored = await stored_content(client, bucket, session, (content_hash for content_hash, _ in hashed))
+
+  pending = {}
+  outcomes: List[FileUploadOutcome] = []
+  for (filename, fileobj), (content_hash, size) in zip(uploads, hashed):
+    outcome = FileUploadOutcome(
+      filename=filename, object_key=content_key(content_hash), content_hash=content_hash, size=size
+    )
+    outcomes.append(outcome)
+    if content_hash in stored or content_hash in pending:
+      outcome.status = "uploaded"
+      outcome.deduplicated = True
+    else:
+      pending[content_hash] = outcome
+  await asyncio.gather(*(
+    upload_file(client, bucket, outcome, fileobj)
+    for outcome, (_, fileobj) in zip(outcomes, uploads)
+    if pending.get(outcome.content_hash) is outcome
+  ))
+  # a copy that piggybacked on a PUT from this same request fails with it
+  for outcome in outcomes:
+    source = pending.get(outcome.content_hash)
+    if outcome.deduplicated and source is not None and source.status == "failed":
+      outcome.status = "failed"
+      outcome.error = source.error
+  return outcomes
+
+
+def _delete_keys(client, bucket: str, keys: List[str]) -> List[str]:
+  failed = []
+  # delete_objects takes at most 1000 keys per call
+  for i in range(0, len(keys), 1000):
+    response = client.delete_objects(
+      Bucket=bucket,
+      Delete={"Objects": [{"Key": key} for key in keys[i:i + 1000]], "Quiet": True}
+    )
+    failed.extend(error["Key"] for error in response.get("Errors", []))
+  return failed
+
+
+async def delete_objects(client, bucket: str, keys: List[str]) -> List[str]:
+  """Best-effort removal of objects. Returns the keys that could not be deleted."""
+  if not keys:
+    return []
+  try:
+    failed = await run_s3(_delete_keys, client, bucket, keys)
+  except Exception as e:
+    print(f"failed to clean up {len(keys)} objects: {e}")
+    return list(keys)
+  if failed:
+    print(f"failed to clean up {len(failed)} of {len(keys)} objects")
+  return failed
+
+
+def uploaded_here(outcomes: List[FileUploadOutcome]) -> List[str]:
+  """Keys this request actually wrote; deduplicated objects belong to other accessions."""
+  return [o.object_key for o in outcomes if o.status == "uploaded" and not o.deduplicated]
+
+
+def reported_outcomes(outcomes: List[FileUploadOutcome], owned: Set[str]) -> List[FileUploadOutcome]:
+  """
+  Outcomes as the caller may see them. Content found under another
+  account is deduplicated all the same, but reported as a plain upload:
+  only `owned` hashes (see owned_content) say they were already stored.
+  """
+  return [
+    outcome.model_copy(update={"deduplicated": False})
+    if outcome.deduplicated and outcome.content_hash not in owned else outcome
+    for outcome in outcomes
+  ]
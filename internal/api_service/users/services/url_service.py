@@ -0,0 +1,115 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from cloud_services import run_s3
+
+URL_EXPIRATION_TIME = 3600
+# a cached URL is handed out only while it has at least this long left, so
+# clients always get one they can use for most of an hour
+MIN_REMAINING = int(os.getenv("PRESIGN_MIN_REMAINING_SECONDS", str(URL_EXPIRATION_TIME // 2)))
+PRESIGN_CACHE_SIZE = int(os.getenv("PRESIGN_CACHE_SIZE", "100000"))
+
+
+class PresignedUrlCache:
+  """
+  Presigned GET URLs by (bucket, object key), oldest first. An entry is
+  served until it has less than MIN_REMAINING seconds left, then reissued;
+  past `size` entries the oldest go first, which are also the closest to
+  expiring. Only used from the event loop, so it needs no lock.
+  """
+
+  def __init__(self, size: int = PRESIGN_CACHE_SIZE, ttl: int = URL_EXPIRATION_TIME - MIN_REMAINING) -> None:
+    self.size = size
+    self.ttl = ttl
+    self.entries: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.expired = 0
+    self.evicted = 0
+
+  def _purge(self, now: float) -> None:
+    # entries are in issue order, so the stale ones are all at the front
+    while self.entries:
+      _, issued = next(iter(self.entries.values()))
+      if now - issued < self.ttl:
+        break
+      self.entries.popitem(last=False)
+      self.expired += 1
+
+  def get_many(self, bucket: str, keys: Iterable[str]) -> Tuple[Dict[str, str], List[str]]:
+    """(cached URLs by key, keys that need signing)."""
+    now = time.monotonic()
+    self._purge(now)
+    found, missing = {}, []
+    for key in keys:
+      entry = self.entries.get((bucket, key))
+      if entry is not None:
+        found[key] = entry[0]
+      else:
+        missing.append(key)
+    self.hits += len(found)
+    self.misses += len(missing)
+    return found, missing
+
+  def put_many(self, bucket: str, urls: Dict[str, str]) -> None:
+    now = time.monotonic()
+    for key, url in urls.items():
+      self.entries[(bucket, key)] = (url, now)
+      self.entries.move_to_end((bucket, key))
+    while len(self.entries) > self.size:
+      self.entries.popitem(last=False)
+      self.evicted += 1
+
+  def clear(self) -> None:
+    self.entries.clear()
+
+  def stats(self) -> dict:
+    lookups = self.hits + self.misses
+    return {
+      "entries": len(self.entries),
+      "size": self.size,
+      "ttl_seconds": self.ttl,
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_ratio": self.hits / lookups if lookups else None,
+      "expired": self.expired,
+      "evicted": self.evicted,
+    }
+
+
+url_cache = PresignedUrlCache()
+
+
+def _sign(client, bucket: str, keys: List[str]) -> Dict[str, str]:
+  urls = {}
+  for key in keys:
+    try:
+      urls[key] = client.generate_presigned_url(
+        ClientMethod="get_object",
+        Params={"Bucket": bucket, "Key": key},
+        ExpiresIn=URL_EXPIRATION_TIME
+      )
+    except Exception as e:
+      print(f"{e}")
+  return urls
+
+
+async def presigned_urls(client, bucket: str, keys: Iterable[str]) -> Dict[str, str]:
+  """
+  Presigned GET URLs of every key, from the cache where possible. The rest
+  are signed in a single executor call, off the event loop. Keys that
+  cannot be signed are missing from the result.
+  """
+  keys = [key for key in dict.fromkeys(keys) if key]
+  urls, missing = url_cache.get_many(bucket, keys)
+  if missing:
+    signed = await run_s3(_sign, client, bucket, missing)
+    url_cache.put_many(bucket, signed)
+    urls.update(signed)
+  return urls
+
+
+async def presigned_url(client, bucket: str, key: str) -> Optional[str]:
+  return (await presigned_urls(client, bucket, [key])).get(key)
@@ -1,6 +1,7 @@
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
-from auth.utils.auth_utils import get_password_hash
+from typing import Tuple
+from auth.utils.auth_utils import get_password_hash_async
 from users.models.accounts import Accounts
 from users.models.users import User
 
@@ -17,9 +18,22 @@ async def get_user_by_email(email: str, session: AsyncSession) -> Accounts | Non
   return Accounts(**normalized_record)
 
 
+async def get_credentials(email: str, session: AsyncSession) -> Tuple[Accounts, bytes] | None:
+  """The account of an email and its password hash, for logins only."""
+  result = await session.execute(
+    text("SELECT AID, PSWRD_HASH FROM ACCOUNTS WHERE EMAIL=:email"),
+    {"email": email}
+  )
+  record = result.mappings().first()
+  if record is None:
+    return None
+  normalized_record = {key.lower(): value for key, value in record.items()}
+  return Accounts(aid=normalized_record["aid"]), normalized_record["pswrd_hash"]
+
+
 async def create_user(user: User, session: AsyncSession) -> Accounts:
   """Create a new account record and return the persisted account."""
-  hashed_pwd = get_password_hash(user.password)
+  hashed_pwd = await get_password_hash_async(user.password)
   result = await session.execute(
     text(
       """
@@ -30,7 +44,7 @@ async def create_user(user: User, session: AsyncSession) -> Accounts:
     ),
     {
       "username": user.username,
-      "hashed_pwd": hashed_pwd,
+      "hashed_pwd": hashed_pwd.encode("utf-8"),
       "f_name": user.fname,
       "l_name": user.lname,
       "email": user.email,
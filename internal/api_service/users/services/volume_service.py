@@ -0,0 +1,326 @@
+import asyncio
+import itertools
+import json
+import os
+import struct
+import tempfile
+from io import BytesIO
+from collections import deque
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import numpy as np
+import pydicom
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from cloud_services import run_s3, transfer_config, MB
+from workers import run_cpu, CPU_WORKERS
+
+# packed volumes are optional: one object per series next to the slices
+PACK_VOLUMES = os.getenv("PACK_VOLUMES", "1") == "1"
+
+# Volume object layout (little endian):
+#   preamble   MAGIC, format version, header length, data offset
+#   header     compact JSON: shape, dtype, spacing, per-slice rescale and
+#              positions, and the byte offset of every slice
+#   padding    up to DATA_ALIGNMENT
+#   pixels     one raw int16 rows x columns block per slice, in display order
+# A slice, or a slab of neighbouring slices, is a single HTTP range read.
+MAGIC = b"PIVOLUME"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("<8sIIQ")
+DATA_ALIGNMENT = 4096
+DTYPE = "<i2"
+CONTENT_TYPE = "application/vnd.pulseimaging.volume"
+# slices decoded at once; bounds the original bytes held in memory
+FILES_IN_FLIGHT = 2 * CPU_WORKERS
+# volumes of large series are spooled to disk past this size
+SPOOL_BYTES = 64 * MB
+# most pixel bytes one slab request may cover; without a stop a request gets
+# as many slices as fit
+MAX_SLAB_BYTES = int(os.getenv("MAX_SLAB_BYTES", str(256 * MB)))
+# bytes pulled from S3 per read while streaming a slab
+STREAM_CHUNK = MB
+# longest JSON a float can encode to; reserves header room for any rescale
+WIDEST_FLOAT = -2.2250738585072014e-308
+
+
+class VolumeError(Exception):
+  pass
+
+
+class SlabTooLarge(VolumeError):
+  pass
+
+
+def volume_key(dicom_id: int, series_uid: str) -> str:
+  return f"/Dicoms/volumes/{dicom_id}/{series_uid}.vol"
+
+
+def pack_slice(data: bytes) -> Tuple[bytes, float, float, int, int]:
+  """
+  Raw little endian int16 pixels of one single-frame slice, with its
+  rescale slope and intercept, rows and columns.
+  Raises VolumeError when the pixels do not fit int16.
+  """
+  ds = pydicom.dcmread(BytesIO(data), force=True)
+  pixels = ds.pixel_array
+  if pixels.ndim != 2:
+    raise VolumeError("Only single-frame grayscale slices can be packed")
+  if pixels.size and (int(pixels.min()) < -32768 or int(pixels.max()) > 32767):
+    raise VolumeError("Pixel values do not fit int16")
+  slope = float(ds.get("RescaleSlope", 1) or 1)
+  intercept = float(ds.get("RescaleIntercept", 0) or 0)
+  rows, columns = pixels.shape
+  return pixels.astype(DTYPE).tobytes(), slope, intercept, rows, columns
+
+
+def _spacing_between(positions: List[Optional[List[float]]]) -> Optional[float]:
+  """Mean distance between neighbouring slice positions, when all are known."""
+  if len(positions) < 2 or any(position is None for position in positions):
+    return None
+  points = np.asarray(positions, dtype=np.float64)
+  return float(np.linalg.norm(np.diff(points, axis=0), axis=1).mean())
+
+
+def build_header(
+  instances: List[dict], slopes: List[float], intercepts: List[float], data_offset: Optional[int] = None
+) -> Tuple[bytes, dict]:
+  """
+  Encoded preamble and header for an ordered series, padded to the data
+  offset, and the header as a dict. Every slice must share rows/columns.
+  A given data_offset (from reserve_header) is kept when the header fits.
+  """
+  rows, columns = instances[0]["rows"], instances[0]["columns"]
+  slice_bytes = rows * columns * np.dtype(DTYPE).itemsize
+  header = {
+    "version": FORMAT_VERSION,
+    "dtype": DTYPE,
+    "slices": len(instances),
+    "rows": rows,
+    "columns": columns,
+    "slice_bytes": slice_bytes,
+    "pixel_spacing": instances[0]["pixel_spacing"],
+    "slice_thickness": instances[0]["slice_thickness"],
+    "spacing_between_slices": _spacing_between([instance["image_position"] for instance in instances]),
+    "rescale_slope": slopes,
+    "rescale_intercept": intercepts,
+    "image_positions": [instance["image_position"] for instance in instances],
+    "instance_numbers": [instance["instance_number"] for instance in instances],
+    "file_ids": [instance["file_id"] for instance in instances],
+  }
+  # the offsets depend on the header length, which depends on the offsets:
+  # size the header with placeholder offsets, then round up to the alignment
+  header["data_offset"] = 0
+  header["offsets"] = [0] * len(instances)
+  length = PREAMBLE.size + len(json.dumps(header, separators=(",", ":")))
+  # room for the real offsets, which are at most 20 digits each
+  length += 20 * (len(instances) + 1)
+  required = -(-length // DATA_ALIGNMENT) * DATA_ALIGNMENT
+  if data_offset is None:
+    data_offset = required
+  elif data_offset < required:
+    raise VolumeError("The header does not fit before the reserved data offset")
+  header["data_offset"] = data_offset
+  header["offsets"] = [data_offset + i * slice_bytes for i in range(len(instances))]
+  encoded = json.dumps(header, separators=(",", ":")).encode("utf-8")
+  preamble = PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(encoded), data_offset)
+  return (preamble + encoded).ljust(data_offset, b"\0"), header
+
+
+def reserve_header(instances: List[dict]) -> int:
+  """
+  A data offset the header of this series fits before whatever rescale
+  values its slices turn out to have, so pixels can be written before the
+  header is known.
+  """
+  widest = [WIDEST_FLOAT] * len(instances)
+  return build_header(instances, widest, widest)[1]["data_offset"]
+
+
+def parse_preamble(data: bytes) -> Tuple[int, int]:
+  """(header length, data offset) from the first PREAMBLE.size bytes of a volume."""
+  magic, version, header_length, data_offset = PREAMBLE.unpack_from(data)
+  if magic != MAGIC or version != FORMAT_VERSION:
+    raise VolumeError("Not a packed volume, or an unsupported version")
+  return header_length, data_offset
+
+
+def slab_stop(volume: dict, start: int, stop: Optional[int]) -> int:
+  """
+  End of a slab request: as many slices from start as MAX_SLAB_BYTES allows
+  when stop is omitted. Raises SlabTooLarge for a longer explicit slab.
+  """
+  most = max(1, MAX_SLAB_BYTES // volume["slice_bytes"])
+  if stop is None:
+    return min(volume["slices"], start + most)
+  if stop - start > most:
+    raise SlabTooLarge(f"At most {most} slices of this volume can be read per request")
+  return stop
+
+
+def slab_range(volume: dict, start: int, stop: int) -> Tuple[int, int]:
+  """Inclusive byte range of slices [start, stop) for an HTTP Range header."""
+  if not 0 <= start < stop <= volume["slices"]:
+    raise VolumeError(f"Slices must satisfy 0 <= start < stop <= {volume['slices']}")
+  first = volume["data_offset"] + start * volume["slice_bytes"]
+  return first, first + (stop - start) * volume["slice_bytes"] - 1
+
+
+def _get_object(client, bucket: str, key: str) -> bytes:
+  return client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+
+async def stream_slab(client, bucket: str, volume: dict, first: int, last: int) -> AsyncIterator[bytes]:
+  """Bytes [first, last] of a volume from a single ranged GET, in STREAM_CHUNK pieces."""
+  body = (await run_s3(
+    client.get_object, Bucket=bucket, Key=volume["object_key"], Range=f"bytes={first}-{last}"
+  ))["Body"]
+  try:
+    while True:
+      chunk = await run_s3(body.read, STREAM_CHUNK)
+      if not chunk:
+        break
+      yield chunk
+  finally:
+    body.close()
+
+
+async def _series_to_pack(session: AsyncSession, dicom_id: int) -> Dict[str, List[dict]]:
+  """Indexed slices of an accession, grouped by series, in display order."""
+  result = await session.execute(
+    text("""
+      SELECT f.FILE_ID, f.OBJECT_KEY, h.SERIES_INSTANCE_UID, h.INSTANCE_NUMBER, h.IMAGE_POSITION,
+        h.PIXEL_SPACING, h.SLICE_THICKNESS, h.ROWS, h.COLUMNS
+      FROM DICOMFILES df
+      JOIN FILERECORDS f ON f.FILE_ID = df.FILE_ID
+      JOIN DICOMHEADERS h ON h.FILE_ID = df.FILE_ID
+      WHERE df.DICOM_ID = :dicom_id AND f.FILETYPE = 'slice' AND h.SERIES_INSTANCE_UID IS NOT NULL
+        AND h.ROWS IS NOT NULL AND h.COLUMNS IS NOT NULL
+        AND NOT EXISTS (
+          SELECT 1 FROM SERIESVOLUMES v
+          WHERE v.DICOM_ID = df.DICOM_ID AND v.SERIES_INSTANCE_UID = h.SERIES_INSTANCE_UID
+        )
+      ORDER BY h.SERIES_INSTANCE_UID, h.INSTANCE_NUMBER NULLS LAST, h.SLICE_LOCATION NULLS LAST, f.FILE_ID
+    """).bindparams(dicom_id=dicom_id)
+  )
+  series: Dict[str, List[dict]] = {}
+  for row in result.mappings():
+    series.setdefault(row["series_instance_uid"], []).append(dict(row))
+  return series
+
+
+async def _pack_series(client, bucket: str, dicom_id: int, series_uid: str, instances: List[dict]) -> dict:
+  """
+  Decode every slice of a series into a spooled volume and upload it as one
+  object. Slices are decoded FILES_IN_FLIGHT ahead and written out in
+  display order as they come, after room reserved for the header (which
+  carries each slice's rescale and is written last), so at most
+  FILES_IN_FLIGHT decoded slices are in memory.
+  """
+  if len({(instance["rows"], instance["columns"]) for instance in instances}) != 1:
+    raise VolumeError("Slices do not share one size")
+
+  async def decode(instance: dict) -> Tuple[bytes, float, float, int, int]:
+    data = await run_s3(_get_object, client, bucket, instance["object_key"])
+    return await run_cpu(pack_slice, data)
+
+  data_offset = reserve_header(instances)
+  slopes: List[float] = []
+  intercepts: List[float] = []
+  upcoming = iter(instances)
+  pending = deque((instance, asyncio.ensure_future(decode(instance)))
+                  for instance in itertools.islice(upcoming, FILES_IN_FLIGHT))
+  key = volume_key(dicom_id, series_uid)
+  volume = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+  try:
+    volume.seek(data_offset)
+    while pending:
+      instance, task = pending.popleft()
+      pixels, slope, intercept, rows, columns = await task
+      if (rows, columns) != (instance["rows"], instance["columns"]):
+        raise VolumeError("Decoded pixels do not match the indexed Rows/Columns")
+      following = next(upcoming, None)
+      if following is not None:
+        pending.append((following, asyncio.ensure_future(decode(following))))
+      # past SPOOL_BYTES this is a disk write
+      await run_s3(volume.write, pixels)
+      slopes.append(slope)
+      intercepts.append(intercept)
+    head, header = build_header(instances, slopes, intercepts, data_offset)
+
+    def upload() -> int:
+      size = volume.tell()
+      volume.seek(0)
+      volume.write(head)
+      volume.seek(0)
+      # large volumes go up as a parallel multipart upload
+      client.upload_fileobj(
+        volume, bucket, key, Config=transfer_config,
+        ExtraArgs={"ContentType": CONTENT_TYPE, "CacheControl": "private, max-age=31536000, immutable"}
+      )
+      return size
+
+    size = await run_s3(upload)
+  finally:
+    for _, task in pending:
+      task.cancel()
+    volume.close()
+  return {
+    "dicom_id": dicom_id, "series_instance_uid": series_uid, "object_key": key,
+    "slices": header["slices"], "rows": header["rows"], "columns": header["columns"],
+    "dtype": DTYPE, "data_offset": header["data_offset"], "slice_bytes": header["slice_bytes"],
+    "size_bytes": size, "header": header,
+  }
+
+
+async def generate_volumes(sessionmaker: async_sessionmaker, client, bucket: str, dicom_id: int) -> None:
+  """
+  Pack each indexed series of an accession into one volume object.
+  Runs after the response is sent; series that cannot be packed (mixed
+  sizes, multi-frame or non-int16 pixels) keep only their slices.
+  """
+  if not PACK_VOLUMES:
+    return
+  async with sessionmaker() as session:
+    series = await _series_to_pack(session, dicom_id)
+    await session.rollback()
+    # one series at a time keeps one volume spool open
+    for series_uid, instances in series.items():
+      try:
+        row = await _pack_series(client, bucket, dicom_id, series_uid, instances)
+      except Exception as e:
+        print(f"failed to pack series {series_uid} of accession {dicom_id}: {e}")
+        continue
+      await session.execute(
+        text("""
+          INSERT INTO SERIESVOLUMES (
+            DICOM_ID, SERIES_INSTANCE_UID, OBJECT_KEY, SLICE_COUNT, ROWS, COLUMNS, DTYPE,
+            DATA_OFFSET, SLICE_BYTES, SIZE_BYTES, HEADER
+          )
+          VALUES (
+            :dicom_id, :series_instance_uid, :object_key, :slices, :rows, :columns, :dtype,
+            :data_offset, :slice_bytes, :size_bytes, CAST(:header AS JSONB)
+          )
+          ON CONFLICT (DICOM_ID, SERIES_INSTANCE_UID) DO NOTHING
+        """).bindparams(**{**row, "header": json.dumps(row["header"])})
+      )
+      await session.commit()
+
+
+async def volumes_for_accession(
+  session: AsyncSession, aid: int, dicom_id: int, series_uid: Optional[str] = None
+) -> List[dict]:
+  """Packed volumes of an accession the caller owns, with their headers."""
+  result = await session.execute(
+    text("""
+      SELECT v.DICOM_ID, v.SERIES_INSTANCE_UID, v.OBJECT_KEY, v.SLICE_COUNT AS SLICES, v.ROWS, v.COLUMNS,
+        v.DTYPE, v.DATA_OFFSET, v.SLICE_BYTES, v.SIZE_BYTES, v.HEADER
+      FROM SERIESVOLUMES v
+      JOIN PATIENTDICOMS pd ON pd.DICOM_ID = v.DICOM_ID
+      WHERE pd.PATIENT_ID = :aid AND v.DICOM_ID = :dicom_id
+        AND (CAST(:series_uid AS VARCHAR) IS NULL OR v.SERIES_INSTANCE_UID = :series_uid)
+      ORDER BY v.SERIES_INSTANCE_UID
+    """).bindparams(aid=aid, dicom_id=dicom_id, series_uid=series_uid)
+  )
+  return [dict(row) for row in result.mappings()]
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import uuid
+from io import BytesIO
+from typing import AsyncIterator, List, Optional, Sequence, Tuple
+
+import pydicom
+from pydicom.encaps import get_frame
+
+from cloud_services import run_s3
+from workers import run_cpu
+
+# bytes pulled from S3 per read while streaming an instance
+STREAM_CHUNK = 1024 * 1024
+# instances are immutable once stored (keys are per upload or per content)
+CACHE_CONTROL = "private, max-age=31536000, immutable"
+# a study or series can gain instances later, so those are revalidated by ETag
+CACHE_REVALIDATE = "private, no-cache"
+# instance rows one retrieve may cover; past this the request is refused
+# rather than answered (and cached) with part of the study
+MAX_RETRIEVE_INSTANCES = int(os.getenv("MAX_RETRIEVE_INSTANCES", "20000"))
+
+# frame media types of encapsulated transfer syntaxes (PS3.18 table 8.7.3-5);
+# native (and deflated) pixel data goes out as application/octet-stream
+FRAME_MEDIA_TYPES = {
+  "1.2.840.10008.1.2.5": "image/x-dicom-rle",
+  "1.2.840.10008.1.2.4.50": "image/jpeg",
+  "1.2.840.10008.1.2.4.51": "image/jpeg",
+  "1.2.840.10008.1.2.4.57": "image/jpeg",
+  "1.2.840.10008.1.2.4.70": "image/jpeg",
+  "1.2.840.10008.1.2.4.80": "image/jls",
+  "1.2.840.10008.1.2.4.81": "image/jls",
+  "1.2.840.10008.1.2.4.90": "image/jp2",
+  "1.2.840.10008.1.2.4.91": "image/jp2",
+}
+
+
+class FrameError(Exception):
+  pass
+
+
+def parse_frame_list(frames: str) -> List[int]:
+  """'1,3,5' -> [1, 3, 5]; frame numbers are 1-based. Raises FrameError."""
+  try:
+    numbers = [int(frame) for frame in frames.split(",") if frame.strip()]
+  except ValueError:
+    raise FrameError(f"Frame list must be comma separated integers, got {frames!r}")
+  if not numbers or any(number < 1 for number in numbers):
+    raise FrameError("Frame numbers start at 1")
+  return numbers
+
+
+def accepts(accept: Optional[str], media_type: str) -> bool:
+  """Whether an Accept header allows multipart/related responses of `media_type` parts."""
+  if not accept:
+    return True
+  for option in accept.split(","):
+    option = option.strip().lower()
+    if option.startswith("*/*") or option.startswith("multipart/*"):
+      return True
+    if option.startswith("multipart/related"):
+      if "type=" not in option:
+        return True
+      wanted = option.split("type=", 1)[1].split(";", 1)[0].strip().strip('"')
+      if wanted in (media_type, "*/*", media_type.split("/")[0] + "/*"):
+        return True
+  return False
+
+
+def etag(file_ids: Sequence[int], *parts) -> str:
+  """Strong ETag for a response built from immutable files."""
+  digest = hashlib.sha256(",".join(str(part) for part in (*file_ids, *parts)).encode("utf-8"))
+  return f'"{digest.hexdigest()[:32]}"'
+
+
+def not_modified(if_none_match: Optional[str], tag: str) -> bool:
+  if not if_none_match:
+    return False
+  return if_none_match.strip() == "*" or tag in [value.strip() for value in if_none_match.split(",")]
+
+
+def new_boundary() -> str:
+  return uuid.uuid4().hex
+
+
+def content_type(boundary: str, media_type: str, transfer_syntax: Optional[str] = None) -> str:
+  value = f'multipart/related; type="{media_type}"; boundary={boundary}'
+  if transfer_syntax:
+    value += f"; transfer-syntax={transfer_syntax}"
+  return value
+
+
+def part_header(boundary: str, media_type: str, location: Optional[str] = None) -> bytes:
+  lines = [f"--{boundary}", f"Content-Type: {media_type}"]
+  if location:
+    lines.append(f"Content-Location: {location}")
+  return ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8")
+
+
+def closing(boundary: str) -> bytes:
+  return f"--{boundary}--\r\n".encode("utf-8")
+
+
+async def stream_object(client, bucket: str, key: str) -> AsyncIterator[bytes]:
+  """Yield an S3 object in STREAM_CHUNK pieces, each read off the event loop."""
+  body = (await run_s3(client.get_object, Bucket=bucket, Key=key))["Body"]
+  try:
+    while True:
+      chunk = await run_s3(body.read, STREAM_CHUNK)
+      if not chunk:
+        break
+      yield chunk
+  finally:
+    body.close()
+
+
+async def stream_instances(client, bucket: str, boundary: str, instances: List[dict]) -> AsyncIterator[bytes]:
+  """A multipart/related body of whole application/dicom instances, one S3 object at a time."""
+  for instance in instances:
+    yield part_header(boundary, "application/dicom")
+    async for chunk in stream_object(client, bucket, instance["object_key"]):
+      yield chunk
+    yield b"\r\n"
+  yield closing(boundary)
+
+
+def extract_frames(data: bytes, frames: List[int]) -> Tuple[List[bytes], str, Optional[str]]:
+  """
+  The requested 1-based frames of one instance as stored: native pixel
+  bytes, or the compressed bitstream of encapsulated syntaxes.
+  Returns (frames, part media type, transfer syntax of encapsulated frames).
+  Raises FrameError for missing pixel data or out of range frames.
+  """
+  ds = pydicom.dcmread(BytesIO(data), force=True)
+  if "PixelData" not in ds:
+    raise FrameError("Instance has no pixel data")
+  count = int(ds.get("NumberOfFrames", 1) or 1)
+  if any(frame > count for frame in frames):
+    raise FrameError(f"Instance has {count} frame(s)")
+  meta = getattr(ds, "file_meta", None)
+  syntax = meta.get("TransferSyntaxUID") if meta is not None else None
+  if syntax is not None and syntax.is_encapsulated:
+    return (
+      [get_frame(ds.PixelData, frame - 1, number_of_frames=count) for frame in frames],
+      FRAME_MEDIA_TYPES.get(str(syntax), "application/octet-stream"),
+      str(syntax),
+    )
+  bits = int(ds.get("BitsAllocated", 16))
+  if bits % 8:
+    raise FrameError("Bit-packed pixel data cannot be split into frames")
+  length = int(ds.Rows) * int(ds.Columns) * int(ds.get("SamplesPerPixel", 1)) * bits // 8
+  pixels = ds.PixelData
+  return [pixels[(frame - 1) * length:frame * length] for frame in frames], "application/octet-stream", None
+
+
+def _get_object(client, bucket: str, key: str) -> bytes:
+  return client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+
+async def fetch_frames(client, bucket: str, key: str, frames: List[int]) -> Tuple[List[bytes], str, Optional[str]]:
+  """Read one instance from S3 and cut the requested frames out of it on the CPU process pool."""
+  data = await run_s3(_get_object, client, bucket, key)
+  return await run_cpu(extract_frames, data, frames)
+
+
+def frames_body(boundary: str, frames: List[bytes], media_type: str, location: str, numbers: List[int]) -> bytes:
+  parts = []
+  for number, frame in zip(numbers, frames):
+    parts.append(part_header(boundary, media_type, f"{location}/frames/{number}"))
+    parts.append(frame)
+    parts.append(b"\r\n")
+  parts.append(closing(boundary))
+  return b"".join(parts)
@@ -0,0 +1,18 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+# CPU-bound work (DICOM parsing, image codecs) runs in worker processes so
+# it neither blocks the event loop nor fights over the GIL
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(os.cpu_count() or 2)))
+
+# spawn, not fork: the API process already runs threads (S3 pool, asyncpg)
+cpu_executor = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+async def run_cpu(fn, *args, **kwargs):
+  """Run a picklable, module-level function on the CPU process pool."""
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(cpu_executor, partial(fn, *args, **kwargs))
@@ -1,9 +1,18 @@
+import hashlib
 import json
 import os
-from typing import Any, Dict, Iterable, List, Optional
+import shutil
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
+import numpy as np
 import requests
 
+from utils.mask_codec import decode_masks
+
 
 class ApiClientError(RuntimeError):
     """Raised when the API client encounters an unexpected response."""
@@ -44,16 +53,41 @@ class ApiClient:
             raise ApiClientError("Attempted to call an authenticated endpoint without logging in")
         return {"Authorization": f"Bearer {self._token}"}
 
-    def get_sessions(self) -> List[Dict[str, Any]]:
+    def get_sessions_page(
+        self,
+        cursor: Optional[str] = None,
+        limit: Optional[int] = None,
+        created_from: Optional[str] = None,
+        created_to: Optional[str] = None,
+        name: Optional[str] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """One page of sessions, newest first, and the cursor of the next page (None on the last)."""
+        params: Dict[str, Any] = {
+            key: value
+            for key, value in (
+                ("cursor", cursor), ("limit", limit), ("created_from", created_from),
+                ("created_to", created_to), ("name", name),
+            )
+            if value is not None
+        }
         response = requests.get(
             f"{self.base_url}/user/sessions",
             headers=self._auth_headers(),
+            params=params,
             timeout=30,
         )
         response.raise_for_status()
         sessions: List[Dict[str, Any]] = response.json()
         if sessions and not self.user_aid:
             self.user_aid = sessions[0].get("aid")
+        return sessions, response.headers.get("X-Next-Cursor")
+
+    def get_sessions(self, name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Every session, following the listing's cursors page by page."""
+        sessions, cursor = self.get_sessions_page(name=name)
+        while cursor:
+            page, cursor = self.get_sessions_page(cursor=cursor, name=name)
+            sessions.extend(page)
         return sessions
 
     def get_session(self, session_id: int, aid: Optional[int] = None) -> Dict[str, Any]:
@@ -73,12 +107,17 @@ class ApiClient:
             self.user_aid = accession.get("aid")
         return accession
 
-    def get_session_with_files(self, session_id: int, aid: Optional[int] = None) -> Dict[str, Any]:
+    def get_session_with_files(
+        self, session_id: int, aid: Optional[int] = None, file_types: Optional[Iterable[str]] = None
+    ) -> Dict[str, Any]:
+        """Accession with each file's content downloaded; ``file_types`` limits which files are fetched."""
+
         accession = self.get_session(session_id, aid=aid)
+        wanted = set(file_types) if file_types is not None else None
         files: List[Dict[str, Any]] = []
-        for file_info in accession.get("files", []):
+        for file_info in self._in_display_order(session_id, accession.get("files", [])):
             url = file_info.get("s3_url")
-            if not url:
+            if not url or (wanted is not None and file_info.get("type") not in wanted):
                 files.append(file_info)
                 continue
             content = self.download_file(url)
@@ -86,24 +125,183 @@ class ApiClient:
         accession["files"] = files
         return accession
 
+    def get_session_previews(self, session_id: int, level: str = "256", aid: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Download one preview level ("thumb", "128" or "256") per file instead
+        of the full slices, in display order. Files whose previews are not
+        ready yet are skipped.
+        """
+
+        accession = self.get_session(session_id, aid=aid)
+        previews: List[Dict[str, Any]] = []
+        for file_info in self._in_display_order(session_id, accession.get("files", [])):
+            preview = next((p for p in file_info.get("previews", []) if p.get("level") == level), None)
+            if preview is None or not preview.get("s3_url"):
+                continue
+            response = requests.get(preview["s3_url"], timeout=30)
+            response.raise_for_status()
+            previews.append({**preview, "type": file_info.get("type"), "object_key": file_info.get("object_key"), "content": response.content})
+        return previews
+
+    def get_session_masks(self, session_id: int, path: Optional[str] = None) -> List[np.ndarray]:
+        """
+        Every mask of an accession as boolean arrays, fetched as one compact
+        mask stack instead of one full-size file per mask. The raw stack is
+        also saved to ``path`` when given.
+        """
+
+        response = requests.get(
+            f"{self.base_url}/user/masks/{session_id}",
+            headers=self._auth_headers(),
+            timeout=60,
+        )
+        response.raise_for_status()
+        if path:
+            with open(path, "wb") as handle:
+                handle.write(response.content)
+        return decode_masks(response.content)
+
+    def get_volumes(self, session_id: int) -> List[Dict[str, Any]]:
+        """Packed volumes of an accession, one per series, with their headers and a presigned URL."""
+
+        response = requests.get(
+            f"{self.base_url}/user/volumes/{session_id}",
+            headers=self._auth_headers(),
+            timeout=30,
+        )
+        response.raise_for_status()
+        volumes: List[Dict[str, Any]] = response.json()
+        return volumes
+
+    def get_intensity_stats(self, session_id: int, slices: bool = False) -> List[Dict[str, Any]]:
+        """Per-series HU statistics (range, histogram, calcium voxels) of an accession, measured at ingest."""
+
+        response = requests.get(
+            f"{self.base_url}/user/intensity/{session_id}",
+            headers=self._auth_headers(),
+            params={"slices": "true" if slices else "false"},
+            timeout=30,
+        )
+        response.raise_for_status()
+        stats: List[Dict[str, Any]] = response.json()
+        return stats
+
+    def read_volume(self, volume: Dict[str, Any], start: int = 0, stop: Optional[int] = None) -> bytes:
+        """
+        Raw pixels of slices [start, stop) of a packed volume, in one ranged
+        GET on its presigned URL. The result is ``stop - start`` blocks of
+        rows x columns values of ``volume["dtype"]``; multiply slice i by
+        header.rescale_slope[i] and add rescale_intercept[i] for modality units.
+        """
+
+        stop = volume["slices"] if stop is None else stop
+        if not 0 <= start < stop <= volume["slices"]:
+            raise ApiClientError(f"Slices must satisfy 0 <= start < stop <= {volume['slices']}")
+        first = volume["data_offset"] + start * volume["slice_bytes"]
+        last = first + (stop - start) * volume["slice_bytes"] - 1
+        response = requests.get(volume["s3_url"], headers={"Range": f"bytes={first}-{last}"}, timeout=120)
+        response.raise_for_status()
+        if response.status_code != 206 and len(response.content) != last - first + 1:
+            # the server ignored the range and sent the whole object
+            return response.content[first:last + 1]
+        return response.content
+
+    def _in_display_order(self, session_id: int, files: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Order files by the server's header index, so nothing is downloaded just to sort it."""
+
+        try:
+            instances = self.search_all_instances(dicom_id=session_id)
+        except requests.RequestException:
+            return files
+        rank = {instance["object_key"]: i for i, instance in enumerate(instances)}
+        return sorted(files, key=lambda file_info: rank.get(file_info.get("object_key"), len(rank)))
+
+    # ------------------------------------------------------------------
+    # Search helpers (header index, QIDO-RS style parameters)
+    # ------------------------------------------------------------------
+    def _search(self, path: str, filters: Dict[str, Any]) -> List[Dict[str, Any]]:
+        response = requests.get(
+            f"{self.base_url}/user/dicomweb/{path}",
+            headers=self._auth_headers(),
+            params={key: value for key, value in filters.items() if value is not None},
+            timeout=30,
+        )
+        response.raise_for_status()
+        results: List[Dict[str, Any]] = response.json()
+        return results
+
+    def search_studies(self, **filters: Any) -> List[Dict[str, Any]]:
+        return self._search("studies", filters)
+
+    def search_series(self, **filters: Any) -> List[Dict[str, Any]]:
+        return self._search("series", filters)
+
+    def search_instances(self, **filters: Any) -> List[Dict[str, Any]]:
+        """Instances matching e.g. SeriesInstanceUID=..., dicom_id=..., sorted by InstanceNumber."""
+
+        return self._search("instances", filters)
+
+    def search_all_instances(self, page_size: int = 1000, **filters: Any) -> List[Dict[str, Any]]:
+        """Every matching instance, in display order, read page by page until a short page."""
+
+        instances: List[Dict[str, Any]] = []
+        while True:
+            page = self.search_instances(**filters, limit=page_size, offset=len(instances))
+            instances.extend(page)
+            if len(page) < page_size:
+                return instances
+
+    def retrieve_frames(self, study_uid: str, series_uid: str, sop_uid: str, frames: Iterable[int]) -> List[bytes]:
+        """Pixel data of the given 1-based frames of one instance (WADO-RS), one bytes object per frame."""
+
+        frame_list = ",".join(str(frame) for frame in frames)
+        response = requests.get(
+            f"{self.base_url}/user/dicomweb/studies/{study_uid}/series/{series_uid}/instances/{sop_uid}/frames/{frame_list}",
+            headers={**self._auth_headers(), "Accept": "multipart/related; type=\"*/*\""},
+            timeout=60,
+        )
+        response.raise_for_status()
+        return _split_multipart(response.headers.get("Content-Type", ""), response.content)
+
     def download_file(self, url: str) -> bytes:
         response = requests.get(url, headers=self._auth_headers(), timeout=120)
         response.raise_for_status()
         return response.content
 
+    def export_session(self, session_id: int, path: str, chunk_size: int = 1024 * 1024) -> str:
+        """Stream the accession's ZIP export (slices, masks, manifest.json) to ``path`` in one sequential write."""
+
+        with requests.get(
+            f"{self.base_url}/user/export/{session_id}",
+            headers=self._auth_headers(),
+            stream=True,
+            timeout=120,
+        ) as response:
+            response.raise_for_status()
+            with open(path, "wb") as handle:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    handle.write(chunk)
+        return path
+
     def download_session_to_directory(self, session_id: int, destination: str, aid: Optional[int] = None) -> List[str]:
-        accession = self.get_session_with_files(session_id, aid=aid)
+        """Save every file of an accession into ``destination``, fetched as one streamed ZIP export."""
+
+        archive_path = os.path.join(destination, f".export_{session_id}_{uuid.uuid4().hex}.zip")
         saved_files: List[str] = []
-        for file_info in accession.get("files", []):
-            content: Optional[bytes] = file_info.get("content")
-            if not content:
-                continue
-            object_key = file_info.get("object_key") or f"file_{len(saved_files)}"
-            filename = os.path.basename(object_key.strip("/")) or f"file_{len(saved_files)}"
-            path = os.path.join(destination, filename)
-            with open(path, "wb") as handle:
-                handle.write(content)
-            saved_files.append(path)
+        try:
+            self.export_session(session_id, archive_path)
+            with zipfile.ZipFile(archive_path) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or info.filename == "manifest.json":
+                        continue
+                    filename = os.path.basename(info.filename) or f"file_{len(saved_files)}"
+                    path = os.path.join(destination, filename)
+                    with archive.open(info) as source, open(path, "wb") as handle:
+                        shutil.copyfileobj(source, handle, 1024 * 1024)
+                    saved_files.append(path)
+        finally:
+            if os.path.exists(archive_path):
+                os.remove(archive_path)
         return saved_files
 
     # ------------------------------------------------------------------
@@ -115,8 +313,17 @@ class ApiClient:
         dicom_name: str,
         file_paths: Iterable[str],
         agaston_score: int | None = None,
+        idempotency_key: Optional[str] = None,
+        max_retries: int = 3,
     ) -> Dict[str, Any]:
+        """
+        Upload through /user/new_accession. Every attempt carries the same
+        Idempotency-Key, so a retry after a timeout gets the accession the
+        server already created instead of a duplicate.
+        """
+
         file_paths = list(file_paths)
+        idempotency_key = idempotency_key or uuid.uuid4().hex
 
         accession_payload: Dict[str, Any] = {
             "aid": aid,
@@ -125,28 +332,326 @@ class ApiClient:
             "files": [{"type": "slice"} for _ in file_paths],
         }
 
-        files_data = []
-        for path in file_paths:
-            filename = os.path.basename(path)
-            files_data.append((
-                "files",
-                (filename, open(path, "rb"), "application/octet-stream"),
-            ))
+        def send() -> requests.Response:
+            files_data = []
+            for path in file_paths:
+                filename = os.path.basename(path)
+                files_data.append((
+                    "files",
+                    (filename, open(path, "rb"), "application/octet-stream"),
+                ))
+            try:
+                return requests.post(
+                    f"{self.base_url}/user/new_accession",
+                    headers={**self._auth_headers(), "Idempotency-Key": idempotency_key},
+                    data={"accession": json.dumps(accession_payload)},
+                    files=files_data,
+                    timeout=120,
+                )
+            finally:
+                for _, file_tuple in files_data:
+                    file_tuple[1].close()
 
-        try:
+        # 409: the first attempt is still running on the server
+        response = self._with_retries(send, max_retries, retry_statuses=(409,))
+        payload: Dict[str, Any] = response.json()
+        return payload
+
+    def upload_accession_streaming(
+        self,
+        aid: int,
+        dicom_name: str,
+        file_paths: Iterable[str],
+        agaston_score: int | None = None,
+        chunk_size: int = 1024 * 1024,
+    ) -> Dict[str, Any]:
+        """Upload through /user/new_accession/stream, reading each file from disk as it is sent."""
+
+        file_paths = list(file_paths)
+        accession_payload: Dict[str, Any] = {
+            "aid": aid,
+            "dicom_name": dicom_name,
+            "agaston_score": agaston_score or 0,
+            "files": [{"type": "slice"} for _ in file_paths],
+        }
+        boundary = uuid.uuid4().hex
+        response = requests.post(
+            f"{self.base_url}/user/new_accession/stream",
+            headers={
+                **self._auth_headers(),
+                "Content-Type": f"multipart/form-data; boundary={boundary}",
+            },
+            data=_iter_multipart(boundary, {"accession": json.dumps(accession_payload)}, file_paths, chunk_size),
+            timeout=120,
+        )
+        response.raise_for_status()
+        payload: Dict[str, Any] = response.json()
+        return payload
+
+    def upload_accession_archive(
+        self,
+        aid: int,
+        dicom_name: str,
+        archive_path: str,
+        agaston_score: int | None = None,
+    ) -> Dict[str, Any]:
+        """Upload a whole study as one ZIP (optionally with a DICOMDIR); the server expands it."""
+
+        accession_payload: Dict[str, Any] = {
+            "aid": aid,
+            "dicom_name": dicom_name,
+            "agaston_score": agaston_score or 0,
+            "files": [],
+        }
+        with open(archive_path, "rb") as handle:
             response = requests.post(
-                f"{self.base_url}/user/new_accession",
+                f"{self.base_url}/user/new_accession/archive",
                 headers=self._auth_headers(),
                 data={"accession": json.dumps(accession_payload)},
-                files=files_data,
+                files={"archive": (os.path.basename(archive_path), handle, "application/zip")},
+                timeout=600,
+            )
+        response.raise_for_status()
+        payload: Dict[str, Any] = response.json()
+        return payload
+
+    def update_accession(
+        self,
+        dicom_id: int,
+        add: Iterable[str] = (),
+        replace: Optional[Dict[str, str]] = None,
+        remove: Iterable[str] = (),
+        mask_paths: Iterable[str] = (),
+        dicom_name: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Change an accession in place: `add` and `mask_paths` are new slice
+        and mask files, `replace` maps stored object keys to the file that
+        replaces them, `remove` lists stored object keys to drop. Only the
+        new files are sent.
+        """
+
+        changes: List[Dict[str, Any]] = []
+        paths: List[str] = []
+        for path in add:
+            changes.append({"op": "add", "filetype": "slice", "filename": os.path.basename(path)})
+            paths.append(path)
+        for path in mask_paths:
+            changes.append({"op": "add", "filetype": "mask", "filename": os.path.basename(path)})
+            paths.append(path)
+        for object_key, path in (replace or {}).items():
+            changes.append({"op": "replace", "object_key": object_key, "filename": os.path.basename(path)})
+            paths.append(path)
+        for object_key in remove:
+            changes.append({"op": "remove", "object_key": object_key})
+        if len({os.path.basename(path) for path in paths}) != len(paths):
+            raise ValueError("Files sent in one update need distinct names")
+
+        handles = [open(path, "rb") for path in paths]
+        try:
+            response = requests.post(
+                f"{self.base_url}/user/update_accession",
+                headers=self._auth_headers(),
+                data={"changes": json.dumps({"dicom_id": dicom_id, "dicom_name": dicom_name, "changes": changes})},
+                files=[
+                    ("files", (os.path.basename(path), handle, "application/octet-stream"))
+                    for path, handle in zip(paths, handles)
+                ],
                 timeout=120,
             )
-            response.raise_for_status()
-            payload: Dict[str, Any] = response.json()
-            return payload
         finally:
-            for _, file_tuple in files_data:
-                file_tuple[1].close()
+            for handle in handles:
+                handle.close()
+        response.raise_for_status()
+        payload: Dict[str, Any] = response.json()
+        return payload
+
+    def upload_accession_resumable(
+        self,
+        aid: int,
+        dicom_name: str,
+        file_paths: Iterable[str],
+        agaston_score: int | None = None,
+        chunk_size: int = 8 * 1024 * 1024,
+        state_path: Optional[str] = None,
+        max_retries: int = 5,
+    ) -> Dict[str, Any]:
+        """Upload a series in numbered chunks that survive dropped connections.
+
+        Progress (the server-side upload id of every file) is kept in
+        ``state_path`` when given, so calling this again with the same
+        arguments after a crash only sends the chunks the server is missing.
+        """
+
+        file_paths = list(file_paths)
+        state: Dict[str, str] = {}
+        if state_path and os.path.exists(state_path):
+            with open(state_path, "r", encoding="utf-8") as handle:
+                state = json.load(handle)
+
+        upload_ids: List[str] = []
+        for path in file_paths:
+            upload = self._resume_or_create_upload(state.get(path), path, chunk_size)
+            state[path] = upload["upload_id"]
+            if state_path:
+                with open(state_path, "w", encoding="utf-8") as handle:
+                    json.dump(state, handle)
+            if upload["status"] == "open":
+                self._send_missing_chunks(upload, path, max_retries)
+                self._with_retries(
+                    lambda: requests.post(
+                        f"{self.base_url}/user/uploads/{upload['upload_id']}/complete",
+                        headers=self._auth_headers(),
+                        timeout=60,
+                    ),
+                    max_retries,
+                )
+            upload_ids.append(upload["upload_id"])
+
+        response = self._with_retries(
+            lambda: requests.post(
+                f"{self.base_url}/user/uploads/finalize",
+                headers=self._auth_headers(),
+                json={
+                    "aid": aid,
+                    "dicom_name": dicom_name,
+                    "agaston_score": agaston_score or 0,
+                    "upload_ids": upload_ids,
+                },
+                timeout=60,
+            ),
+            max_retries,
+        )
+        if state_path and os.path.exists(state_path):
+            os.remove(state_path)
+        payload: Dict[str, Any] = response.json()
+        return payload
+
+    def upload_accession_direct(
+        self,
+        aid: int,
+        dicom_name: str,
+        file_paths: Iterable[str],
+        agaston_score: int | None = None,
+        max_workers: int = 8,
+        max_retries: int = 3,
+    ) -> Dict[str, Any]:
+        """Upload slices straight to object storage with presigned URLs, then finalize.
+
+        The API only signs URLs and records the result, so file bytes never
+        pass through it. Files whose content this account already holds are
+        not sent at all.
+        """
+
+        file_paths = list(file_paths)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            digests = list(pool.map(_sha256_file, file_paths))
+        response = requests.post(
+            f"{self.base_url}/user/uploads/presign",
+            headers=self._auth_headers(),
+            json={
+                "files": [
+                    {"filename": os.path.basename(path), "filetype": "slice", "sha256": digest}
+                    for path, digest in zip(file_paths, digests)
+                ]
+            },
+            timeout=30,
+        )
+        response.raise_for_status()
+        signed: List[Dict[str, Any]] = response.json()["files"]
+
+        def put(item: Dict[str, Any], path: str) -> None:
+            if item.get("exists"):
+                return
+
+            def send() -> requests.Response:
+                with open(path, "rb") as handle:
+                    return requests.put(item["url"], data=handle, headers=item.get("headers") or {}, timeout=120)
+            self._with_retries(send, max_retries)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            # list() surfaces the first failed upload as an exception
+            list(pool.map(put, signed, file_paths))
+
+        response = self._with_retries(
+            lambda: requests.post(
+                f"{self.base_url}/user/uploads/presigned/finalize",
+                headers=self._auth_headers(),
+                json={
+                    "aid": aid,
+                    "dicom_name": dicom_name,
+                    "agaston_score": agaston_score or 0,
+                    "files": [
+                        {"filename": item["filename"], "filetype": item["filetype"], "object_key": item["object_key"]}
+                        for item in signed
+                    ],
+                },
+                timeout=60,
+            ),
+            max_retries,
+        )
+        payload: Dict[str, Any] = response.json()
+        return payload
+
+    def _resume_or_create_upload(self, upload_id: Optional[str], path: str, chunk_size: int) -> Dict[str, Any]:
+        if upload_id:
+            response = requests.get(
+                f"{self.base_url}/user/uploads/{upload_id}",
+                headers=self._auth_headers(),
+                timeout=30,
+            )
+            if response.status_code != 404:
+                response.raise_for_status()
+                upload: Dict[str, Any] = response.json()
+                if upload["status"] in ("open", "complete"):
+                    return upload
+        response = requests.post(
+            f"{self.base_url}/user/uploads",
+            headers=self._auth_headers(),
+            json={
+                "filename": os.path.basename(path),
+                "size": os.path.getsize(path),
+                "filetype": "slice",
+                "chunk_size": chunk_size,
+            },
+            timeout=30,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def _send_missing_chunks(self, upload: Dict[str, Any], path: str, max_retries: int) -> None:
+        chunk_size = upload["chunk_size"]
+        with open(path, "rb") as handle:
+            for chunk in upload.get("missing_chunks", []):
+                handle.seek((chunk - 1) * chunk_size)
+                data = handle.read(chunk_size)
+                self._with_retries(
+                    lambda: requests.put(
+                        f"{self.base_url}/user/uploads/{upload['upload_id']}/chunks/{chunk}",
+                        headers={**self._auth_headers(), "Content-Type": "application/octet-stream"},
+                        data=data,
+                        timeout=120,
+                    ),
+                    max_retries,
+                )
+
+    @staticmethod
+    def _with_retries(send, max_retries: int, retry_statuses: Iterable[int] = ()) -> requests.Response:
+        """Retry a request on connection errors, timeouts and 5xx with exponential backoff."""
+
+        retry_statuses = set(retry_statuses)
+        for attempt in range(max_retries + 1):
+            try:
+                response = send()
+                retryable = response.status_code >= 500 or response.status_code in retry_statuses
+                if not retryable or attempt == max_retries:
+                    response.raise_for_status()
+                    return response
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == max_retries:
+                    raise
+            time.sleep(min(2 ** attempt, 30))
+        raise ApiClientError("unreachable")
 
     # Convenience ----------------------------------------------------------------
     def ensure_user_aid(self) -> int:
@@ -158,3 +663,62 @@ class ApiClient:
             if self.user_aid is not None:
                 return self.user_aid
         raise ApiClientError("Unable to determine the current user's AID")
+
+
+def _sha256_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        while True:
+            chunk = handle.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _iter_multipart(boundary: str, fields: Dict[str, str], file_paths: List[str], chunk_size: int) -> Iterator[bytes]:
+    """Yield a multipart/form-data body without holding any file in memory.
+
+    Fields come first so the server can route the files as they arrive.
+    """
+
+    for name, value in fields.items():
+        yield (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+        ).encode("utf-8")
+        yield value.encode("utf-8")
+        yield b"\r\n"
+    for path in file_paths:
+        filename = os.path.basename(path)
+        yield (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="files"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8")
+        with open(path, "rb") as handle:
+            while True:
+                chunk = handle.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode("utf-8")
+
+
+def _split_multipart(content_type: str, body: bytes) -> List[bytes]:
+    """Part bodies of a multipart/related response, in order."""
+
+    boundary = next(
+        (param.split("=", 1)[1].strip().strip('"') for param in content_type.split(";") if param.strip().startswith("boundary=")),
+        None,
+    )
+    if not boundary:
+        raise ApiClientError("Multipart response without a boundary")
+    parts: List[bytes] = []
+    for chunk in body.split(f"--{boundary}".encode("utf-8"))[1:]:
+        if chunk.startswith(b"--"):
+            break
+        _, _, content = chunk.partition(b"\r\n\r\n")
+        parts.append(content[:-2] if content.endswith(b"\r\n") else content)
+    return parts
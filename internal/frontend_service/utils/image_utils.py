@@ -9,14 +9,29 @@ def apply_windowing(pixel_array, center, width):
     img = np.clip(img, lower, upper)
     return ((img - lower) / (upper - lower)) * 255
 
-def get_qimage(dcm):
+def series_window(stats, low=0.5, high=99.5):
+    """(center, width) spanning the low..high percentiles of a series histogram from get_intensity_stats."""
+    counts = np.asarray(stats["histogram"], dtype=np.float64)
+    if not counts.sum():
+        return None
+    cumulative = np.cumsum(counts) / counts.sum()
+    edges = stats["histogram_min"] + stats["bin_width"] * np.arange(counts.size + 1)
+    lower = edges[np.searchsorted(cumulative, low / 100)]
+    upper = edges[np.searchsorted(cumulative, high / 100) + 1]
+    return float(lower + upper) / 2, max(float(upper - lower), 1.0)
+
+def get_qimage(dcm, window=None):
+    """The slice as an 8-bit QImage, windowed with (center, width) if given, else the slice's own window."""
     img = dcm.pixel_array.astype(np.float32)
     slope = float(getattr(dcm, "RescaleSlope", 1))
     intercept = float(getattr(dcm, "RescaleIntercept", 0))
     img = img * slope + intercept
 
-    center = float(dcm.WindowCenter[0]) if isinstance(dcm.WindowCenter, pydicom.multival.MultiValue) else float(dcm.WindowCenter)
-    width = float(dcm.WindowWidth[0]) if isinstance(dcm.WindowWidth, pydicom.multival.MultiValue) else float(dcm.WindowWidth)
+    if window is not None:
+        center, width = window
+    else:
+        center = float(dcm.WindowCenter[0]) if isinstance(dcm.WindowCenter, pydicom.multival.MultiValue) else float(dcm.WindowCenter)
+        width = float(dcm.WindowWidth[0]) if isinstance(dcm.WindowWidth, pydicom.multival.MultiValue) else float(dcm.WindowWidth)
 
     img = apply_windowing(img, center, width).astype(np.uint8)
 
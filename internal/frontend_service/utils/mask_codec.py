@@ -0,0 +1,60 @@
+import struct
+from typing import List
+
+import numpy as np
+
+# Reader for the API's mask stack format (see GET /user/masks/{dicom_id}):
+# a preamble, one index entry per slice, then every slice either
+# bit-packed or as alternating background/foreground run lengths.
+MAGIC = b"PMSK"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("<4sHI")
+INDEX_DTYPE = np.dtype([("encoding", "u1"), ("rows", "<u4"), ("columns", "<u4"), ("offset", "<u8"), ("length", "<u8")])
+EMPTY, BITPACKED, RUNS16, RUNS32 = 0, 1, 2, 3
+EXTENSION = ".pmsk"
+
+
+class MaskFormatError(ValueError):
+    """Raised when bytes are not a valid mask stack."""
+
+
+def decode_slice(encoding: int, rows: int, columns: int, payload) -> np.ndarray:
+    size = rows * columns
+    if encoding == EMPTY:
+        return np.zeros((rows, columns), dtype=bool)
+    if encoding == BITPACKED:
+        flat = np.unpackbits(np.frombuffer(payload, dtype=np.uint8), count=size, bitorder="little")
+        return flat.astype(bool).reshape(rows, columns)
+    if encoding in (RUNS16, RUNS32):
+        runs = np.frombuffer(payload, dtype="<u2" if encoding == RUNS16 else "<u4")
+        if int(runs.sum()) != size:
+            raise MaskFormatError("Run lengths do not cover the slice")
+        values = (np.arange(runs.size) % 2).astype(bool)
+        return np.repeat(values, runs).reshape(rows, columns)
+    raise MaskFormatError(f"Unknown slice encoding {encoding}")
+
+
+def decode_masks(data: bytes) -> List[np.ndarray]:
+    """Decode a mask stack into one boolean array per slice."""
+
+    if len(data) < PREAMBLE.size:
+        raise MaskFormatError("Mask stack is truncated")
+    magic, version, count = PREAMBLE.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise MaskFormatError("Not a mask stack, or an unsupported version")
+    index = np.frombuffer(data, dtype=INDEX_DTYPE, count=count, offset=PREAMBLE.size)
+    view = memoryview(data)
+    return [
+        decode_slice(
+            int(entry["encoding"]),
+            int(entry["rows"]),
+            int(entry["columns"]),
+            view[int(entry["offset"]):int(entry["offset"]) + int(entry["length"])],
+        )
+        for entry in index
+    ]
+
+
+def read_mask_file(path: str) -> List[np.ndarray]:
+    with open(path, "rb") as handle:
+        return decode_masks(handle.read())
@@ -118,13 +118,13 @@ class MainMenu(QWidget):
             return None
         return items[0].data(Qt.UserRole)
 
-    def _fetch_accession(self) -> Optional[Dict[str, Any]]:
+    def _fetch_accession(self, file_types: Optional[Tuple[str, ...]] = None) -> Optional[Dict[str, Any]]:
         session_id = self._selected_session_id()
         if session_id is None:
             QMessageBox.information(self, "No selection", "Please select a session first.")
             return None
         try:
-            accession = self.api_client.get_session_with_files(session_id)
+            accession = self.api_client.get_session_with_files(session_id, file_types=file_types)
         except requests.HTTPError as exc:
             QMessageBox.critical(self, "Error", f"API error: {exc.response.text}")
             return None
@@ -162,6 +162,19 @@ class MainMenu(QWidget):
             dicom_slices.sort(key=lambda ds: int(getattr(ds, "InstanceNumber", 0)))
         return dicom_slices, mask_images
 
+    def _fetch_masks(self, accession: Dict[str, Any]) -> List[np.ndarray]:
+        """The accession's masks as boolean arrays, from the server's compact mask stack."""
+
+        if not any(file_info.get("type") == "mask" for file_info in accession.get("files", [])):
+            return []
+        try:
+            return self.api_client.get_session_masks(accession["dicom_id"])
+        except requests.HTTPError as exc:
+            QMessageBox.critical(self, "Error", f"API error: {exc.response.text}")
+        except (requests.RequestException, ApiClientError, ValueError) as exc:
+            QMessageBox.critical(self, "Error", f"Failed to fetch masks: {exc}")
+        return []
+
     # ------------------------------------------------------------------
     def launch_single(self) -> None:
         accession = self._fetch_accession()
@@ -186,10 +199,11 @@ class MainMenu(QWidget):
         viewer.show()
 
     def launch_side_by_side(self) -> None:
-        accession = self._fetch_accession()
+        accession = self._fetch_accession(file_types=("slice",))
         if not accession:
             return
-        dicom_slices, masks = self._partition_files(accession)
+        dicom_slices, _ = self._partition_files(accession)
+        masks = self._fetch_masks(accession)
         if not dicom_slices or not masks:
             QMessageBox.information(self, "Incomplete data", "Side-by-side view requires both slices and masks.")
             return
@@ -197,10 +211,11 @@ class MainMenu(QWidget):
         viewer.show()
 
     def launch_overlay(self) -> None:
-        accession = self._fetch_accession()
+        accession = self._fetch_accession(file_types=("slice",))
         if not accession:
             return
-        dicom_slices, masks = self._partition_files(accession)
+        dicom_slices, _ = self._partition_files(accession)
+        masks = self._fetch_masks(accession)
         if not dicom_slices or not masks:
             QMessageBox.information(self, "Incomplete data", "Overlay view requires both slices and masks.")
             return
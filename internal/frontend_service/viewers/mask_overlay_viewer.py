@@ -18,6 +18,7 @@ from PyQt5.QtWidgets import (
 )
 
 from utils.dicom_loader import load_dicom_slices
+from utils.mask_codec import EXTENSION as MASK_EXTENSION, read_mask_file
 
 
 class MaskOverlayViewer(QWidget):
@@ -100,6 +101,11 @@ class MaskOverlayViewer(QWidget):
             for i, ds in enumerate(self.dicom_slices)
         }
 
+        # a compact mask stack already holds every slice, in order
+        stacks = sorted(name for name in os.listdir(folder_path) if name.endswith(MASK_EXTENSION))
+        if stacks:
+            return read_mask_file(os.path.join(folder_path, stacks[0]))
+
         mask_images: List[np.ndarray] = [None] * len(self.dicom_slices)  # type: ignore
 
         for fname in os.listdir(folder_path):
@@ -18,6 +18,7 @@ from PyQt5.QtWidgets import (
 )
 
 from utils.dicom_loader import load_dicom_slices
+from utils.mask_codec import EXTENSION as MASK_EXTENSION, read_mask_file
 from utils.image_utils import get_qimage
 
 
@@ -110,6 +111,11 @@ class MaskSideBySideViewer(QWidget):
             for i, ds in enumerate(self.dicom_slices)
         }
 
+        # a compact mask stack already holds every slice, in order
+        stacks = sorted(name for name in os.listdir(folder_path) if name.endswith(MASK_EXTENSION))
+        if stacks:
+            return read_mask_file(os.path.join(folder_path, stacks[0]))
+
         mask_images: List[np.ndarray] = [None] * len(self.dicom_slices)  # type: ignore
 
         for fname in os.listdir(folder_path):
@@ -158,6 +164,8 @@ class MaskSideBySideViewer(QWidget):
         self.slice_label.setPixmap(pixmap)
 
         # Mask to QPixmap based on mode
+        if mask_img.dtype == bool:
+            mask_img = mask_img.astype(np.uint8) * 255
         height, width = mask_img.shape[:2]
 
         if self.mode == "grayscale":